@@ -37,6 +37,7 @@ from core.model import (
     ConfigurationSetting,
     Contributor,
     CustomList,
+    CustomListEntry,
     DataSource,
     Edition,
     ExternalIntegration,
@@ -90,6 +91,7 @@ from api.registry import (
 from google_oauth_admin_authentication_provider import GoogleOAuthAdminAuthenticationProvider
 from password_admin_authentication_provider import PasswordAdminAuthenticationProvider
 
+from api.circulation import PatronActivityExecutor
 from api.controller import CirculationManagerController
 from api.coverage import MetadataWranglerCollectionRegistrar
 from core.app_server import entry_response
@@ -100,6 +102,8 @@ from core.app_server import (
 )
 from core.opds import AcquisitionFeed
 from opds import AdminAnnotator, AdminFeed
+from dashboard_stats import DashboardStats
+from lane_sizes import LaneSizeQueue
 from collections import Counter
 from core.classifier import (
     genres,
@@ -109,12 +113,15 @@ from core.classifier import (
 )
 from datetime import datetime, timedelta
 from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import desc, nullslast, or_, and_, distinct, select, join
-from sqlalchemy.orm import lazyload
+from sqlalchemy.sql.expression import desc, nullslast, or_, and_, distinct, select, join, tuple_
+from sqlalchemy.orm import lazyload, joinedload
 
 from templates import admin as admin_template
 
-from api.authenticator import AuthenticationProvider
+from api.authenticator import (
+    AuthenticationProvider,
+    BasicAuthenticationProvider,
+)
 from api.simple_authentication import SimpleAuthenticationProvider
 from api.millenium_patron import MilleniumPatronAPI
 from api.sip import SIP2AuthenticationProvider
@@ -1341,9 +1348,9 @@ class WorkController(AdminCirculationManagerController):
                     for lane in Lane.affected_by_customlist(list):
                         affected_lanes.add(lane)
 
-            # If any list changes affected lanes, update their sizes.
-            for lane in affected_lanes:
-                lane.update_size(self._db)
+            # If any list changes affected lanes, their sizes will be
+            # updated by bin/update_lane_sizes.
+            LaneSizeQueue.add(self._db, affected_lanes)
 
             return Response(unicode(_("Success")), 200)
 
@@ -1417,6 +1424,7 @@ class CustomListsController(AdminCirculationManagerController):
 
     def _create_or_update_list(self, library, name, entries, collections, id=None):
         data_source = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
+        now = datetime.utcnow()
 
         old_list_with_name = CustomList.find(self._db, name, library=library)
 
@@ -1433,10 +1441,10 @@ class CustomListsController(AdminCirculationManagerController):
             return CUSTOM_LIST_NAME_ALREADY_IN_USE
         else:
             list, is_new = create(self._db, CustomList, name=name, data_source=data_source)
-            list.created = datetime.now()
+            list.created = now
             list.library = library
 
-        list.updated = datetime.now()
+        list.updated = now
         list.name = name
 
         if entries:
@@ -1444,41 +1452,14 @@ class CustomListsController(AdminCirculationManagerController):
         else:
             entries = []
 
-        old_entries = [x for x in list.entries if x.edition]
-        membership_change = False
-        for entry in entries:
-            urn = entry.get("identifier_urn")
-
-            identifier, ignore = Identifier.parse_urn(self._db, urn)
-            query = self._db.query(
-                Work
-            ).join(
-                LicensePool, LicensePool.work_id==Work.id
-            ).join(
-                Collection, LicensePool.collection_id==Collection.id
-            ).filter(
-                LicensePool.identifier_id==identifier.id
-            ).filter(
-                Collection.id.in_([c.id for c in library.all_collections])
-            )
-            work = query.one()
-
-            if work:
-                entry, entry_is_new = list.add_entry(work, featured=True)
-                if entry_is_new:
-                    membership_change = True
-
-        new_urns = [entry.get("identifier_urn") for entry in entries]
-        for entry in old_entries:
-            if entry.edition.primary_identifier.urn not in new_urns:
-                list.remove_entry(entry.edition)
-                membership_change = True
+        urns = [entry.get("identifier_urn") for entry in entries]
+        membership_change = self._update_list_entries(library, list, urns, now)
 
         if membership_change:
             # If this list was used to populate any lanes, those
-            # lanes need to have their counts updated.
-            for lane in Lane.affected_by_customlist(list):
-                lane.update_size(self._db)
+            # lanes need to have their counts updated. That can be
+            # slow, so it's done later by bin/update_lane_sizes.
+            LaneSizeQueue.add(self._db, Lane.affected_by_customlist(list))
 
         if collections:
             collections = json.loads(collections)
@@ -1501,6 +1482,130 @@ class CustomListsController(AdminCirculationManagerController):
         else:
             return Response(unicode(list.id), 200)
 
+    def _works_for_urns(self, library, urns):
+        """Find the works in a library's collections that have the
+        given identifiers, with a single query.
+
+        :return: A dictionary mapping URNs to Works. URNs that don't
+            correspond to a work in the library are left out.
+        """
+        identifiers_by_urn, failures = Identifier.parse_urns(
+            self._db, urns, autocreate=False
+        )
+        if not identifiers_by_urn:
+            return {}
+        urns_by_identifier_id = dict(
+            (identifier.id, urn)
+            for urn, identifier in identifiers_by_urn.items()
+        )
+        qu = self._db.query(
+            LicensePool.identifier_id, Work
+        ).join(
+            Work, LicensePool.work_id==Work.id
+        ).filter(
+            LicensePool.identifier_id.in_(urns_by_identifier_id.keys())
+        ).filter(
+            LicensePool.collection_id.in_(
+                [c.id for c in library.all_collections]
+            )
+        ).options(
+            joinedload(Work.presentation_edition)
+        )
+        return dict(
+            (urns_by_identifier_id[identifier_id], work)
+            for identifier_id, work in qu
+        )
+
+    def _update_list_entries(self, library, list, urns, now):
+        """Make the list contain exactly the works with the given URNs.
+
+        The current entries are compared with the new ones as sets,
+        and the differences are added and removed in bulk, rather than
+        through CustomList.add_entry and remove_entry. Like those
+        methods, this updates the search documents of the works that
+        were added or removed, though here it's done with a single
+        bulk request. As add_entry would, it marks every entry on the
+        new list, old or new, as featured and as having appeared at
+        `now`. The caller is responsible for setting list.updated.
+
+        :return: True if any entries were added or removed.
+        """
+        works_by_urn = self._works_for_urns(library, urns)
+
+        # Find the list's current entries, along with the URN of each
+        # entry's edition.
+        current = self._db.query(
+            CustomListEntry.id, CustomListEntry.work_id, Identifier
+        ).join(
+            Edition, CustomListEntry.edition_id==Edition.id
+        ).join(
+            Identifier, Edition.primary_identifier_id==Identifier.id
+        ).filter(
+            CustomListEntry.list_id==list.id
+        ).all()
+        current_urns = set()
+        current_work_ids = set()
+        to_keep = []
+        to_remove = []
+        removed_work_ids = set()
+        new_urns = set(urns)
+        for entry_id, work_id, identifier in current:
+            urn = identifier.urn
+            if urn in new_urns:
+                current_urns.add(urn)
+                current_work_ids.add(work_id)
+                to_keep.append(entry_id)
+            else:
+                to_remove.append(entry_id)
+                if work_id:
+                    removed_work_ids.add(work_id)
+
+        if to_remove:
+            self._db.query(CustomListEntry).filter(
+                CustomListEntry.id.in_(to_remove)
+            ).delete(synchronize_session='fetch')
+        if to_keep:
+            # The entries that stay on the list have just appeared on
+            # it again.
+            self._db.query(CustomListEntry).filter(
+                CustomListEntry.id.in_(to_keep)
+            ).update(
+                dict(featured=True, most_recent_appearance=now),
+                synchronize_session='fetch'
+            )
+        changed_works = []
+        if removed_work_ids:
+            changed_works = self._db.query(Work).filter(
+                Work.id.in_(removed_work_ids)
+            ).all()
+
+        added = []
+        for urn in urns:
+            work = works_by_urn.get(urn)
+            if (not work or urn in current_urns
+                or work.id in current_work_ids):
+                continue
+            added.append(CustomListEntry(
+                customlist=list, work=work,
+                edition=work.presentation_edition, featured=True,
+                first_appearance=now, most_recent_appearance=now,
+            ))
+            current_work_ids.add(work.id)
+            changed_works.append(work)
+        self._db.add_all(added)
+
+        if to_remove or added:
+            self._db.flush()
+            # A work's search document lists the custom lists it's on.
+            search = self.manager.external_search
+            if search and changed_works:
+                search.bulk_update(changed_works)
+            # The list's relationship to its entries may have been
+            # loaded before the bulk delete.
+            self._db.expire(list, ['entries'])
+            return True
+        return False
+
     def custom_list(self, list_id):
         library = flask.request.library
         self.require_librarian(library)
@@ -1696,6 +1801,19 @@ class LanesController(AdminCirculationManagerController):
 class DashboardController(AdminCirculationManagerController):
 
     def stats(self):
+        # Use the saved snapshot of the numbers if it's recent enough;
+        # otherwise calculate them now.
+        dashboard = None
+        max_age = ConfigurationSetting.sitewide(
+            self._db, Configuration.DASHBOARD_STATS_SNAPSHOT_MAX_AGE
+        ).int_value
+        if max_age:
+            dashboard = DashboardStats.from_snapshot(
+                self._db, timedelta(minutes=max_age)
+            )
+        if not dashboard:
+            dashboard = DashboardStats.calculate(self._db)
+
         library_stats = {}
 
         total_title_count = 0
@@ -1707,127 +1825,17 @@ class DashboardController(AdminCirculationManagerController):
             if not flask.request.admin or not flask.request.admin.can_see_collection(collection):
                 continue
 
-            licensed_title_count = self._db.query(
-                LicensePool
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                and_(
-                    LicensePool.licenses_owned > 0,
-                    LicensePool.open_access == False,
-                )
-            ).count()
-
-            open_title_count = self._db.query(
-                LicensePool
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == True
-            ).count()
-
-            # The sum queries return None instead of 0 if there are
-            # no license pools in the db.
-
-            license_count = self._db.query(
-                func.sum(LicensePool.licenses_owned)
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == False,
-            ).all()[0][0] or 0
-
-            available_license_count = self._db.query(
-                func.sum(LicensePool.licenses_available)
-            ).filter(
-                LicensePool.collection_id == collection.id
-            ).filter(
-                LicensePool.open_access == False,
-            ).all()[0][0] or 0
-
-            total_title_count += licensed_title_count + open_title_count
-            total_license_count += license_count
-            total_available_license_count += available_license_count
-
-            collection_counts[collection.name] = dict(
-                licensed_titles=licensed_title_count,
-                open_access_titles=open_title_count,
-                licenses=license_count,
-                available_licenses=available_license_count,
-            )
+            counts = dashboard.for_collection(collection)
+            total_title_count += counts["licensed_titles"] + counts["open_access_titles"]
+            total_license_count += counts["licenses"]
+            total_available_license_count += counts["available_licenses"]
+            collection_counts[collection.name] = counts
 
-        
         for library in self._db.query(Library):
             # Only include libraries this admin has librarian access to.
             if not flask.request.admin or not flask.request.admin.is_librarian(library):
                 continue
 
-            patron_count = self._db.query(Patron).filter(Patron.library_id==library.id).count()
-
-            active_loans_patron_count = self._db.query(
-                distinct(Patron.id)
-            ).join(
-                Patron.loans
-            ).filter(
-                Loan.end >= datetime.now(),
-            ).filter(
-                Patron.library_id == library.id
-            ).count()
-
-            active_patrons = select(
-                [Patron.id]
-            ).select_from(
-                join(
-                    Loan,
-                    Patron,
-                    and_(
-                        Patron.id == Loan.patron_id,
-                        Patron.library_id == library.id,
-                        Loan.id != None,
-                        Loan.end >= datetime.now()
-                    )
-                )
-            ).union(
-                select(
-                    [Patron.id]
-                ).select_from(
-                    join(
-                        Hold,
-                        Patron,
-                        Patron.id == Hold.patron_id,
-                        Patron.library_id == library.id,
-                    )
-                )
-            ).alias()
-
-
-            active_loans_or_holds_patron_count_query = select(
-                [func.count(distinct(active_patrons.c.id))]
-            ).select_from(
-                active_patrons
-            )
-
-            result = self._db.execute(active_loans_or_holds_patron_count_query)
-            active_loans_or_holds_patron_count = [r[0] for r in result][0]
-
-            loan_count = self._db.query(
-                Loan
-            ).join(
-                Loan.patron
-            ).filter(
-                Patron.library_id == library.id
-            ).filter(
-                Loan.end >= datetime.now()
-            ).count()
-
-            hold_count = self._db.query(
-                Hold
-            ).join(
-                Hold.patron
-            ).filter(
-                Patron.library_id == library.id
-            ).count()
-
             title_count = 0
             license_count = 0
             available_license_count = 0
@@ -1841,13 +1849,7 @@ class DashboardController(AdminCirculationManagerController):
                 available_license_count += counts.get("available_licenses", 0)
 
             library_stats[library.short_name] = dict(
-                patrons=dict(
-                    total=patron_count,
-                    with_active_loans=active_loans_patron_count,
-                    with_active_loans_or_holds=active_loans_or_holds_patron_count,
-                    loans=loan_count,
-                    holds=hold_count,
-                ),
+                patrons=dashboard.for_library(library),
                 inventory=dict(
                     titles=title_count,
                     licenses=license_count,
@@ -1891,8 +1893,23 @@ class DashboardController(AdminCirculationManagerController):
             collections=collection_counts,
         )
 
+        # Let the client know how fresh the numbers are.
+        library_stats["total"]["as_of"] = dashboard.as_of.strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+
         return library_stats
 
+    def patron_activity_latency(self):
+        """Show how long each kind of distributor has been taking to
+        report on patrons' loans and holds.
+
+        The numbers are kept by each server process, so they only
+        cover requests handled by the process that answers this one.
+        """
+        self.require_system_admin()
+        return PatronActivityExecutor.latency_report()
+
     def circulation_events(self):
         annotator = AdminAnnotator(self.circulation, flask.request.library)
         num = min(int(flask.request.args.get("num", "100")), 500)
@@ -1919,46 +1936,51 @@ class DashboardController(AdminCirculationManagerController):
 
         return dict({ "circulation_events": events })
 
+    # When exporting circulation events, load this many at a time.
+    BULK_CIRCULATION_EVENTS_CHUNK_SIZE = 1000
+
     def bulk_circulation_events(self):
+        """Export the circulation events that happened between two dates.
+
+        The dates come from the 'start' and 'end' arguments, in the
+        format YYYY-MM-DD, and both days are included. A single day
+        can be requested with the 'date' argument. The default is
+        today.
+
+        :return: A 2-tuple (rows, date). `rows` is a generator that
+            yields a header row followed by one row per event, and
+            `date` describes the range of dates covered.
+        """
         default = str(datetime.today()).split(" ")[0]
         date = flask.request.args.get("date", default)
-        next_date = datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)
-
-        query = self._db.query(
-                CirculationEvent, Identifier, Work, Edition
-            ) \
-            .join(LicensePool, LicensePool.id == CirculationEvent.license_pool_id) \
-            .join(Identifier, Identifier.id == LicensePool.identifier_id) \
-            .join(Work, Work.id == LicensePool.work_id) \
-            .join(Edition, Edition.id == Work.presentation_edition_id) \
-            .filter(CirculationEvent.start >= date) \
-            .filter(CirculationEvent.start < next_date) \
-            .order_by(CirculationEvent.start.asc())
-        query = query \
-            .options(lazyload(Identifier.licensed_through)) \
-            .options(lazyload(Work.license_pools))
-        results = query.all()
-
-        work_ids = map(lambda result: result[2].id, results)
+        start = flask.request.args.get("start", date)
+        end = flask.request.args.get("end", start)
+        try:
+            start_date = datetime.strptime(start, "%Y-%m-%d")
+            end_date = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
+        except ValueError:
+            return INVALID_DATE_FORMAT, None
+        if start != end:
+            date = "%s_%s" % (start, end)
+        else:
+            date = start
+        rows = self._bulk_circulation_event_rows(start_date, end_date)
+        return rows, date
 
-        subquery = self._db \
-            .query(WorkGenre.work_id, Genre.name) \
-            .join(Genre) \
-            .filter(WorkGenre.work_id.in_(work_ids)) \
-            .order_by(WorkGenre.affinity.desc()) \
-            .subquery()
-        genre_query = self._db \
-            .query(subquery.c.work_id, func.string_agg(subquery.c.name, ",")) \
-            .select_from(subquery) \
-            .group_by(subquery.c.work_id)
-        genres = dict(genre_query.all())
+    def _bulk_circulation_event_rows(self, start, end):
+        """Yield a CSV header row, then a row for every circulation event
+        between `start` (inclusive) and `end` (exclusive).
 
+        Events are loaded a chunk at a time, in order of start time,
+        so that a long export never has to hold every event in memory.
+        """
         header = [
             "time", "event", "identifier", "identifier_type", "title", "author",
             "fiction", "audience", "publisher", "language", "target_age", "genres"
         ]
+        yield header
 
-        def result_to_row(result):
+        def result_to_row(result, genres):
             (event, identifier, work, edition) = result
             return [
                 str(event.start) or "",
@@ -1975,7 +1997,59 @@ class DashboardController(AdminCirculationManagerController):
                 genres.get(work.id)
             ]
 
-        return [header] + map(result_to_row, results), date
+        chunk_size = self.BULK_CIRCULATION_EVENTS_CHUNK_SIZE
+        last_seen = None
+        while True:
+            query = self._db.query(
+                    CirculationEvent, Identifier, Work, Edition
+                ) \
+                .join(LicensePool, LicensePool.id == CirculationEvent.license_pool_id) \
+                .join(Identifier, Identifier.id == LicensePool.identifier_id) \
+                .join(Work, Work.id == LicensePool.work_id) \
+                .join(Edition, Edition.id == Work.presentation_edition_id) \
+                .filter(CirculationEvent.start >= start) \
+                .filter(CirculationEvent.start < end)
+            if last_seen:
+                # Pick up right after the last event in the previous chunk.
+                query = query.filter(
+                    tuple_(CirculationEvent.start, CirculationEvent.id)
+                    > tuple_(*last_seen)
+                )
+            query = query \
+                .order_by(CirculationEvent.start.asc(), CirculationEvent.id.asc()) \
+                .options(lazyload(Identifier.licensed_through)) \
+                .options(lazyload(Work.license_pools)) \
+                .limit(chunk_size)
+            results = query.all()
+            if not results:
+                break
+
+            genres = self._genres_for_works(
+                set(result[2].id for result in results)
+            )
+            for result in results:
+                yield result_to_row(result, genres)
+
+            if len(results) < chunk_size:
+                break
+            event = results[-1][0]
+            last_seen = (event.start, event.id)
+
+    def _genres_for_works(self, work_ids):
+        """Map work IDs to a comma-separated list of the works' genres,
+        in descending order of affinity.
+        """
+        subquery = self._db \
+            .query(WorkGenre.work_id, Genre.name) \
+            .join(Genre) \
+            .filter(WorkGenre.work_id.in_(work_ids)) \
+            .order_by(WorkGenre.affinity.desc()) \
+            .subquery()
+        genre_query = self._db \
+            .query(subquery.c.work_id, func.string_agg(subquery.c.name, ",")) \
+            .select_from(subquery) \
+            .group_by(subquery.c.work_id)
+        return dict(genre_query.all())
 
 class SettingsController(AdminCirculationManagerController):
 
@@ -2946,6 +3020,37 @@ class SettingsController(AdminCirculationManagerController):
             service_id, ExternalIntegration.PATRON_AUTH_GOAL
         )
 
+    def patron_auth_service_credential_cache(self, service_id):
+        """Report on the logins cached for a patron authentication
+        integration, or flush the cached logins for a single patron so
+        that their next request is checked with the ILS.
+        """
+        integration = get_one(
+            self._db, ExternalIntegration, id=service_id,
+            goal=ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        if not integration:
+            return MISSING_SERVICE
+        for library in integration.libraries:
+            self.require_library_manager(library)
+
+        if flask.request.method == "GET":
+            return dict(
+                stats=BasicAuthenticationProvider.credential_cache_stats(
+                    self._db, integration.id
+                )
+            )
+
+        identifier = flask.request.form.get("identifier")
+        if not identifier:
+            return NO_PATRON_IDENTIFIER
+        flushed = 0
+        for library in integration.libraries:
+            flushed += BasicAuthenticationProvider.flush_credential_cache(
+                self._db, library.id, identifier
+            )
+        return Response(unicode(flushed), 200)
+
     def sitewide_settings(self):
         return self._sitewide_settings_controller(Configuration)
 
@@ -0,0 +1,200 @@
+"""Gather the numbers shown on the admin dashboard.
+
+The numbers are calculated with a handful of GROUP BY queries that
+cover every collection and library at once. Since even those can be
+slow on a large site, they can also be saved to a snapshot table by
+bin/refresh_dashboard_stats and read back by the admin interface.
+"""
+from nose.tools import set_trace
+from datetime import datetime
+
+from sqlalchemy import (
+    and_,
+    case,
+    distinct,
+    func,
+    select,
+    union,
+)
+from sqlalchemy.sql.expression import join
+
+from core.model import (
+    Hold,
+    LicensePool,
+    Loan,
+    Patron,
+)
+
+from api.tables import dashboard_stats_table
+
+class DashboardStats(object):
+    """Per-collection inventory counts and per-library patron counts,
+    as of a certain time.
+    """
+
+    def __init__(self, as_of, collections, libraries):
+        """Constructor.
+
+        :param as_of: The time at which the numbers were calculated.
+        :param collections: A dictionary mapping collection IDs to
+            inventory counts.
+        :param libraries: A dictionary mapping library IDs to patron
+            counts.
+        """
+        self.as_of = as_of
+        self.collections = collections
+        self.libraries = libraries
+
+    EMPTY_COLLECTION = dict(
+        licensed_titles=0, open_access_titles=0, licenses=0,
+        available_licenses=0,
+    )
+
+    EMPTY_LIBRARY = dict(
+        total=0, with_active_loans=0, with_active_loans_or_holds=0,
+        loans=0, holds=0,
+    )
+
+    def for_collection(self, collection):
+        return dict(
+            self.collections.get(collection.id, self.EMPTY_COLLECTION)
+        )
+
+    def for_library(self, library):
+        return dict(self.libraries.get(library.id, self.EMPTY_LIBRARY))
+
+    @classmethod
+    def calculate(cls, _db):
+        """Calculate up-to-date numbers from the database."""
+        as_of = datetime.utcnow()
+        # Loan end dates are compared against the local time, as
+        # they have been since the dashboard was first written.
+        now = datetime.now()
+        return cls(
+            as_of, cls.collection_counts(_db),
+            cls.library_counts(_db, now)
+        )
+
+    @classmethod
+    def collection_counts(cls, _db):
+        """Count titles and licenses in every collection with one query."""
+        not_open_access = LicensePool.open_access == False
+        licensed = and_(LicensePool.licenses_owned > 0, not_open_access)
+        qu = _db.query(
+            LicensePool.collection_id,
+            func.sum(case([(licensed, 1)], else_=0)),
+            func.sum(case([(LicensePool.open_access == True, 1)], else_=0)),
+            func.sum(case([(not_open_access, LicensePool.licenses_owned)],
+                          else_=0)),
+            func.sum(case([(not_open_access, LicensePool.licenses_available)],
+                          else_=0)),
+        ).group_by(LicensePool.collection_id)
+
+        counts = {}
+        for (collection_id, licensed_titles, open_access_titles, licenses,
+             available_licenses) in qu:
+            counts[collection_id] = dict(
+                licensed_titles=int(licensed_titles or 0),
+                open_access_titles=int(open_access_titles or 0),
+                licenses=int(licenses or 0),
+                available_licenses=int(available_licenses or 0),
+            )
+        return counts
+
+    @classmethod
+    def library_counts(cls, _db, now):
+        """Count patrons, loans and holds for every library with four
+        queries.
+        """
+        counts = {}
+        def record(library_id, key, value):
+            if library_id not in counts:
+                counts[library_id] = dict(cls.EMPTY_LIBRARY)
+            counts[library_id][key] = int(value or 0)
+
+        qu = _db.query(
+            Patron.library_id, func.count(Patron.id)
+        ).group_by(Patron.library_id)
+        for library_id, patrons in qu:
+            record(library_id, 'total', patrons)
+
+        active_loan = Loan.end >= now
+        qu = _db.query(
+            Patron.library_id, func.count(distinct(Patron.id)),
+            func.count(Loan.id)
+        ).join(
+            Loan, Loan.patron_id==Patron.id
+        ).filter(active_loan).group_by(Patron.library_id)
+        for library_id, patrons, loans in qu:
+            record(library_id, 'with_active_loans', patrons)
+            record(library_id, 'loans', loans)
+
+        qu = _db.query(
+            Patron.library_id, func.count(Hold.id)
+        ).join(
+            Hold, Hold.patron_id==Patron.id
+        ).group_by(Patron.library_id)
+        for library_id, holds in qu:
+            record(library_id, 'holds', holds)
+
+        borrowers = select(
+            [Patron.library_id, Patron.id.label('patron_id')]
+        ).select_from(
+            join(Loan, Patron, Patron.id==Loan.patron_id)
+        ).where(active_loan)
+        holders = select(
+            [Patron.library_id, Patron.id.label('patron_id')]
+        ).select_from(
+            join(Hold, Patron, Patron.id==Hold.patron_id)
+        )
+        active = union(borrowers, holders).alias()
+        qu = select(
+            [active.c.library_id, func.count(distinct(active.c.patron_id))]
+        ).group_by(active.c.library_id)
+        for library_id, patrons in _db.execute(qu):
+            record(library_id, 'with_active_loans_or_holds', patrons)
+
+        return counts
+
+    def save(self, _db):
+        """Replace the current snapshot with these numbers."""
+        connection = _db.connection()
+        rows = []
+        for collection_id, data in self.collections.items():
+            rows.append(dict(
+                timestamp=self.as_of, collection_id=collection_id,
+                library_id=None, data=data
+            ))
+        for library_id, data in self.libraries.items():
+            rows.append(dict(
+                timestamp=self.as_of, collection_id=None,
+                library_id=library_id, data=data
+            ))
+        connection.execute(dashboard_stats_table.delete())
+        if rows:
+            connection.execute(dashboard_stats_table.insert(), rows)
+
+    @classmethod
+    def from_snapshot(cls, _db, max_age=None):
+        """Load the most recently saved snapshot.
+
+        :param max_age: A timedelta. If the snapshot is older than
+            this, it's ignored.
+        :return: A DashboardStats, or None if there's no usable
+            snapshot.
+        """
+        connection = _db.connection()
+        rows = connection.execute(select([dashboard_stats_table])).fetchall()
+        if not rows:
+            return None
+        as_of = min(row.timestamp for row in rows)
+        if max_age is not None and as_of < datetime.utcnow() - max_age:
+            return None
+        collections = {}
+        libraries = {}
+        for row in rows:
+            if row.collection_id is not None:
+                collections[row.collection_id] = row.data
+            elif row.library_id is not None:
+                libraries[row.library_id] = row.data
+        return cls(as_of, collections, libraries)
@@ -0,0 +1,67 @@
+"""Keep track of lanes whose sizes need to be recalculated.
+
+Recalculating a lane's size can be slow, so when a librarian changes
+the books in a custom list, the lanes based on that list are put in a
+queue instead, and bin/update_lane_sizes recalculates them later.
+"""
+from nose.tools import set_trace
+from datetime import datetime
+
+from sqlalchemy import (
+    and_,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+
+from core.model import get_one
+from core.lane import Lane
+
+from api.tables import stale_lane_sizes_table
+
+class LaneSizeQueue(object):
+    """A queue of lanes whose sizes are out of date."""
+
+    @classmethod
+    def add(cls, _db, lanes):
+        """Put some lanes in the queue."""
+        lane_ids = set(lane.id for lane in lanes)
+        if not lane_ids:
+            return
+        table = stale_lane_sizes_table
+        now = datetime.utcnow()
+
+        # A lane that's already in the queue stays there, but its
+        # timestamp is updated so that a run that's in progress
+        # doesn't remove it. Doing this with a single upsert means
+        # two librarians saving at once can't both try to insert the
+        # same lane.
+        qu = insert(table).values(
+            [dict(lane_id=lane_id, timestamp=now) for lane_id in lane_ids]
+        )
+        qu = qu.on_conflict_do_update(
+            index_elements=[table.c.lane_id],
+            set_=dict(timestamp=qu.excluded.timestamp)
+        )
+        _db.connection().execute(qu)
+
+    @classmethod
+    def process(cls, _db):
+        """Recalculate the size of every lane in the queue.
+
+        :return: The number of lanes whose sizes were recalculated.
+        """
+        table = stale_lane_sizes_table
+        connection = _db.connection()
+        updated = 0
+        for row in connection.execute(select([table])).fetchall():
+            lane = get_one(_db, Lane, id=row.lane_id)
+            if lane:
+                lane.update_size(_db)
+                updated += 1
+            connection.execute(
+                table.delete().where(
+                    and_(table.c.lane_id==row.lane_id,
+                         table.c.timestamp<=row.timestamp)
+                )
+            )
+        return updated
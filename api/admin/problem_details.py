@@ -407,3 +407,10 @@ COLLECTION_DOES_NOT_SUPPORT_REGISTRATION = pd(
     title=_("The collection does not support registration"),
     detail=_("The collection does not support registration."),
 )
+
+NO_PATRON_IDENTIFIER = pd(
+    "http://librarysimplified.org/terms/problem/no-patron-identifier",
+    status_code=400,
+    title=_("No patron identifier"),
+    detail=_("You must specify the identifier of the patron."),
+)
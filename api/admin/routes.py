@@ -4,7 +4,8 @@ import flask
 from flask import (
     Response,
     redirect,
-    make_response
+    make_response,
+    stream_with_context,
 )
 import os
 
@@ -268,8 +269,8 @@ def genres():
 @returns_problem_detail
 @requires_admin
 def bulk_circulation_events():
-    """Returns a CSV representation of all circulation events with optional
-    start and end times."""
+    """Streams a CSV representation of all circulation events with optional
+    start and end dates."""
     data, date = app.manager.admin_dashboard_controller.bulk_circulation_events()
     if isinstance(data, ProblemDetail):
         return data
@@ -304,12 +305,20 @@ def bulk_circulation_events():
             for row in rows:
                 self.writerow(row)
 
-    output = StringIO()
-    writer = UnicodeWriter(output)
-    writer.writerows(data)
-    response = make_response(output.getvalue())
+    def generate():
+        # Send the CSV a piece at a time rather than building the
+        # whole thing in memory.
+        output = StringIO()
+        writer = UnicodeWriter(output)
+        for row in data:
+            writer.writerow(row)
+            if output.tell() >= 64 * 1024:
+                yield output.getvalue()
+                output.truncate(0)
+        yield output.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype="text/csv")
     response.headers['Content-Disposition'] = "attachment; filename=circulation_events_" + date + ".csv"
-    response.headers["Content-type"] = "text/csv"
     return response
 
 @library_route('/admin/circulation_events')
@@ -326,6 +335,14 @@ def circulation_events():
 def stats():
     return app.manager.admin_dashboard_controller.stats()
 
+@app.route('/admin/patron_activity_latency')
+@returns_json_or_response_or_problem_detail
+@requires_admin
+def patron_activity_latency():
+    """Returns latency histograms for patron activity requests to
+    each distributor."""
+    return app.manager.admin_dashboard_controller.patron_activity_latency()
+
 @app.route('/admin/libraries', methods=['GET', 'POST'])
 @returns_json_or_response_or_problem_detail
 @requires_admin
@@ -404,6 +421,13 @@ def patron_auth_services():
 def patron_auth_service(service_id):
     return app.manager.admin_settings_controller.patron_auth_service(service_id)
 
+@app.route("/admin/patron_auth_service/<service_id>/credential_cache", methods=["GET", "POST"])
+@returns_json_or_response_or_problem_detail
+@requires_admin
+@requires_csrf_token
+def patron_auth_service_credential_cache(service_id):
+    return app.manager.admin_settings_controller.patron_auth_service_credential_cache(service_id)
+
 @app.route("/admin/metadata_services", methods=['GET', 'POST'])
 @returns_json_or_response_or_problem_detail
 @requires_admin
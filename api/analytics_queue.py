@@ -0,0 +1,274 @@
+"""Collect analytics events in the background, so that a patron
+borrowing a book doesn't have to wait while every analytics provider
+hears about it.
+"""
+from nose.tools import set_trace
+import atexit
+import datetime
+import logging
+import threading
+import time
+from Queue import (
+    Empty,
+    Full,
+    Queue,
+)
+
+from core.model import (
+    Library,
+    LicensePool,
+)
+
+
+class AnalyticsQueue(object):
+    """Stands in for an Analytics object.
+
+    collect_event() only puts the event in a queue. A background
+    thread takes events off the queue in batches, loads the libraries
+    and license pools they refer to in its own database session, and
+    passes them on to the analytics providers. The CirculationEvents
+    created by a batch are committed together.
+
+    A provider that defines collect_events() gets a whole batch at
+    once, as a list of (library, license_pool, event_type, time,
+    kwargs) tuples. Other providers get one collect_event() call per
+    event.
+    """
+
+    # What to do with an event when the queue is full.
+    DROP = "drop"       # Log a warning and forget the event.
+    INLINE = "inline"   # Handle the event right away, on the caller's thread.
+
+    MAX_SIZE = 10000
+    BATCH_SIZE = 100
+
+    # Once the first event in a batch arrives, wait this many seconds
+    # for others to join it.
+    LINGER = 0.5
+
+    # How often the background thread checks whether it's been told to
+    # stop.
+    POLL_INTERVAL = 1
+
+    # How long shutdown() waits for the background thread to finish
+    # the batch it's working on.
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, analytics, session_factory, max_size=None,
+                 batch_size=None, linger=None, overflow=DROP, start=True):
+        """Constructor.
+
+        :param analytics: The Analytics object that finds the
+            providers for each event.
+        :param session_factory: A function that creates a new database
+            session for the background thread.
+        :param overflow: DROP or INLINE.
+        :param start: If this is False, the background thread isn't
+            started, and events stay in the queue until flush() is
+            called.
+        """
+        self.analytics = analytics
+        self.session_factory = session_factory
+        self.batch_size = batch_size or self.BATCH_SIZE
+        if linger is None:
+            linger = self.LINGER
+        self.linger = linger
+        if overflow not in (self.DROP, self.INLINE):
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        self.overflow = overflow
+        self.queue = Queue(max_size or self.MAX_SIZE)
+        self.dropped = 0
+        self.log = logging.getLogger("Analytics queue")
+
+        # Only one batch is handled at a time, whether by the
+        # background thread or by flush().
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        if start:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="Analytics queue"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.shutdown)
+
+    def collect_event(self, library, license_pool, event_type, time=None,
+                      **kwargs):
+        """Queue an event for the analytics providers.
+
+        The arguments are the same as for Analytics.collect_event.
+        """
+        if not time:
+            time = datetime.datetime.utcnow()
+        if self.stopping.is_set():
+            # Nothing is going to take this event off the queue.
+            return self.handle_now(
+                library, license_pool, event_type, time, **kwargs
+            )
+
+        event = (
+            library.id if library else None,
+            license_pool.id if license_pool else None,
+            event_type, time, kwargs
+        )
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            if self.overflow == self.INLINE:
+                return self.handle_now(
+                    library, license_pool, event_type, time, **kwargs
+                )
+            self.dropped += 1
+            self.log.warn(
+                "Analytics queue is full; dropped %s event (%d dropped so far).",
+                event_type, self.dropped
+            )
+
+    def handle_now(self, library, license_pool, event_type, time, **kwargs):
+        """Send an event to the providers without queueing it."""
+        self.analytics.collect_event(
+            library, license_pool, event_type, time, **kwargs
+        )
+
+    def run(self):
+        """Handle batches of events until shutdown() is called."""
+        while not self.stopping.is_set():
+            batch = self.next_batch(self.POLL_INTERVAL)
+            if batch:
+                self.handle_batch(batch)
+
+    def next_batch(self, timeout, linger=None):
+        """Take up to `batch_size` events off the queue.
+
+        :param timeout: How long to wait for the first event.
+        :param linger: How long to wait for more events after that.
+            Defaults to the `linger` given to the constructor.
+        :return: A list of events, possibly empty.
+        """
+        if linger is None:
+            linger = self.linger
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        deadline = time.time() + linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Handle every event in the queue, on this thread.
+
+        :return: The number of events handled.
+        """
+        handled = 0
+        while True:
+            batch = self.next_batch(0, 0)
+            if not batch:
+                return handled
+            self.handle_batch(batch)
+            handled += len(batch)
+
+    def shutdown(self):
+        """Stop the background thread and handle whatever's left in the
+        queue.
+        """
+        self.stopping.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(self.SHUTDOWN_TIMEOUT)
+        handled = self.flush()
+        if handled:
+            self.log.info("Handled %d analytics events on shutdown.", handled)
+
+    def handle_batch(self, batch):
+        """Handle a batch of events in a new database session."""
+        with self.lock:
+            _db = self.session_factory()
+            try:
+                self.process_batch(_db, batch)
+                _db.commit()
+            except Exception, e:
+                self.log.error(
+                    "Could not handle %d analytics events.", len(batch),
+                    exc_info=e
+                )
+                _db.rollback()
+            finally:
+                _db.close()
+
+    def process_batch(self, _db, batch):
+        """Send a batch of events to the analytics providers.
+
+        :param batch: A list of events as they were queued, with IDs
+            in place of libraries and license pools.
+        """
+        libraries = self._load(_db, Library, [x[0] for x in batch])
+        pools = self._load(_db, LicensePool, [x[1] for x in batch])
+
+        # The same Analytics object is used for the whole batch, even
+        # if the site configuration is reloaded in the meantime.
+        analytics = self.analytics
+        events_by_provider = {}
+        providers = []
+        for library_id, pool_id, event_type, time, kwargs in batch:
+            library = libraries.get(library_id)
+            event = (library, pools.get(pool_id), event_type, time, kwargs)
+            for provider in self.providers_for(analytics, library):
+                if id(provider) not in events_by_provider:
+                    events_by_provider[id(provider)] = []
+                    providers.append(provider)
+                events_by_provider[id(provider)].append(event)
+
+        for provider in providers:
+            events = events_by_provider[id(provider)]
+            try:
+                if hasattr(provider, 'collect_events'):
+                    provider.collect_events(events)
+                else:
+                    for library, pool, event_type, time, kwargs in events:
+                        provider.collect_event(
+                            library, pool, event_type, time, **kwargs
+                        )
+            except Exception, e:
+                # One broken provider shouldn't keep the others from
+                # hearing about these events.
+                self.log.error(
+                    "Analytics provider %r could not handle %d events.",
+                    provider, len(events), exc_info=e
+                )
+
+    def providers_for(self, analytics, library):
+        """Find the providers that should hear about an event in the
+        given library.
+        """
+        if not hasattr(analytics, 'sitewide_providers'):
+            # This isn't an Analytics object, but something that
+            # collects events itself.
+            return [analytics]
+        providers = list(analytics.sitewide_providers)
+        if library:
+            providers.extend(analytics.library_providers.get(library.id, []))
+        return providers
+
+    def _load(self, _db, cls, ids):
+        """Load the objects with the given IDs in a single query.
+
+        :return: A dictionary mapping IDs to objects.
+        """
+        ids = set(x for x in ids if x is not None)
+        if not ids:
+            return {}
+        return dict(
+            (x.id, x) for x in _db.query(cls).filter(cls.id.in_(ids))
+        )
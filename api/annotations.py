@@ -1,12 +1,22 @@
 from nose.tools import set_trace
 from pyld import jsonld
 import json
-from datetime import datetime
+from datetime import (
+    datetime,
+    timedelta,
+)
 import os
 
+from sqlalchemy import (
+    func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+
 from core.model import (
     Annotation,
     Identifier,
+    Session,
     get_one_or_create,
 )
 
@@ -15,6 +25,7 @@ from core.app_server import (
 )
 
 from problem_details import *
+from tables import compacted_annotations_table
 
 def load_document(url):
     """Retrieves JSON-LD for the given URL from a local
@@ -46,82 +57,307 @@ class AnnotationWriter(object):
     JSONLD_CONTEXT = "http://www.w3.org/ns/anno.jsonld"
     LDP_CONTEXT = "http://www.w3.org/ns/ldp.jsonld"
 
+    # The number of annotations on each page of a container.
+    PAGE_SIZE = 100
+
+    # A sync token is the time of the latest change the client has
+    # seen, in this format.
+    SYNC_TOKEN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    # An annotation is timestamped when it's written, but nobody else
+    # can see the change until its transaction commits, possibly after
+    # a client has synced a change with a later timestamp. So each sync
+    # looks this far back before the time in its token. The token also
+    # lists the changes in that window the client already has, so they
+    # aren't sent again.
+    SYNC_OVERLAP = timedelta(minutes=5)
+
     @classmethod
-    def annotations_for(cls, patron, identifier=None):
-        annotations = [annotation for annotation in patron.annotations if annotation.active]
+    def annotations_query(cls, patron, identifier=None):
+        """Find a patron's active annotations, optionally only the ones
+        for a particular book.
+        """
+        _db = Session.object_session(patron)
+        qu = _db.query(Annotation).filter(
+            Annotation.patron_id==patron.id
+        ).filter(
+            Annotation.active==True
+        )
         if identifier:
-            annotations = [annotation for annotation in annotations if annotation.identifier == identifier]
-        return annotations
+            qu = qu.filter(Annotation.identifier_id==identifier.id)
+        return qu
 
     @classmethod
-    def annotation_container_for(cls, patron, identifier=None):
+    def annotations_for(cls, patron, identifier=None):
+        return cls.ordered(cls.annotations_query(patron, identifier)).all()
+
+    @classmethod
+    def ordered(cls, qu):
+        """Put the most recent annotations first."""
+        return qu.order_by(
+            Annotation.timestamp.desc().nullslast(), Annotation.id.desc()
+        )
+
+    @classmethod
+    def url_for(cls, patron, identifier=None, **kwargs):
+        """Find the URL to a patron's annotation container, or to one of
+        its pages.
+        """
         if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
+            return url_for('annotations_for_work',
+                           identifier_type=identifier.type,
+                           identifier=identifier.identifier,
+                           library_short_name=patron.library.short_name,
+                           _external=True, **kwargs)
+        return url_for("annotations",
+                       library_short_name=patron.library.short_name,
+                       _external=True, **kwargs)
 
-        latest_timestamp = None
-        if len(annotations) > 0:
-            # patron.annotations is already sorted by timestamp, so the first
-            # annotation is the most recent.
-            latest_timestamp = annotations[0].timestamp
+    @classmethod
+    def summary(cls, patron, identifier=None):
+        """Count a patron's active annotations and find when the most
+        recent one was made, in a single query.
+
+        :return: A 2-tuple (total, latest timestamp).
+        """
+        return cls.annotations_query(patron, identifier).with_entities(
+            func.count(Annotation.id), func.max(Annotation.timestamp)
+        ).one()
+
+    @classmethod
+    def annotation_container_for(cls, patron, identifier=None, page_size=None):
+        page_size = page_size or cls.PAGE_SIZE
+        url = cls.url_for(patron, identifier)
+        total, latest_timestamp = cls.summary(patron, identifier)
 
         container = dict()
         container["@context"] = [cls.JSONLD_CONTEXT, cls.LDP_CONTEXT]
         container["id"] = url
         container["type"] = ["BasicContainer", "AnnotationCollection"]
-        container["total"] = len(annotations)
-        container["first"] = cls.annotation_page_for(patron, identifier=identifier, with_context=False)
+        container["total"] = total
+        container["syncToken"] = cls.sync_token(latest_timestamp)
+        container["first"] = cls.annotation_page_for(
+            patron, identifier=identifier, with_context=False,
+            page_size=page_size, total=total
+        )
+        if total > page_size:
+            container["last"] = cls.url_for(
+                patron, identifier, page=(total - 1) / page_size
+            )
         return container, latest_timestamp
-        
 
     @classmethod
-    def annotation_page_for(cls, patron, identifier=None, with_context=True):
+    def annotation_page_for(cls, patron, identifier=None, with_context=True,
+                            page=0, page_size=None, total=None):
+        """Describe one page of a patron's annotations.
+
+        :param page: The number of the page, starting from zero.
+        :param total: The total number of annotations in the
+            container, if it's already known.
+        """
+        page_size = page_size or cls.PAGE_SIZE
+        qu = cls.annotations_query(patron, identifier=identifier)
+        if total is None:
+            total = qu.count()
+        offset = page * page_size
+        annotations = cls.ordered(qu).offset(offset).limit(page_size).all()
+        compacted = cls.compacted_for(
+            Session.object_session(patron), [x.id for x in annotations]
+        )
+        details = [
+            cls.detail(annotation, with_context=with_context,
+                       compacted=compacted.get(annotation.id))
+            for annotation in annotations
+        ]
+
+        page_dict = dict()
+        if with_context:
+            page_dict["@context"] = cls.JSONLD_CONTEXT
+        page_dict["id"] = cls.url_for(patron, identifier, page=page)
+        page_dict["type"] = "AnnotationPage"
+        page_dict["partOf"] = cls.url_for(patron, identifier)
+        page_dict["startIndex"] = offset
+        if offset + page_size < total:
+            page_dict["next"] = cls.url_for(patron, identifier, page=page + 1)
+        if page > 0:
+            page_dict["prev"] = cls.url_for(patron, identifier, page=page - 1)
+        page_dict["items"] = details
+        return page_dict
+
+    @classmethod
+    def sync_token(cls, timestamp, seen=()):
+        """Turn the time of the latest change into a sync token.
+
+        :param seen: (annotation ID, timestamp) 2-tuples for the
+            changes the client knows about. The ones within
+            SYNC_OVERLAP of `timestamp` are listed in the token.
+        """
+        if not timestamp:
+            return None
+        token = timestamp.strftime(cls.SYNC_TOKEN_FORMAT)
+        window = []
+        for annotation_id, changed in sorted(seen):
+            age = timestamp - changed
+            if timedelta(0) <= age < cls.SYNC_OVERLAP:
+                microseconds = (
+                    (age.days * 86400 + age.seconds) * 1000000
+                    + age.microseconds
+                )
+                window.append("%d:%d" % (annotation_id, microseconds))
+        if window:
+            token += "~" + ",".join(window)
+        return token
+
+    @classmethod
+    def parse_sync_token(cls, token):
+        """Turn a sync token back into a time and the changes the
+        client had already seen around that time.
+
+        :return: A 2-tuple (datetime, set of (annotation ID, timestamp)
+            2-tuples), or None if the token is invalid.
+        """
+        time_part, ignore, seen_part = (token or "").partition("~")
+        timestamp = None
+        for format in (cls.SYNC_TOKEN_FORMAT, "%Y-%m-%dT%H:%M:%S"):
+            try:
+                timestamp = datetime.strptime(time_part, format)
+                break
+            except ValueError:
+                continue
+        if not timestamp:
+            return None
+        seen = set()
+        for item in seen_part.split(","):
+            if not item:
+                continue
+            try:
+                annotation_id, microseconds = [int(x) for x in item.split(":")]
+            except ValueError:
+                return None
+            seen.add(
+                (annotation_id,
+                 timestamp - timedelta(microseconds=microseconds))
+            )
+        return timestamp, seen
+
+    @classmethod
+    def changes_since(cls, patron, since, identifier=None, seen=None):
+        """Describe the changes to a patron's annotations since a client
+        last synced them.
+
+        :param since: The time of the latest change the client knows
+            about.
+        :param seen: (annotation ID, timestamp) 2-tuples for the
+            changes the client already has from shortly before `since`,
+            as parsed from its sync token.
+        :return: A 2-tuple (page, latest timestamp). The page lists
+            the annotations that were created or updated since then,
+            and the IDs of the ones that were deleted. Its sync token
+            should be passed back in the next time.
+        """
+        seen = seen or set()
+        _db = Session.object_session(patron)
+        qu = _db.query(Annotation).filter(
+            Annotation.patron_id==patron.id
+        ).filter(
+            Annotation.timestamp > since - cls.SYNC_OVERLAP
+        )
         if identifier:
-            url = url_for('annotations_for_work',
-                          identifier_type=identifier.type,
-                          identifier=identifier.identifier,
-                          library_short_name=patron.library.short_name,
-                          _external=True)
-        else:
-            url = url_for("annotations", library_short_name=patron.library.short_name, _external=True)
-        annotations = cls.annotations_for(patron, identifier=identifier)
-        details = [cls.detail(annotation, with_context=with_context) for annotation in annotations]
+            qu = qu.filter(Annotation.identifier_id==identifier.id)
+        recent = qu.order_by(Annotation.timestamp, Annotation.id).all()
+
+        # Anything in the overlap window that isn't in the token was
+        # committed after the client's last sync.
+        changed = [x for x in recent if (x.id, x.timestamp) not in seen]
+        active = [x for x in changed if x.active]
+        deleted = [x for x in changed if not x.active]
+        compacted = cls.compacted_for(_db, [x.id for x in active])
+        latest_timestamp = max([since] + [x.timestamp for x in recent])
 
         page = dict()
-        if with_context:
-            page["@context"] = cls.JSONLD_CONTEXT
-        page["id"] = url
+        page["@context"] = cls.JSONLD_CONTEXT
+        page["id"] = cls.url_for(
+            patron, identifier, since=cls.sync_token(since, seen)
+        )
         page["type"] = "AnnotationPage"
-        page["items"] = details
-        return page
+        page["partOf"] = cls.url_for(patron, identifier)
+        page["items"] = [
+            cls.detail(annotation, with_context=False,
+                       compacted=compacted.get(annotation.id))
+            for annotation in active
+        ]
+        page["deleted"] = [cls.detail_url(x) for x in deleted]
+        page["syncToken"] = cls.sync_token(
+            latest_timestamp, [(x.id, x.timestamp) for x in recent]
+        )
+        return page, latest_timestamp
+
+    @classmethod
+    def compacted_for(cls, _db, annotation_ids):
+        """Look up the stored compacted target and body for some
+        annotations.
+
+        :return: A dictionary mapping annotation IDs to 2-tuples
+            (target, body), either of which may be None.
+        """
+        if not annotation_ids:
+            return {}
+        table = compacted_annotations_table
+        rows = _db.connection().execute(
+            select([table]).where(table.c.annotation_id.in_(annotation_ids))
+        )
+        return dict(
+            (row.annotation_id, (row.target, row.body)) for row in rows
+        )
 
     @classmethod
-    def detail(cls, annotation, with_context=True):
+    def compact(cls, value):
+        """Compact a JSON-LD document that was stored in expanded form."""
+        compacted = jsonld.compact(json.loads(value), cls.JSONLD_CONTEXT)
+        del compacted["@context"]
+        return compacted
+
+    @classmethod
+    def detail_url(cls, annotation):
+        return url_for("annotation_detail", annotation_id=annotation.id,
+                       library_short_name=annotation.patron.library.short_name,
+                       _external=True)
+
+    @classmethod
+    def detail(cls, annotation, with_context=True, compacted=None):
+        """Describe an annotation.
+
+        :param compacted: The annotation's stored compacted target and
+            body, if they've already been looked up.
+        """
+        if compacted is None:
+            _db = Session.object_session(annotation)
+            compacted = cls.compacted_for(_db, [annotation.id]).get(
+                annotation.id
+            )
+        target = body = None
+        if compacted:
+            target, body = compacted
+
         item = dict()
         if with_context:
             item["@context"] = cls.JSONLD_CONTEXT
-        item["id"] = url_for("annotation_detail", annotation_id=annotation.id,
-                             library_short_name=annotation.patron.library.short_name,
-                             _external=True)
+        item["id"] = cls.detail_url(annotation)
         item["type"] = "Annotation"
         item["motivation"] = annotation.motivation
         item["body"] = annotation.content
         if annotation.target:
-            target = json.loads(annotation.target)
-            compacted = jsonld.compact(target, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["target"] = compacted
+            if target:
+                item["target"] = json.loads(target)
+            else:
+                # This annotation was written before compacted
+                # targets were stored.
+                item["target"] = cls.compact(annotation.target)
         if annotation.content:
-            body = json.loads(annotation.content)
-            compacted = jsonld.compact(body, cls.JSONLD_CONTEXT)
-            del compacted["@context"]
-            item["body"] = compacted
+            if body:
+                item["body"] = json.loads(body)
+            else:
+                item["body"] = cls.compact(annotation.content)
 
         return item
 
@@ -192,6 +428,41 @@ class AnnotationParser(object):
         if content:
             annotation.content = json.dumps(content)
         annotation.active = True
-        annotation.timestamp = datetime.now()
+        annotation.timestamp = datetime.utcnow()
+        cls.store_compacted(_db, annotation)
 
         return annotation
+
+    @classmethod
+    def store_compacted(cls, _db, annotation):
+        """Compact the annotation's target and body now, so that
+        reading the annotation later is just a matter of serializing
+        them.
+        """
+        target = body = None
+        if annotation.target:
+            target = unicode(json.dumps(
+                AnnotationWriter.compact(annotation.target)
+            ))
+        if annotation.content:
+            body = unicode(json.dumps(
+                AnnotationWriter.compact(annotation.content)
+            ))
+        qu = insert(compacted_annotations_table).values(
+            annotation_id=annotation.id, target=target, body=body
+        )
+        qu = qu.on_conflict_do_update(
+            index_elements=[compacted_annotations_table.c.annotation_id],
+            set_=dict(target=qu.excluded.target, body=qu.excluded.body)
+        )
+        _db.connection().execute(qu)
+
+    @classmethod
+    def forget_compacted(cls, _db, annotation):
+        """Remove the stored compacted target and body of an annotation
+        that's been deleted.
+        """
+        table = compacted_annotations_table
+        _db.connection().execute(
+            table.delete().where(table.c.annotation_id==annotation.id)
+        )
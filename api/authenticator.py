@@ -32,12 +32,21 @@ from core.util.http import RemoteIntegrationException
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import or_
+from sqlalchemy import (
+    func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
 from problem_details import *
+from tables import credential_cache_table
 from util.patron import PatronUtility
+from circulation import PatronActivityCache
 from api.opds import LibraryAnnotator
 from api.custom_patron_catalog import CustomPatronCatalog
 
 import datetime
+import hashlib
+import hmac
 import logging
 from money import Money
 import os
@@ -1195,7 +1204,8 @@ class AuthenticationProvider(OPDSAuthenticationFlow):
         patron = self.authenticate(_db, header)
         if not isinstance(patron, Patron):
             return patron
-        if PatronUtility.needs_external_sync(patron):
+        activity_cache = PatronActivityCache.from_configuration(_db)
+        if PatronUtility.needs_external_sync(patron, activity_cache):
             self.update_patron_metadata(patron)
         return patron
 
@@ -1374,6 +1384,12 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
     IDENTIFIER_MAXIMUM_LENGTH = u"identifier_maximum_length"
     PASSWORD_MAXIMUM_LENGTH = u"password_maximum_length"
     
+    # Configuration settings that control how long the results of
+    # checking credentials with the ILS are trusted.
+    CREDENTIAL_CACHE_TTL = u'credential_cache_ttl'
+    FAILED_LOGIN_CACHE_TTL = u'failed_login_cache_ttl'
+    DEFAULT_FAILED_LOGIN_CACHE_TTL = 5
+
     # The client should use a certain string when asking for a patron's
     # "identifier" and "password"
     IDENTIFIER_LABEL = u'identifier_label'
@@ -1478,13 +1494,43 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
           "label": _("Label for password entry"),
           "optional": True,
         },
+        { "key": CREDENTIAL_CACHE_TTL,
+          "label": _("Number of seconds to trust a successful login"),
+          "description": _("If this is set, a patron who logs in successfully won't have their credentials checked with the ILS again for this many seconds."),
+          "type": "number",
+          "optional": True,
+        },
+        { "key": FAILED_LOGIN_CACHE_TTL,
+          "label": _("Number of seconds to remember a failed login"),
+          "description": _("Only used if successful logins are being trusted. Repeated attempts with the same incorrect credentials won't be checked with the ILS for this many seconds."),
+          "type": "number",
+          "default": DEFAULT_FAILED_LOGIN_CACHE_TTL,
+          "optional": True,
+        },
     ] + AuthenticationProvider.SETTINGS
     
     # Used in the constructor to signify that the default argument
     # value for the class should be used (as distinct from None, which
     # indicates that no value should be used.)
     class_default = object()
-    
+
+    # Credentials that passed a check with the source of truth are
+    # kept in the credentialcache table, keyed by an HMAC of the
+    # library, username and password made with the site's secret key,
+    # so that we don't have to ask the ILS about them again for a
+    # while. Every process sees the same cache, so flushing a patron's
+    # logins takes effect everywhere at once.
+    #
+    # Each entry is listed under the patron's authorization
+    # identifier, so it can be flushed without knowing the patron's
+    # password. Failed logins are listed under the username that was
+    # typed in.
+
+    # Every so often, when caching a login, we take the opportunity to
+    # delete expired entries.
+    CREDENTIAL_CACHE_PURGE_EVERY = 1000
+    _credential_cache_writes = 0
+
     def __init__(self, library, integration, analytics=None):
         """Create a BasicAuthenticationProvider.
 
@@ -1543,6 +1589,14 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             or self.DEFAULT_PASSWORD_LABEL
         )
 
+        self.credential_cache_ttl = integration.setting(
+            self.CREDENTIAL_CACHE_TTL).int_value
+        failed_login_cache_ttl = integration.setting(
+            self.FAILED_LOGIN_CACHE_TTL).int_value
+        if failed_login_cache_ttl is None:
+            failed_login_cache_ttl = self.DEFAULT_FAILED_LOGIN_CACHE_TTL
+        self.failed_login_cache_ttl = failed_login_cache_ttl
+
     @property
     def collects_password(self):
         """Does this BasicAuthenticationProvider expect a username
@@ -1620,6 +1674,52 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
             # need to be checked with the source of truth.
             return server_side_validation_result
 
+        if not self.credential_cache_ttl:
+            return self.authenticate_with_source_of_truth(
+                _db, username, password
+            )
+
+        # We may have checked these credentials with the source of
+        # truth recently enough that we don't need to do it again.
+        cache_key = self.credential_cache_key(_db, username, password)
+        cached = self._cached_login(_db, cache_key)
+        if cached and cached.failed:
+            self._count_credential_cache_hit(_db, cache_key)
+            return None
+        if cached:
+            patrondata = PatronData(complete=False, **cached.patron_data)
+            patron = self.local_patron_lookup(_db, username, patrondata)
+            if patron:
+                self._count_credential_cache_hit(_db, cache_key)
+                return patron
+
+        patron = self.authenticate_with_source_of_truth(
+            _db, username, password
+        )
+        if isinstance(patron, Patron):
+            # Remember only what we need to find the Patron again.
+            patron_data = dict(
+                permanent_id=patron.external_identifier,
+                authorization_identifier=patron.authorization_identifier,
+                username=patron.username,
+            )
+            self._cache_credentials(
+                _db, patron.authorization_identifier or username,
+                cache_key, patron_data, self.credential_cache_ttl
+            )
+        elif not patron and self.failed_login_cache_ttl:
+            self._cache_credentials(
+                _db, username, cache_key, None, self.failed_login_cache_ttl
+            )
+        return patron
+
+    def authenticate_with_source_of_truth(self, _db, username, password):
+        """Check a username and password with the source of truth and
+        turn them into a Patron object.
+
+        :return: A Patron if one can be authenticated; a ProblemDetail
+        if an error occurs; None if the credentials are wrong.
+        """
         # Check these credentials with the source of truth.
         patrondata = self.remote_authenticate(username, password)
         if not patrondata or isinstance(patrondata, ProblemDetail):
@@ -1688,6 +1788,124 @@ class BasicAuthenticationProvider(AuthenticationProvider, HasSelfTests):
         self.apply_patrondata(patrondata, patron)
         return patron
 
+    def credential_cache_key(self, _db, username, password):
+        """Turn a set of credentials into a key for the credential
+        cache.
+        """
+        secret = ConfigurationSetting.sitewide_secret(
+            _db, Configuration.SECRET_KEY
+        )
+        credentials = json.dumps([self.library_id, username, password])
+        return unicode(hmac.new(
+            secret.encode("utf8"), credentials, hashlib.sha256
+        ).hexdigest())
+
+    @classmethod
+    def _cached_login(cls, _db, cache_key):
+        """Find the unexpired cache entry for some credentials.
+
+        :return: A row from the credentialcache table, or None.
+        """
+        table = credential_cache_table
+        return _db.connection().execute(
+            select([table]).where(
+                table.c.key==cache_key
+            ).where(
+                table.c.expires > datetime.datetime.utcnow()
+            )
+        ).first()
+
+    def _cache_credentials(self, _db, identifier, cache_key, patron_data,
+                           ttl):
+        """Cache the result of checking some credentials, and list it
+        under `identifier`.
+
+        :param patron_data: A dictionary of PatronData fields that
+            find the patron again, or None if the login failed.
+        """
+        now = datetime.datetime.utcnow()
+        table = credential_cache_table
+        qu = insert(table).values(
+            key=cache_key, integration_id=self.external_integration_id,
+            library_id=self.library_id, identifier=identifier,
+            failed=patron_data is None, patron_data=patron_data,
+            expires=now + datetime.timedelta(seconds=ttl), hits=0,
+        )
+        qu = qu.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_=dict(
+                identifier=qu.excluded.identifier, failed=qu.excluded.failed,
+                patron_data=qu.excluded.patron_data,
+                expires=qu.excluded.expires, hits=0,
+            )
+        )
+        connection = _db.connection()
+        connection.execute(qu)
+
+        BasicAuthenticationProvider._credential_cache_writes += 1
+        writes = BasicAuthenticationProvider._credential_cache_writes
+        if writes % self.CREDENTIAL_CACHE_PURGE_EVERY == 0:
+            connection.execute(table.delete().where(table.c.expires <= now))
+
+    @classmethod
+    def _count_credential_cache_hit(cls, _db, cache_key):
+        table = credential_cache_table
+        _db.connection().execute(
+            table.update().where(table.c.key==cache_key).values(
+                hits=table.c.hits + 1
+            )
+        )
+
+    @classmethod
+    def credential_cache_stats(cls, _db, integration_id):
+        """Describe the logins currently cached for an integration.
+
+        :return: A dictionary with the number of cached logins and
+            failed logins, and the number of requests each kind has
+            answered without asking the source of truth.
+        """
+        table = credential_cache_table
+        rows = _db.connection().execute(
+            select([
+                table.c.failed, func.count(table.c.key),
+                func.coalesce(func.sum(table.c.hits), 0)
+            ]).where(
+                table.c.integration_id==integration_id
+            ).where(
+                table.c.expires > datetime.datetime.utcnow()
+            ).group_by(table.c.failed)
+        )
+        stats = dict(logins=0, failed_logins=0, hits=0, negative_hits=0)
+        for failed, entries, hits in rows:
+            if failed:
+                stats['failed_logins'] = entries
+                stats['negative_hits'] = int(hits)
+            else:
+                stats['logins'] = entries
+                stats['hits'] = int(hits)
+        return stats
+
+    @classmethod
+    def flush_credential_cache(cls, _db, library_id, identifier):
+        """Forget every cached login for a patron, in every process,
+        so that their next request is checked with the source of
+        truth.
+
+        :param identifier: The patron's authorization identifier. This
+            finds their cached logins whatever username they typed in.
+        :return: The number of unexpired cache entries removed.
+        """
+        table = credential_cache_table
+        now = datetime.datetime.utcnow()
+        removed = _db.connection().execute(
+            table.delete().where(
+                table.c.library_id==library_id
+            ).where(
+                table.c.identifier==identifier
+            ).returning(table.c.expires)
+        )
+        return len([x for x in removed if x.expires > now])
+
     def apply_patrondata(self, patrondata, patron):
         """Apply a PatronData object to the given patron and make sure
         any fields that need to be updated as a result of new data
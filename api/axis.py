@@ -57,6 +57,11 @@ from circulation import (
     BaseCirculationAPI
 )
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
+from util.xmlparser import (
+    IncrementalXMLParser,
+    response_body,
+)
 from selftest import (
     HasSelfTests,
     SelfTestResult,
@@ -98,6 +103,17 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI, HasSelfTests
     def external_integration(self, _db):
         return self.collection.external_integration
 
+    def _make_request(self, url, method, headers, data=None, params=None,
+                      **kwargs):
+        # Don't read the body of a GET response into memory up front;
+        # availability responses can be large enough that they're
+        # better parsed as they arrive. See response_body.
+        if method.upper() == 'GET':
+            kwargs.setdefault('stream', True)
+        return super(Axis360API, self)._make_request(
+            url, method, headers, data=data, params=params, **kwargs
+        )
+
     def _run_self_tests(self, _db):
         result = self.run_test(
             "Refreshing bearer token", self.refresh_bearer_token
@@ -221,8 +237,8 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI, HasSelfTests
         availability = self.availability(
             patron_id=patron.authorization_identifier, 
             title_ids=title_ids)
-        return list(AvailabilityResponseParser(self.collection).process_all(
-            availability.content))
+        return list(AvailabilityResponseParser(self.collection).process_stream(
+            response_body(availability)))
 
     def update_availability(self, licensepool):
         """Update the availability information for a single LicensePool.
@@ -261,8 +277,8 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI, HasSelfTests
         """
         identifier_strings = self.create_identifier_strings(identifiers)
         response = self.availability(title_ids=identifier_strings)
-        parser = BibliographicParser(self.collection)
-        return parser.process_all(response.content)
+        parser = StreamingBibliographicParser(self.collection)
+        return parser.process_stream(response_body(response))
 
     def _reap(self, identifier):
         """Update our local circulation information to reflect the fact that
@@ -301,9 +317,9 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI, HasSelfTests
         :yield: A sequence of (Metadata, CirculationData) 2-tuples
         """
         availability = self.availability(since=since)
-        content = availability.content
-        for bibliographic, circulation in BibliographicParser(self.collection).process_all(
-                content):
+        parser = StreamingBibliographicParser(self.collection)
+        source = response_body(availability)
+        for bibliographic, circulation in parser.process_stream(source):
             yield bibliographic, circulation
 
 
@@ -322,6 +338,7 @@ class Axis360CirculationMonitor(CollectionMonitor):
 
     def __init__(self, _db, collection, api_class=Axis360API):
         super(Axis360CirculationMonitor, self).__init__(_db, collection)
+        ChangedWorkQueue.watch(_db)
         if isinstance(api_class, Axis360API):
             # Use a preexisting Axis360API instance rather than
             # creating a new one.
@@ -402,6 +419,17 @@ class AxisCollectionReaper(IdentifierSweepMonitor):
         self.api.update_licensepools_for_identifiers(identifiers)
 
 
+class StreamingBibliographicParser(IncrementalXMLParser, BibliographicParser):
+    """A BibliographicParser that handles each title as soon as it's
+    been read, rather than after the whole document has been parsed.
+    """
+
+    def process_stream(self, source):
+        return self.process_incrementally(
+            source, "{%s}title" % self.NS['axis'], self.NS
+        )
+
+
 class ResponseParser(Axis360Parser):
 
     id_type = Identifier.AXIS_360_ID
@@ -597,7 +625,7 @@ class HoldReleaseResponseParser(ResponseParser):
             e, namespaces, {3109 : NotOnHold})
         return True
 
-class AvailabilityResponseParser(ResponseParser):
+class AvailabilityResponseParser(IncrementalXMLParser, ResponseParser):
    
     def process_all(self, string):
         for info in super(AvailabilityResponseParser, self).process_all(
@@ -607,6 +635,14 @@ class AvailabilityResponseParser(ResponseParser):
             if info:
                 yield info
 
+    def process_stream(self, source):
+        """Like process_all, but handle each title as soon as it's been
+        read.
+        """
+        return self.process_incrementally(
+            source, "{%s}title" % self.NS['axis'], self.NS
+        )
+
     def process_one(self, e, ns):
 
         # Figure out which book we're talking about.
@@ -7,6 +7,7 @@ import datetime
 import os
 import re
 import logging
+from multiprocessing.pool import ThreadPool
 from flask_babel import lazy_gettext as _
 
 from nose.tools import set_trace
@@ -48,6 +49,10 @@ from core.monitor import (
 )
 from core.util.web_publication_manifest import AudiobookManifest
 from core.util.xmlparser import XMLParser
+from util.xmlparser import (
+    IncrementalXMLParser,
+    response_body,
+)
 from core.util.http import (
     BadResponseException
 )
@@ -58,6 +63,7 @@ from core.bibliotheca import (
 )
 
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
 from core.analytics import Analytics
 
 class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI, HasSelfTests):
@@ -95,6 +101,16 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI, HasSelfTests):
     def external_integration(self, _db):
         return self.collection.external_integration
 
+    def _request_with_timeout(self, method, url, *args, **kwargs):
+        # Don't read the body of a GET response into memory up front;
+        # some of them are large enough that they're better parsed
+        # as they arrive. See response_body.
+        if method.upper() == 'GET':
+            kwargs.setdefault('stream', True)
+        return super(BibliothecaAPI, self)._request_with_timeout(
+            method, url, *args, **kwargs
+        )
+
     def _run_self_tests(self, _db):
         def _count_events():
             now = datetime.datetime.utcnow()
@@ -133,10 +149,10 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI, HasSelfTests):
         if cache_result:
             self._db.commit()
         try:
-            events = EventParser().process_all(response.content)
+            events = EventParser().process_stream(response_body(response))
         except Exception, e:
             self.log.error(
-                "Error parsing Bibliotheca response content: %s", response.content,
+                "Error parsing Bibliotheca response from %s", url,
                 exc_info=e
             )
             raise e
@@ -154,7 +170,7 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI, HasSelfTests):
     def get_circulation_for(self, identifiers):
         """Return circulation objects for the selected identifiers."""
         response = self.circulation_request(identifiers)
-        for circ in CirculationParser().process_all(response.content):
+        for circ in CirculationParser().process_stream(response_body(response)):
             if circ:
                 yield circ
 
@@ -173,7 +189,9 @@ class BibliothecaAPI(BaseBibliothecaAPI, BaseCirculationAPI, HasSelfTests):
     def patron_activity(self, patron, pin):
         response = self._patron_activity_request(patron)
         collection = self.collection
-        return PatronCirculationParser(self.collection).process_all(response.content)
+        return PatronCirculationParser(self.collection).process_stream(
+            response_body(response)
+        )
 
     TEMPLATE = "<%(request_type)s><ItemId>%(item_id)s</ItemId><PatronId>%(patron_id)s</PatronId></%(request_type)s>"
 
@@ -456,7 +474,7 @@ class MockBibliothecaAPI(BaseMockBibliothecaAPI, BibliothecaAPI):
     pass
 
 
-class BibliothecaParser(XMLParser):
+class BibliothecaParser(IncrementalXMLParser, XMLParser):
 
     INPUT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
@@ -497,6 +515,12 @@ class CirculationParser(BibliothecaParser):
                 string, "//ItemCirculation"):
             yield i
 
+    def process_stream(self, source):
+        """Like process_all, but handle each item as soon as it's been
+        read.
+        """
+        return self.process_incrementally(source, "ItemCirculation")
+
     def process_one(self, tag, namespaces):
         if not tag.xpath("ItemId"):
             # This happens for events associated with books
@@ -677,6 +701,24 @@ class PatronCirculationParser(BibliothecaParser):
         everything = itertools.chain(loans, holds, reserves)
         return [x for x in everything if x]
 
+    def process_stream(self, source):
+        """Like process_all, but handle each item as soon as it's been
+        read.
+        """
+        handlers = dict(
+            Checkouts=self.process_one_loan,
+            Holds=self.process_one_hold,
+            Reserves=self.process_one_reserve,
+        )
+        def handler(tag, namespaces):
+            parent = tag.getparent()
+            if parent is None or parent.tag not in handlers:
+                return None
+            return handlers[parent.tag](tag, namespaces)
+        return list(
+            self.process_incrementally(source, "Item", handler=handler)
+        )
+
     def process_one_loan(self, tag, namespaces):
         return self.process_one(tag, namespaces, LoanInfo)
 
@@ -767,6 +809,12 @@ class EventParser(BibliothecaParser):
                 string, "//CloudLibraryEvent"):
             yield i
 
+    def process_stream(self, source):
+        """Like process_all, but handle each event as soon as it's been
+        read.
+        """
+        return self.process_incrementally(source, "CloudLibraryEvent")
+
     def process_one(self, tag, namespaces):
         isbn = self.text_of_subtag(tag, "ISBN")
         bibliotheca_id = self.text_of_subtag(tag, "ItemId")
@@ -908,10 +956,20 @@ class BibliothecaEventMonitor(CollectionMonitor):
     DEFAULT_START_TIME = datetime.timedelta(365*3)
     PROTOCOL = ExternalIntegration.BIBLIOTHECA
 
+    # The number of day slices whose events are fetched at once. If
+    # this is more than one, the slices are fetched in worker threads,
+    # but their events are still handled in order in the main thread.
+    WORKERS = 1
+
+    # The number of events to handle before committing.
+    BATCH_SIZE = 1000
+
     def __init__(self, _db, collection, api_class=BibliothecaAPI, 
-                 cli_date=None, analytics=None):
+                 cli_date=None, analytics=None, workers=None):
         self.analytics = analytics or Analytics(_db)
         super(BibliothecaEventMonitor, self).__init__(_db, collection)
+        self.workers = workers or self.WORKERS
+        ChangedWorkQueue.watch(_db)
         if isinstance(api_class, BibliothecaAPI):
             # We were given an actual API object. Just use it.
             self.api = api_class
@@ -971,39 +1029,98 @@ class BibliothecaEventMonitor(CollectionMonitor):
             yield slice_start, slice_cutoff, full_slice
             slice_start = slice_start + increment
 
+    def fetch_slice(self, timespan):
+        """Get the events in one slice of time.
+
+        This may be called from a worker thread.
+
+        :return: A 2-tuple (timespan, list of events).
+        """
+        start, cutoff, full_slice = timespan
+        self.log.info("Asking for events between %r and %r", start, cutoff)
+        # Responses are cached in the database, which worker threads
+        # can't use.
+        cache_result = full_slice and self.workers <= 1
+        events = self.api.get_events_between(start, cutoff, cache_result)
+        return timespan, list(events)
+
+    def fetched_slices(self, start, cutoff, pool=None):
+        """Fetch the events for every day between `start` and `cutoff`,
+        a few days at a time if there's a pool of workers.
+
+        :yield: A 2-tuple (timespan, list of events) for each day, in
+            order.
+        """
+        one_day = datetime.timedelta(days=1)
+        timespans = self.slice_timespan(start, cutoff, one_day)
+        if not pool:
+            for timespan in timespans:
+                yield self.fetch_slice(timespan)
+            return
+
+        # Only submit as many slices as there are workers, so a long
+        # backfill doesn't pile up years of events in memory.
+        while True:
+            window = list(itertools.islice(timespans, self.workers))
+            if not window:
+                break
+            for result in pool.imap(self.fetch_slice, window):
+                yield result
+
     def run_once(self, start, cutoff):
-        added_books = 0
+        pool = None
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+        try:
+            return self.handle_slices(start, cutoff, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def handle_slices(self, start, cutoff, pool=None):
+        """Handle the events between `start` and `cutoff`, one day at a
+        time.
+
+        Once all of a day's events have been handled, the monitor's
+        timestamp is moved forward and committed, so if a long backfill
+        is interrupted, the next run picks up where it left off.
+        """
         i = 0
-        one_day = datetime.timedelta(days=1)
         most_recent_timestamp = start
-        for start, cutoff, full_slice in self.slice_timespan(
-                start, cutoff, one_day):
-            most_recent_timestamp = start
-            self.log.info("Asking for events between %r and %r", start, cutoff)
+        slices = self.fetched_slices(start, cutoff, pool)
+        while True:
+            event = None
+            try:
+                (slice_start, slice_cutoff, full_slice), events = next(slices)
+            except StopIteration:
+                break
+            except Exception, e:
+                self.log.error(
+                    "Fatal error getting list of Bibliotheca events.",
+                    exc_info=e
+                )
+                raise e
+
+            most_recent_timestamp = slice_start
             try:
-                event = None
-                events = self.api.get_events_between(start, cutoff, full_slice)
                 for event in events:
                     event_timestamp = self.handle_event(*event)
                     if (not most_recent_timestamp or
                         (event_timestamp > most_recent_timestamp)):
                         most_recent_timestamp = event_timestamp
                     i += 1
-                    if not i % 1000:
+                    if not i % self.BATCH_SIZE:
                         self._db.commit()
-                self._db.commit()
             except Exception, e:
-                if event:
-                    self.log.error(
-                        "Fatal error processing Bibliotheca event %r.", event,
-                        exc_info=e
-                    )
-                else:
-                    self.log.error(
-                        "Fatal error getting list of Bibliotheca events.",
-                        exc_info=e
-                    )
+                self.log.error(
+                    "Fatal error processing Bibliotheca event %r.", event,
+                    exc_info=e
+                )
                 raise e
+
+            self.timestamp().timestamp = most_recent_timestamp
+            self._db.commit()
         self.log.info("Handled %d events total", i)
         return most_recent_timestamp
 
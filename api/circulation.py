@@ -1,13 +1,22 @@
 from nose.tools import set_trace
 from circulation_exceptions import *
+import copy
 import datetime
 from collections import defaultdict
-from threading import Thread
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 import flask
 import logging
 import re
 import time
 from flask_babel import lazy_gettext as _
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+)
 
 from core.config import CannotLoadConfiguration
 from core.cdn import cdnify
@@ -26,9 +35,14 @@ from core.model import (
     LicensePool,
     Loan,
     Hold,
+    Patron,
     RightsStatus,
     Session,
 )
+from util.cache import (
+    LRUCache,
+    SQLiteCache,
+)
 from util.patron import PatronUtility
 from config import Configuration
 
@@ -56,6 +70,13 @@ class CirculationInfo(object):
         self.identifier_type = identifier_type
         self.identifier = identifier
 
+    @property
+    def pool_key(self):
+        """A key that uniquely identifies this object's LicensePool
+        without going to the database.
+        """
+        return (self.collection_id, self.identifier_type, self.identifier)
+
     def collection(self, _db):
         """Find the Collection to which this object belongs."""
         return Collection.by_id(_db, self.collection_id)
@@ -278,13 +299,286 @@ class HoldInfo(CirculationInfo):
         )
 
 
+class LatencyHistogram(object):
+    """A thread-safe histogram of call latencies, in seconds.
+
+    This is cheap enough to update on every call, and its snapshot()
+    is suitable for handing to a monitoring system.
+    """
+
+    # The upper bounds of the histogram buckets, in seconds. Anything
+    # slower than the last bound goes into the overflow bucket.
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.timeouts = 0
+        self.lock = Lock()
+
+    def record(self, seconds):
+        """Record that a call took the given number of seconds."""
+        with self.lock:
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    index = i
+                    break
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def record_timeout(self):
+        """Record that a caller gave up waiting on a call."""
+        with self.lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        """Return the current state of the histogram as a dictionary.
+
+        Bucket counts are cumulative, in the style of Prometheus.
+        """
+        with self.lock:
+            buckets = []
+            running = 0
+            for bound, count in zip(self.buckets, self.counts):
+                running += count
+                buckets.append((bound, running))
+            buckets.append(("+Inf", self.count))
+            return dict(
+                buckets=buckets, count=self.count, sum=self.total,
+                timeouts=self.timeouts,
+            )
+
+
+class PatronActivityExecutor(object):
+    """A process-wide, bounded pool of threads for asking remote APIs
+    about patron activity.
+
+    Creating a new thread for every API on every call to
+    CirculationAPI.patron_activity gets expensive under load, so all
+    CirculationAPIs in a process share this pool.
+
+    Each call runs in its own database session, with its own copy of
+    the API object. A call that the caller stopped waiting for can
+    keep running without touching the caller's session.
+    """
+
+    # The maximum number of patron activity requests that may be
+    # in flight at once, across all libraries.
+    POOL_SIZE = 20
+
+    # The maximum number of those requests that may go to any one API
+    # class. A vendor that stops responding can tie up this many of
+    # the pool's threads, but the other vendors still get the rest.
+    MAX_CALLS_PER_API = 5
+
+    # Returned by a call whose patron can't be seen from a new
+    # session, because the patron hasn't been committed yet.
+    PATRON_NOT_COMMITTED = object()
+
+    _pool = None
+    _lock = Lock()
+
+    # Latency histograms, keyed by the name of the API class.
+    latency = {}
+
+    # The number of calls in flight, keyed by the name of the API class.
+    in_flight = {}
+
+    @classmethod
+    def pool(cls):
+        """Find or create the shared thread pool."""
+        with cls._lock:
+            if cls._pool is None:
+                cls._pool = ThreadPool(cls.POOL_SIZE)
+            return cls._pool
+
+    @classmethod
+    def histogram(cls, api_name):
+        """Find or create the latency histogram for the given API class."""
+        with cls._lock:
+            if api_name not in cls.latency:
+                cls.latency[api_name] = LatencyHistogram()
+            return cls.latency[api_name]
+
+    @classmethod
+    def submit(cls, api, patron, pin, bind):
+        """Ask `api` for a patron's activity in a pool thread.
+
+        :param bind: The engine (or connection) to use for the call's
+            own database session.
+        :return: A multiprocessing AsyncResult, or None if too many
+            calls to this API are already in flight.
+        """
+        api_name = api.__class__.__name__
+        histogram = cls.histogram(api_name)
+        with cls._lock:
+            if cls.in_flight.get(api_name, 0) >= cls.MAX_CALLS_PER_API:
+                return None
+            cls.in_flight[api_name] = cls.in_flight.get(api_name, 0) + 1
+        patron_id = patron.id
+        def run():
+            before = time.time()
+            _db = Session(bind=bind)
+            try:
+                patron = _db.query(Patron).get(patron_id)
+                if patron is None:
+                    return cls.PATRON_NOT_COMMITTED
+                call_api = copy.copy(api)
+                call_api._db = _db
+                # Some APIs implement patron_activity as a generator;
+                # make sure the work actually happens in this thread.
+                activity = list(call_api.patron_activity(patron, pin))
+
+                # Keep anything the API saved along the way, such as
+                # a new access token.
+                _db.commit()
+                return activity
+            except Exception:
+                _db.rollback()
+                raise
+            finally:
+                _db.close()
+                histogram.record(time.time() - before)
+                with cls._lock:
+                    cls.in_flight[api_name] = max(
+                        0, cls.in_flight.get(api_name, 0) - 1
+                    )
+        return cls.pool().apply_async(run)
+
+    @classmethod
+    def latency_report(cls):
+        """Summarize patron activity latency for every API class
+        that has been used in this process.
+        """
+        with cls._lock:
+            histograms = cls.latency.items()
+        return dict(
+            (name, histogram.snapshot()) for name, histogram in histograms
+        )
+
+    @classmethod
+    def reset(cls):
+        """Shut down the pool and forget all latency information.
+
+        This is mainly useful in tests.
+        """
+        with cls._lock:
+            if cls._pool is not None:
+                cls._pool.terminate()
+            cls._pool = None
+            cls.latency = {}
+            cls.in_flight = {}
+
+
+class PatronActivityCache(object):
+    """A short-lived cache of the LoanInfo and HoldInfo objects that
+    each Collection reports for a patron.
+
+    Entries are removed whenever the patron does something through
+    the circulation manager that changes their loans or holds.
+    """
+
+    # Cache backends shared by every CirculationAPI in this process,
+    # keyed by the path to the shared store (or None for an
+    # in-process cache).
+    _backends = {}
+    _lock = Lock()
+
+    def __init__(self, backend, ttl, shared=False):
+        """Constructor.
+
+        :param backend: An object that implements the interface of
+            api.util.cache.LRUCache.
+        :param ttl: The number of seconds to keep an entry.
+        :param shared: Is `backend` shared by every process on the
+            server? If not, a loan made through one process won't
+            remove the patron's entries from another process's cache.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.shared = shared
+        self.log = logging.getLogger("Patron activity cache")
+
+    @classmethod
+    def from_configuration(cls, _db):
+        """Create a PatronActivityCache according to the site-wide
+        configuration.
+
+        :return: A PatronActivityCache, or None if caching of patron
+            activity is not enabled.
+        """
+        ttl = ConfigurationSetting.sitewide(
+            _db, Configuration.PATRON_ACTIVITY_CACHE_TTL
+        ).int_value
+        if not ttl:
+            return None
+        path = ConfigurationSetting.sitewide(
+            _db, Configuration.PATRON_ACTIVITY_CACHE_PATH
+        ).value or None
+        with cls._lock:
+            backend = cls._backends.get(path)
+            if backend is None:
+                if path:
+                    backend = SQLiteCache(path)
+                else:
+                    backend = LRUCache()
+                cls._backends[path] = backend
+        return cls(backend, ttl, shared=bool(path))
+
+    def key(self, patron, collection_id):
+        return ("patron-activity", patron.id, collection_id)
+
+    def get(self, patron, collection_id):
+        """Look up a patron's cached activity in a Collection.
+
+        :return: A list of LoanInfo and HoldInfo objects, or None if
+            nothing is cached.
+        """
+        return self.backend.get(self.key(patron, collection_id))
+
+    def set(self, patron, collection_id, activity):
+        """Cache a patron's activity in a Collection."""
+        try:
+            self.backend.set(
+                self.key(patron, collection_id), list(activity), self.ttl
+            )
+        except Exception, e:
+            # The activity couldn't be stored; we'll just have to ask
+            # the remote again next time.
+            self.log.warn(
+                "Could not cache activity for patron %s: %s", patron.id, e
+            )
+
+    def invalidate(self, patron, collection_id):
+        """Forget a patron's cached activity in a Collection."""
+        self.backend.delete(self.key(patron, collection_id))
+        self.backend.delete(self.key(patron, None))
+
+    def mark_fresh(self, patron):
+        """Note that we just heard from every remote about this patron's
+        activity.
+        """
+        self.backend.set(self.key(patron, None), True, self.ttl)
+
+    def is_fresh(self, patron):
+        """Have we heard from every remote about this patron's activity
+        within the last `ttl` seconds, with no changes since then?
+        """
+        return bool(self.backend.get(self.key(patron, None)))
+
+
 class CirculationAPI(object):
     """Implement basic circulation logic and abstract away the details
     between different circulation APIs behind generic operations like
     'borrow'.
     """
 
-    def __init__(self, _db, library, analytics=None, api_map=None):
+    def __init__(self, _db, library, analytics=None, api_map=None,
+                 activity_cache=None):
         """Constructor.
 
         :param _db: A database session (probably a scoped session, which is
@@ -304,10 +598,16 @@ class CirculationAPI(object):
            Since instantiating these API classes may result in API
            calls, we only instantiate one CirculationAPI per library,
            and keep them around as long as possible.
+
+        :param activity_cache: A PatronActivityCache. By default, one
+           is created if the site-wide configuration calls for it.
         """
         self._db = _db
         self.library_id = library.id
         self.analytics = analytics
+        if activity_cache is None:
+            activity_cache = PatronActivityCache.from_configuration(_db)
+        self.activity_cache = activity_cache
         self.initialization_exceptions = dict()
         api_map = api_map or self.default_api_map
 
@@ -321,6 +621,9 @@ class CirculationAPI(object):
         # from any other Collections.
         self.collection_ids_for_sync = []
 
+        # How long patron_activity waits for each Collection's API.
+        self.patron_activity_timeouts = {}
+
         self.log = logging.getLogger("Circulation API")
         for collection in library.collections:
             if collection.protocol in api_map:
@@ -336,6 +639,24 @@ class CirculationAPI(object):
                 if api:
                     self.api_for_collection[collection.id] = api
                     self.collection_ids_for_sync.append(collection.id)
+                    self.patron_activity_timeouts[collection.id] = (
+                        self.patron_activity_timeout(collection, api)
+                    )
+
+    def patron_activity_timeout(self, collection, api):
+        """How long to wait for `api` to report on a patron's loans
+        and holds in `collection`.
+
+        This is the collection's patron activity timeout setting, if
+        it has one, and the API class's default otherwise.
+        """
+        setting = collection.external_integration.setting(
+            BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT_KEY
+        )
+        return setting.int_value or getattr(
+            api, 'PATRON_ACTIVITY_TIMEOUT',
+            BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT
+        )
 
     @property
     def library(self):
@@ -528,6 +849,9 @@ class CirculationAPI(object):
                 api.update_availability(licensepool)
                 raise e
 
+            # The patron's loans may have changed.
+            self.invalidate_activity(patron, licensepool)
+
         if loan_info:
             # We successfuly secured a loan.  Now create it in our
             # database.
@@ -583,6 +907,9 @@ class CirculationAPI(object):
                 else:
                     raise e
 
+            # The patron's holds may have changed.
+            self.invalidate_activity(patron, licensepool)
+
         # It's pretty rare that we'd go from having a loan for a book
         # to needing to put it on hold, but we do check for that case.
         __transaction = self._db.begin_nested()
@@ -690,6 +1017,8 @@ class CirculationAPI(object):
             fulfillment = api.fulfill(
                 patron, pin, licensepool, internal_format
             )
+            # Fulfilling a loan may lock it to a delivery mechanism.
+            self.invalidate_activity(patron, licensepool)
             if not fulfillment or not (
                     fulfillment.content_link or fulfillment.content
             ):
@@ -774,6 +1103,7 @@ class CirculationAPI(object):
                     # The book wasn't checked out in the first
                     # place. Everything's fine.
                     pass
+                self.invalidate_activity(patron, licensepool)
 
             __transaction = self._db.begin_nested()
             logging.info("In revoke_loan(), deleting loan #%d" % loan.id)
@@ -807,6 +1137,7 @@ class CirculationAPI(object):
                 # The book wasn't on hold in the first place. Everything's
                 # fine.
                 pass
+            self.invalidate_activity(patron, licensepool)
         # Any other CannotReleaseHold exception will be propagated
         # upwards at this point
         if hold:
@@ -829,74 +1160,116 @@ class CirculationAPI(object):
         """Return a record of the patron's current activity
         vis-a-vis all relevant external loan sources.
 
-        We check each source in a separate thread for speed.
+        We check each source in a shared pool of threads for speed.
+        If a source doesn't respond within its patron activity
+        timeout, we stop waiting for it and report the results as
+        incomplete.
 
-        :return: A 2-tuple (loans, holds) containing `HoldInfo` and
-        `LoanInfo` objects.
+        :return: A 3-tuple (loans, holds, complete) containing
+        `LoanInfo` objects, `HoldInfo` objects, and a boolean
+        indicating whether every source was heard from.
         """
-        log = self.log
-        class PatronActivityThread(Thread):
-            def __init__(self, api, patron, pin):
-                self.api = api
-                self.patron = patron
-                self.pin = pin
-                self.activity = None
-                self.exception = None
-                super(PatronActivityThread, self).__init__()
-
-            def run(self):
-                before = time.time()
-                try:
-                    self.activity = self.api.patron_activity(
-                        self.patron, self.pin)
-                except Exception, e:
-                    self.exception = e
-                after = time.time()
-                log.debug(
-                    "Synced %s in %.2f sec", self.api.__class__.__name__,
-                    after-before
-                )
-
-        threads = []
         before = time.time()
-        for api in self.api_for_collection.values():
-            thread = PatronActivityThread(api, patron, pin)
-            threads.append(thread)
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+        pending = []
+        cached = []
         loans = []
         holds = []
         complete = True
-        for thread in threads:
-            if thread.exception:
+        bind = self._db.get_bind()
+        for collection_id, api in self.api_for_collection.items():
+            activity = None
+            if self.activity_cache:
+                activity = self.activity_cache.get(patron, collection_id)
+            if activity is not None:
+                cached.extend(activity)
+                continue
+            result = PatronActivityExecutor.submit(api, patron, pin, bind)
+            if result is None:
+                # This API already has as many calls in flight as it's
+                # allowed, probably because it's not responding.
+                complete = False
+                self.log.error(
+                    "Too many calls to %s in progress; not asking it about this patron.",
+                    api.__class__.__name__
+                )
+                continue
+            pending.append((collection_id, api, result))
+
+        if cached and not self.activity_cache.shared:
+            # This process's cache may not have heard about a loan
+            # made through another process, so these results can't
+            # be used to decide which local loans and holds to delete.
+            complete = False
+        self._sort_activity(cached, loans, holds)
+        for collection_id, api, result in pending:
+            api_name = api.__class__.__name__
+            timeout = self.patron_activity_timeouts.get(collection_id)
+            if timeout is None:
+                timeout = getattr(
+                    api, 'PATRON_ACTIVITY_TIMEOUT',
+                    BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT
+                )
+            remaining = max(0, before + timeout - time.time())
+            activity = None
+            try:
+                activity = result.get(remaining)
+                if activity is PatronActivityExecutor.PATRON_NOT_COMMITTED:
+                    # The patron was created during this request, so
+                    # only this session can see them. Ask the API on
+                    # this thread instead.
+                    activity = list(api.patron_activity(patron, pin))
+            except TimeoutError, e:
+                # The source is taking too long. Don't hold up the
+                # other sources on its account, but we no longer have
+                # a complete picture of the patron's loans.
+                complete = False
+                PatronActivityExecutor.histogram(api_name).record_timeout()
+                self.log.error(
+                    "%s did not respond within %.2f sec", api_name, timeout
+                )
+            except Exception, e:
                 # Something went wrong, so we don't have a complete
                 # picture of the patron's loans.
                 complete = False
                 self.log.error(
-                    "%s errored out: %s", thread.api.__class__.__name__,
-                    thread.exception,
-                    exc_info=thread.exception
+                    "%s errored out: %s", api_name, e, exc_info=e
                 )
-            if thread.activity:
-                for i in thread.activity:
-                    l = None
-                    if isinstance(i, LoanInfo):
-                        l = loans
-                    elif isinstance(i, HoldInfo):
-                        l = holds
-                    else:
-                        self.log.warn(
-                            "value %r from patron_activity is neither a loan nor a hold.", 
-                            i
-                        )
-                    if l is not None:
-                        l.append(i)
+            if activity is not None:
+                if self.activity_cache:
+                    self.activity_cache.set(patron, collection_id, activity)
+                self._sort_activity(activity, loans, holds)
+        if complete and not cached and self.activity_cache:
+            # Every remote was just asked, not the cache.
+            self.activity_cache.mark_fresh(patron)
         after = time.time()
         self.log.debug("Full sync took %.2f sec", after-before)
         return loans, holds, complete
 
+    def _sort_activity(self, activity, loans, holds):
+        """Sort the results of BaseCirculationAPI.patron_activity into
+        a list of loans and a list of holds.
+        """
+        for i in activity:
+            l = None
+            if isinstance(i, LoanInfo):
+                l = loans
+            elif isinstance(i, HoldInfo):
+                l = holds
+            else:
+                self.log.warn(
+                    "value %r from patron_activity is neither a loan nor a hold.", 
+                    i
+                )
+            if l is not None:
+                l.append(i)
+
+    def invalidate_activity(self, patron, licensepool):
+        """Our cached view of the patron's activity in the given
+        LicensePool's Collection is no longer accurate.
+        """
+        if self.activity_cache and patron and licensepool:
+            self.activity_cache.invalidate(patron, licensepool.collection_id)
+
     def local_loans(self, patron):
         return self._db.query(Loan).join(Loan.license_pool).filter(
             LicensePool.collection_id.in_(self.collection_ids_for_sync)
@@ -911,15 +1284,55 @@ class CirculationAPI(object):
             Hold.patron==patron
         )
 
+    def license_pools_for(self, infos):
+        """Find the LicensePools for a number of CirculationInfo objects
+        with a single query.
+
+        :param infos: A list of CirculationInfo objects.
+        :return: A dictionary mapping each CirculationInfo's pool_key
+            to its LicensePool.
+        """
+        keys = set(info.pool_key for info in infos)
+        pools = {}
+        if keys:
+            qu = self._db.query(LicensePool).join(
+                LicensePool.identifier
+            ).options(
+                contains_eager(LicensePool.identifier)
+            ).filter(
+                tuple_(
+                    LicensePool.collection_id, Identifier.type,
+                    Identifier.identifier
+                ).in_(list(keys))
+            )
+            for pool in qu:
+                i = pool.identifier
+                pools[(pool.collection_id, i.type, i.identifier)] = pool
+
+        # Any LicensePools we didn't find need to be created, which
+        # is rare enough that we can do it one at a time.
+        for info in infos:
+            if info.pool_key not in pools:
+                pools[info.pool_key] = info.license_pool(self._db)
+        return pools
+
     def sync_bookshelf(self, patron, pin):
 
         # Get the external view of the patron's current state.
         remote_loans, remote_holds, complete = self.patron_activity(patron, pin)
 
+        # Look up all the relevant LicensePools at once, rather than
+        # one query per remote loan or hold.
+        pools = self.license_pools_for(remote_loans + remote_holds)
+
         # Get our internal view of the patron's current state.
         __transaction = self._db.begin_nested()
-        local_loans = self.local_loans(patron)
-        local_holds = self.local_holds(patron)
+        local_loans = self.local_loans(patron).options(
+            joinedload(Loan.license_pool).joinedload(LicensePool.identifier)
+        )
+        local_holds = self.local_holds(patron).options(
+            joinedload(Hold.license_pool).joinedload(LicensePool.identifier)
+        )
 
         now = datetime.datetime.utcnow()
         local_loans_by_identifier = {}
@@ -951,29 +1364,45 @@ class CirculationAPI(object):
             key = (i.type, i.identifier)
             local_holds_by_identifier[key] = h
 
-        active_loans = []
-        active_holds = []
+        # Compare the remote loans to the local loans. Local loans
+        # that need to be updated are updated in place; loans that
+        # don't exist locally are gathered up so they can all be
+        # created at once.
+        loans = []
+        loans_to_create = {}
+        seen = set()
         for loan in remote_loans:
-            # This is a remote loan. Find or create the corresponding
-            # local loan.
-            pool = loan.license_pool(self._db)
+            pool = pools[loan.pool_key]
             start = loan.start_date
             end = loan.end_date
             key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
-                # We already have the Loan object, we don't need to look
-                # it up again.
-                local_loan = local_loans_by_identifier[key]
-
-                # But maybe the remote's opinions as to the loan's
-                # start or end date have changed.
+            local_loan = local_loans_by_identifier.get(key)
+            if local_loan:
+                # We already have the Loan object, but maybe the
+                # remote's opinions as to the loan's start or end date
+                # have changed.
                 if start:
                     local_loan.start = start
                 if end:
                     local_loan.end = end
-            else:
-                local_loan, new = pool.loan_to(patron, start, end)
+            elif pool.id not in loans_to_create:
+                loans_to_create[pool.id] = dict(
+                    patron_id=patron.id, license_pool_id=pool.id,
+                    start=start or now, end=end
+                )
+            loans.append((loan, pool, local_loan))
+            seen.add(key)
+
+        # Check the local loans we found off the list we're keeping
+        # so we don't delete them later.
+        for key in seen:
+            local_loans_by_identifier.pop(key, None)
 
+        new_loans = self._bulk_create(Loan, 'loans', patron, loans_to_create)
+        active_loans = []
+        for loan, pool, local_loan in loans:
+            if not local_loan:
+                local_loan = new_loans[pool.id]
             if loan.locked_to:
                 # The loan source is letting us know that the loan is
                 # locked to a specific delivery mechanism. Even if
@@ -983,36 +1412,41 @@ class CirculationAPI(object):
                 loan.locked_to.apply(local_loan, autocommit=False)
             active_loans.append(local_loan)
 
-            # Check the local loan off the list we're keeping so we
-            # don't delete it later.
-            key = (loan.identifier_type, loan.identifier)
-            if key in local_loans_by_identifier:
-                del local_loans_by_identifier[key]
-
+        # Now do the same for holds.
+        holds = []
+        holds_to_create = {}
+        seen = set()
         for hold in remote_holds:
-            # This is a remote hold. Find or create the corresponding
-            # local hold.
-            pool = hold.license_pool(self._db)
+            pool = pools[hold.pool_key]
             start = hold.start_date
             end = hold.end_date
             position = hold.hold_position
             key = (hold.identifier_type, hold.identifier)
-            if key in local_holds_by_identifier:
-                # We already have the Hold object, we don't need to look
-                # it up again.
-                local_hold = local_holds_by_identifier[key]
-
-                # But maybe the remote's opinions as to the hold's
-                # start or end date have changed.
+            local_hold = local_holds_by_identifier.get(key)
+            if local_hold:
+                # We already have the Hold object, but maybe the
+                # remote's opinions as to the hold's start or end date
+                # have changed.
                 local_hold.update(start, end, position)
-            else:
+            elif not patron.library.allow_holds:
+                # LicensePool.on_hold_to knows how to enforce the
+                # library's hold policy.
                 local_hold, new = pool.on_hold_to(patron, start, end, position)
-            active_holds.append(local_hold)
+            elif pool.id not in holds_to_create:
+                holds_to_create[pool.id] = dict(
+                    patron_id=patron.id, license_pool_id=pool.id,
+                    start=start or now, end=end, position=position
+                )
+            holds.append((pool, local_hold))
+            seen.add(key)
 
-            # Check the local hold off the list we're keeping so that
-            # we don't delete it later.
-            if key in local_holds_by_identifier:
-                del local_holds_by_identifier[key]
+        for key in seen:
+            local_holds_by_identifier.pop(key, None)
+
+        new_holds = self._bulk_create(Hold, 'holds', patron, holds_to_create)
+        active_holds = []
+        for pool, local_hold in holds:
+            active_holds.append(local_hold or new_holds[pool.id])
 
         # We only want to delete local loans and holds if we were able to
         # successfully sync with all the providers. If there was an error,
@@ -1025,25 +1459,72 @@ class CirculationAPI(object):
             # borrowing a book and syncing their bookshelf at the same time,
             # and the local loan was created after we got the remote loans.
             # If the loan's start date is less than a minute ago, we'll keep it.
+            one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+            doomed_loans = []
             for loan in local_loans_by_identifier.values():
                 if loan.license_pool.collection_id in self.collection_ids_for_sync:
-                    one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
                     if loan.start < one_minute_ago:
                         logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
-                        self._db.delete(loan)
+                        doomed_loans.append(loan.id)
                     else:
                         logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
+            self._bulk_delete(Loan, 'loans', patron, doomed_loans)
 
             # Every hold remaining in holds_by_identifier is a hold that
             # the provider doesn't know about, which means it's expired
             # and we should get rid of it.
-            for hold in local_holds_by_identifier.values():
-                if hold.license_pool.collection_id in self.collection_ids_for_sync:
-                    self._db.delete(hold)
+            doomed_holds = [
+                hold.id for hold in local_holds_by_identifier.values()
+                if hold.license_pool.collection_id in self.collection_ids_for_sync
+            ]
+            self._bulk_delete(Hold, 'holds', patron, doomed_holds)
 
         __transaction.commit()
         return active_loans, active_holds
 
+    def _bulk_create(self, model, relationship, patron, rows):
+        """Create a number of Loans or Holds for a patron with a
+        single INSERT statement.
+
+        :param model: Loan or Hold.
+        :param relationship: The name of the Patron and LicensePool
+            relationship that holds `model` objects.
+        :param rows: A dictionary mapping LicensePool IDs to
+            dictionaries of column values.
+        :return: A dictionary mapping LicensePool IDs to the objects.
+            If the patron borrowed or reserved one of the books while
+            we were syncing, this is the object that was created for
+            that, and our row isn't inserted.
+        """
+        if not rows:
+            return {}
+        self._db.execute(
+            insert(model.__table__).on_conflict_do_nothing(), rows.values()
+        )
+        created = self._db.query(model).filter(
+            model.patron_id==patron.id
+        ).filter(
+            model.license_pool_id.in_(rows.keys())
+        ).all()
+
+        # The ORM didn't see these objects being created, so any
+        # collections that should contain them are now out of date.
+        self._db.expire(patron, [relationship])
+        for x in created:
+            self._db.expire(x.license_pool, [relationship])
+        return dict((x.license_pool_id, x) for x in created)
+
+    def _bulk_delete(self, model, relationship, patron, ids):
+        """Delete a number of a patron's Loans or Holds with a single
+        DELETE statement.
+        """
+        if not ids:
+            return
+        self._db.query(model).filter(model.id.in_(ids)).delete(
+            synchronize_session='fetch'
+        )
+        self._db.expire(patron, [relationship])
+
 
 class BaseCirculationAPI(object):
     """Encapsulates logic common to all circulation APIs."""
@@ -1081,9 +1562,23 @@ class BaseCirculationAPI(object):
         "description": _("Until it hears otherwise from the distributor, this server will assume that any given loan for this library from this collection will last this number of days. This number is usually a negotiated value between the library and the distributor. This only affects estimates&mdash;it cannot affect the actual length of loans.")
     }
 
+    PATRON_ACTIVITY_TIMEOUT_KEY = "patron_activity_timeout"
+
+    # Lets an admin say how long to wait for a collection's
+    # distributor to report on a patron's loans and holds. It's part
+    # of SETTINGS below, so every circulation API that adds
+    # BaseCirculationAPI.SETTINGS to its own settings offers it.
+    PATRON_ACTIVITY_TIMEOUT_SETTING = {
+        "key": PATRON_ACTIVITY_TIMEOUT_KEY,
+        "label": _("Patron activity timeout (in seconds)"),
+        "type": "number",
+        "optional": True,
+        "description": _("How long to wait for this distributor to report on a patron's loans and holds. If it takes longer, the patron's bookshelf is shown without this collection's books, and nothing is removed from it."),
+    }
+
     # These collection-specific settings should be inherited by all
     # distributors.
-    SETTINGS = []
+    SETTINGS = [PATRON_ACTIVITY_TIMEOUT_SETTING]
 
     # These library- and collection-specific settings should be
     # inherited by all distributors.
@@ -1096,6 +1591,13 @@ class BaseCirculationAPI(object):
     # cannot revoke their hold on the book.
     CAN_REVOKE_HOLD_WHEN_RESERVED = True
 
+    # CirculationAPI.patron_activity will wait this many seconds for
+    # the API to report on a patron's loans and holds before giving
+    # up and treating the sync as incomplete, unless the collection's
+    # PATRON_ACTIVITY_TIMEOUT_SETTING says otherwise. Subclasses for
+    # slow vendors may override this.
+    PATRON_ACTIVITY_TIMEOUT = 30
+
     # If the client must set a delivery mechanism at the point of
     # checkout (Axis 360), set this to BORROW_STEP. If the client may
     # wait til the point of fulfillment to set a delivery mechanism
@@ -121,6 +121,17 @@ class Configuration(CoreConfiguration):
     # a shared secret with a library registry. The setting is automatically generated
     # and not editable by admins.
     PUBLIC_KEY = "public-key"
+
+    # Names of the site-wide settings that control how long we trust
+    # our cached view of a patron's loans and holds, and where that
+    # cache is kept.
+    PATRON_ACTIVITY_CACHE_TTL = u"patron_activity_cache_ttl"
+    PATRON_ACTIVITY_CACHE_PATH = u"patron_activity_cache_path"
+
+    # If this is set, the admin dashboard shows the statistics saved
+    # by bin/refresh_dashboard_stats, as long as they're no more than
+    # this many minutes old.
+    DASHBOARD_STATS_SNAPSHOT_MAX_AGE = u"dashboard_stats_snapshot_max_age"
     
     SITEWIDE_SETTINGS = CoreConfiguration.SITEWIDE_SETTINGS + [
         {
@@ -139,6 +150,26 @@ class Configuration(CoreConfiguration):
             "key": STATIC_FILE_CACHE_TIME,
             "label": _("Cache time for static JS and CSS files for the admin interface"),
         },
+        {
+            "key": PATRON_ACTIVITY_CACHE_TTL,
+            "label": _("Number of seconds to cache a patron's loans and holds"),
+            "description": _("If this is set, a patron who refreshes their bookshelf repeatedly will be shown the cached view of their loans and holds, instead of the circulation manager asking every distributor each time. Borrowing or returning a book clears the cache."),
+            "type": "number",
+            "optional": True,
+        },
+        {
+            "key": PATRON_ACTIVITY_CACHE_PATH,
+            "label": _("Location of the shared cache of patrons' loans and holds"),
+            "description": _("A path to a file on local disk. If this is set, all the processes on a server will share cached loans and holds. Otherwise, each process keeps its own cache in memory, and books are never removed from a patron's bookshelf based on what's in the cache."),
+            "optional": True,
+        },
+        {
+            "key": DASHBOARD_STATS_SNAPSHOT_MAX_AGE,
+            "label": _("Maximum age, in minutes, of the dashboard statistics snapshot"),
+            "description": _("If this is set, the admin dashboard will show the statistics saved by the refresh_dashboard_stats script instead of calculating them every time, as long as they're no older than this. Otherwise, statistics are always calculated on the spot."),
+            "type": "number",
+            "optional": True,
+        },
     ]
 
     LIBRARY_SETTINGS = CoreConfiguration.LIBRARY_SETTINGS + [
@@ -5,11 +5,15 @@ import sys
 import urllib
 import datetime
 import base64
+import hashlib
 from wsgiref.handlers import format_date_time
 from time import mktime
 
 from lxml import etree
-from sqlalchemy.orm import eagerload
+from sqlalchemy.orm import (
+    eagerload,
+    sessionmaker,
+)
 
 from functools import wraps
 import flask
@@ -146,6 +150,7 @@ from novelist import (
 from base_controller import BaseCirculationManagerController
 from testing import MockCirculationAPI, MockSharedCollectionAPI
 from core.analytics import Analytics
+from analytics_queue import AnalyticsQueue
 from accept_types import parse_header
 
 class CirculationManager(object):
@@ -163,6 +168,7 @@ class CirculationManager(object):
                 sys.exit()
 
         self.testing = testing
+        self.analytics_queue = None
         self.site_configuration_last_update = (
             Configuration.site_configuration_last_update(self._db, timeout=0)
         )
@@ -188,7 +194,7 @@ class CirculationManager(object):
         interface.
         """
         LogConfiguration.initialize(self._db)
-        self.analytics = Analytics(self._db)
+        self.analytics = self.setup_analytics()
         self.auth = Authenticator(self._db, self.analytics)
 
         self.setup_external_search()
@@ -247,6 +253,26 @@ class CirculationManager(object):
             self.setup_external_search()
         return self.__external_search
 
+    def setup_analytics(self):
+        """Find the analytics providers.
+
+        Outside of tests, events are passed on to the providers by a
+        background thread, so that requests don't have to wait for
+        them.
+        """
+        analytics = Analytics(self._db)
+        if self.testing:
+            return analytics
+        if self.analytics_queue:
+            # Keep the events that are already queued, but send them
+            # to the newly configured providers.
+            self.analytics_queue.analytics = analytics
+        else:
+            self.analytics_queue = AnalyticsQueue(
+                analytics, sessionmaker(bind=self._db.get_bind())
+            )
+        return self.analytics_queue
+
     def setup_external_search(self):
         try:
             self.__external_search = self.setup_search()
@@ -445,6 +471,50 @@ class CirculationManagerController(BaseCirculationManagerController):
         """Return the appropriate SharedCollectionAPI for the request library."""
         return self.manager.shared_collection_api
 
+    def not_modified(self, etag, weak=False, **kwargs):
+        """If the client already has the representation with the given
+        ETag, make a 304 response telling it so.
+
+        :param weak: Whether `etag` is a weak ETag.
+        :param kwargs: Passed into feed_response(), so that the 304
+            response has the same headers as the full response would.
+        :return: A Response, or None if the client needs the full
+            representation.
+        """
+        # If-None-Match always uses the weak comparison.
+        if etag and flask.request.if_none_match.contains_weak(etag):
+            response = feed_response(u"", **kwargs)
+            response.status_code = 304
+            response.set_etag(etag, weak=weak)
+            return response
+        return None
+
+    def conditional_feed_response(self, feed, etag=None, **kwargs):
+        """Send an OPDS feed with an ETag, or a 304 response if the
+        client already has this version of the feed.
+
+        :param etag: A weak ETag for this feed, calculated from
+            whatever the feed was built from. By default, a strong
+            ETag is calculated from the feed's content.
+        :param kwargs: Passed into feed_response().
+        """
+        if isinstance(feed, ProblemDetail):
+            return feed
+        if not isinstance(feed, basestring):
+            feed = unicode(feed)
+        weak = bool(etag)
+        if not etag:
+            content = feed
+            if isinstance(content, unicode):
+                content = content.encode("utf8")
+            etag = hashlib.sha1(content).hexdigest()
+        response = self.not_modified(etag, weak=weak, **kwargs)
+        if response:
+            return response
+        response = feed_response(feed, **kwargs)
+        response.set_etag(etag, weak=weak)
+        return response
+
     def load_lane(self, lane_identifier):
         """Turn user input into a Lane object."""
         library_id = flask.request.library.id
@@ -656,7 +726,7 @@ class OPDSFeedController(CirculationManagerController):
         feed = AcquisitionFeed.groups(
             self._db, title, url, lane, annotator, facets=facets
         )
-        return feed_response(feed)
+        return self.conditional_feed_response(feed)
 
     def feed(self, lane_identifier):
         """Build or retrieve a paginated acquisition feed."""
@@ -684,7 +754,7 @@ class OPDSFeedController(CirculationManagerController):
             facets=facets,
             pagination=pagination,
         )
-        return feed_response(feed)
+        return self.conditional_feed_response(feed)
 
     def crawlable_library_feed(self):
         """Build or retrieve a crawlable acquisition feed for the
@@ -748,7 +818,7 @@ class OPDSFeedController(CirculationManagerController):
             facets=facets,
             pagination=pagination,
         )
-        return feed_response(feed)
+        return self.conditional_feed_response(feed)
 
     def search(self, lane_identifier):
 
@@ -851,10 +921,19 @@ class LoanController(CirculationManagerController):
                     "ERROR DURING SYNC for %s: %r", patron.id, e, exc_info=e
                 )
 
+        # If the patron's loans and holds haven't changed since they
+        # last asked, there's no need to make the feed.
+        etag = LibraryLoanAndHoldAnnotator.active_loans_etag(
+            patron, self.manager.site_configuration_last_update
+        )
+        response = self.not_modified(etag, weak=True, cache_for=None)
+        if response:
+            return response
+
         # Then make the feed.
         feed = LibraryLoanAndHoldAnnotator.active_loans_for(
             self.circulation, patron)
-        return feed_response(feed, cache_for=None)
+        return self.conditional_feed_response(feed, etag=etag, cache_for=None)
 
     def borrow(self, identifier_type, identifier, mechanism_id=None):
         """Create a new loan or hold for a book.
@@ -1286,14 +1365,43 @@ class AnnotationController(CirculationManagerController):
                                '<http://www.w3.org/TR/annotation-protocol/>; rel="http://www.w3.org/ns/ldp#constrainedBy"']
             headers['Content-Type'] = AnnotationWriter.CONTENT_TYPE
 
-            container, timestamp = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
+            page = flask.request.args.get('page')
+            since = flask.request.args.get('since')
+            if since is not None:
+                # A client is asking what's changed since it last synced.
+                sync = AnnotationWriter.parse_sync_token(since)
+                if not sync:
+                    return INVALID_INPUT.detailed(
+                        _("Invalid sync token: %s") % since
+                    )
+                since_time, seen = sync
+                document, timestamp = AnnotationWriter.changes_since(
+                    patron, since_time, identifier=identifier, seen=seen
+                )
+            elif page is None:
+                document, timestamp = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
+            else:
+                # A client is following a link to a later page of the
+                # container.
+                try:
+                    page = int(page)
+                except ValueError:
+                    page = -1
+                if page < 0:
+                    return INVALID_INPUT.detailed(
+                        _("Invalid page number: %s") % flask.request.args.get('page')
+                    )
+                total, timestamp = AnnotationWriter.summary(patron, identifier=identifier)
+                document = AnnotationWriter.annotation_page_for(
+                    patron, identifier=identifier, page=page, total=total
+                )
             etag = 'W/""'
             if timestamp:
                 etag = 'W/"%s"' % timestamp
                 headers['Last-Modified'] = format_date_time(mktime(timestamp.timetuple()))
             headers['ETag'] = etag
 
-            content = json.dumps(container)
+            content = json.dumps(document)
             return Response(content, status=200, headers=headers)
 
         data = flask.request.data
@@ -1333,6 +1441,11 @@ class AnnotationController(CirculationManagerController):
 
         if flask.request.method == 'DELETE':
             annotation.set_inactive()
+            # Clients that sync their annotations find out about the
+            # deletion through the timestamp, which is in UTC like
+            # every other annotation timestamp.
+            annotation.timestamp = datetime.datetime.utcnow()
+            AnnotationParser.forget_compacted(self._db, annotation)
             return Response()
 
         content = json.dumps(AnnotationWriter.detail(annotation))
@@ -17,6 +17,7 @@ from circulation import (
 )
 
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
 
 from selftest import (
     HasSelfTests,
@@ -660,6 +661,7 @@ class EnkiImport(CollectionMonitor):
         """Constructor."""
         super(EnkiImport, self).__init__(_db, collection)
         self._db = _db
+        ChangedWorkQueue.watch(_db)
         if callable(api_class):
             api = api_class(_db, collection)
         else:
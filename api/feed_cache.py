@@ -0,0 +1,87 @@
+"""Keep track of which works have changed, so that cached lane feeds
+only need to be regenerated when something in them has changed.
+
+Bibliographic changes show up in the materialized views, but changes
+to a book's availability don't. So the vendor monitors watch their
+database sessions, and whenever a LicensePool's availability changes,
+its work is added to a queue of changed works.
+"""
+from nose.tools import set_trace
+from datetime import datetime
+
+from sqlalchemy import (
+    event,
+    func,
+    inspect,
+)
+
+from core.model import LicensePool
+
+from tables import changed_works_table
+
+class ChangedWorkQueue(object):
+    """A queue of works whose availability has changed."""
+
+    # A change to any of these LicensePool fields is a change to the
+    # book's availability.
+    AVAILABILITY_FIELDS = [
+        'licenses_owned', 'licenses_available', 'licenses_reserved',
+        'patrons_in_hold_queue', 'open_access', 'suppressed',
+    ]
+
+    @classmethod
+    def watch(cls, _db):
+        """Add a work to the queue whenever a LicensePool's availability
+        changes in this database session.
+        """
+        if not event.contains(_db, 'after_flush', cls._after_flush):
+            event.listen(_db, 'after_flush', cls._after_flush)
+
+    @classmethod
+    def _after_flush(cls, session, flush_context):
+        work_ids = set()
+        for obj in session.new.union(session.dirty):
+            if (isinstance(obj, LicensePool) and obj.work_id
+                and cls.availability_changed(obj)):
+                work_ids.add(obj.work_id)
+        if work_ids:
+            cls.add(session.connection(), work_ids)
+
+    @classmethod
+    def availability_changed(cls, licensepool):
+        attrs = inspect(licensepool).attrs
+        return any(
+            getattr(attrs, field).history.has_changes()
+            for field in cls.AVAILABILITY_FIELDS
+        )
+
+    @classmethod
+    def add(cls, connection, work_ids, timestamp=None):
+        """Record that some works changed."""
+        timestamp = timestamp or datetime.utcnow()
+        connection.execute(
+            changed_works_table.insert(),
+            [dict(work_id=work_id, timestamp=timestamp)
+             for work_id in work_ids]
+        )
+
+    @classmethod
+    def latest_change(cls, _db, work_ids):
+        """Find the most recent time any of the given works changed.
+
+        :param work_ids: A SELECT statement (or a list) of work IDs.
+        :return: A datetime, or None if none of the works are in the
+            queue.
+        """
+        return _db.query(
+            func.max(changed_works_table.c.timestamp)
+        ).filter(changed_works_table.c.work_id.in_(work_ids)).scalar()
+
+    @classmethod
+    def prune(cls, _db, before):
+        """Remove changes that happened before the given time."""
+        _db.connection().execute(
+            changed_works_table.delete().where(
+                changed_works_table.c.timestamp < before
+            )
+        )
@@ -1,8 +1,18 @@
 from config import CannotLoadConfiguration
+import atexit
+import logging
+import threading
+import time
 import uuid
 import unicodedata
 import urllib
 import re
+import requests
+from Queue import (
+    Empty,
+    Queue,
+)
+from requests.adapters import HTTPAdapter
 from flask_babel import lazy_gettext as _
 from core.util.http import HTTP
 from core.model import (
@@ -38,14 +48,58 @@ class GoogleAnalyticsProvider(object):
     TRACKING_ID = "tracking_id"
     DEFAULT_URL = "http://www.google-analytics.com/collect"
 
+    BATCH_URL = "batch_url"
+    DEFAULT_BATCH_URL = "http://www.google-analytics.com/batch"
+    SEND_IN_BATCHES = "send_in_batches"
+
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("URL"), "default": DEFAULT_URL },
+        { "key": SEND_IN_BATCHES,
+          "label": _("Send events in batches"),
+          "type": "select",
+          "description": _("Sending events in batches makes far fewer requests to Google Analytics when many events happen at once, such as when a large collection is imported. Events may reach Google Analytics a little later."),
+          "options": [
+              { "key": "false", "label": _("Send each event as it happens") },
+              { "key": "true", "label": _("Send events in batches") },
+          ],
+          "default": "false",
+        },
+        { "key": BATCH_URL, "label": _("Batch URL"), "default": DEFAULT_BATCH_URL,
+          "description": _("Where to send batches of events. For testing, this and the URL can point to a local stand-in for Google Analytics."),
+          "optional": True,
+        },
     ]
 
     LIBRARY_SETTINGS = [
         { "key": TRACKING_ID, "label": _("Tracking ID") },
     ]
-    
+
+    # The Measurement Protocol's limits on a single request to the
+    # batch endpoint.
+    MAX_HITS_PER_BATCH = 20
+    MAX_BATCH_BYTES = 16 * 1024
+    MAX_HIT_BYTES = 8 * 1024
+
+    # A batch that can't be sent is tried this many more times,
+    # waiting BACKOFF seconds before the first retry and twice as long
+    # before each retry after that, but no retry starts once
+    # MAX_SEND_TIME seconds have passed since the first try.
+    RETRIES = 3
+    BACKOFF = 1
+    TIMEOUT = 10
+    MAX_SEND_TIME = 30
+
+    # Batches are sent over keep-alive connections from this pool,
+    # which is shared by every GoogleAnalyticsProvider.
+    _http_session = None
+    _http_session_lock = threading.Lock()
+    CONNECTION_POOL_SIZE = 10
+
+    # In batch mode, hits wait in this HitBuffer, which is also shared
+    # by every GoogleAnalyticsProvider.
+    _hit_buffer = None
+    _hit_buffer_lock = threading.Lock()
+
     def __init__(self, integration, library=None):
         _db = Session.object_session(integration)
         if not library:
@@ -58,8 +112,43 @@ class GoogleAnalyticsProvider(object):
         if not self.tracking_id:
             raise CannotLoadConfiguration("Missing tracking id for library %s" % library.short_name)
 
+        self.batching = ConfigurationSetting.for_externalintegration(
+            self.SEND_IN_BATCHES, integration
+        ).bool_value
+        batch_url_setting = ConfigurationSetting.for_externalintegration(
+            self.BATCH_URL, integration
+        )
+        self.batch_url = batch_url_setting.value or self.DEFAULT_BATCH_URL
+        self.log = logging.getLogger("Google Analytics")
 
     def collect_event(self, library, license_pool, event_type, time, **kwargs):
+        hit = self.hit(library, license_pool, event_type, time, **kwargs)
+        if self.batching:
+            self.add_hits([hit])
+        else:
+            self.post(self.url, hit)
+
+    def collect_events(self, events):
+        """Send a number of events at once.
+
+        :param events: A list of (library, license_pool, event_type,
+            time, kwargs) tuples.
+        """
+        hits = [
+            self.hit(library, license_pool, event_type, time, **kwargs)
+            for library, license_pool, event_type, time, kwargs in events
+        ]
+        if self.batching:
+            self.add_hits(hits, flush=True)
+        else:
+            for hit in hits:
+                self.post(self.url, hit)
+
+    def hit(self, library, license_pool, event_type, time, **kwargs):
+        """Describe an event as a Measurement Protocol hit.
+
+        :return: A URL-encoded string.
+        """
         client_id = uuid.uuid4()
         fields = {
             'v': 1,
@@ -96,11 +185,253 @@ class GoogleAnalyticsProvider(object):
         # urlencode doesn't like unicode strings so we convert them to utf8
         fields = {k: unicodedata.normalize("NFKD", unicode(v)).encode("utf8") for k, v in fields.iteritems()}
         
-        params = re.sub(r"=None(&?)", r"=\1", urllib.urlencode(fields))
-        self.post(self.url, params)
+        return re.sub(r"=None(&?)", r"=\1", urllib.urlencode(fields))
 
     def post(self, url, params):
         response = HTTP.post_with_timeout(url, params)
 
-        
+    def add_hits(self, hits, flush=False):
+        """Add hits to the ones waiting to be sent. Every batch that's
+        full is sent in the background.
+
+        :param flush: If this is True, send everything, even if the
+            last batch isn't full.
+        """
+        self.hit_buffer().add(self, hits, flush=flush)
+
+    def flush(self):
+        """Send every hit that's waiting to go to this provider's batch
+        URL, in the background.
+        """
+        self.hit_buffer().flush(self.batch_url)
+
+    def batches(self, hits):
+        """Divide hits into batches that are within the batch
+        endpoint's limits.
+        """
+        batch = []
+        for hit in hits:
+            if len(hit) > self.MAX_HIT_BYTES:
+                # Google Analytics would ignore this hit anyway.
+                self.log.warn("Not sending a hit of %d bytes.", len(hit))
+                continue
+            if batch and not self.has_room(batch, hit):
+                yield batch
+                batch = []
+            batch.append(hit)
+        if batch:
+            yield batch
+
+    def has_room(self, batch, hit=""):
+        """Could a hit of the same size as `hit` be added to `batch`?"""
+        if len(batch) >= self.MAX_HITS_PER_BATCH:
+            return False
+        # Hits in a batch are separated by newlines.
+        size = sum(len(x) + 1 for x in batch) + len(hit)
+        return size <= self.MAX_BATCH_BYTES
+
+    @classmethod
+    def http_session(cls):
+        with cls._http_session_lock:
+            if not cls._http_session:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=cls.CONNECTION_POOL_SIZE,
+                    pool_maxsize=cls.CONNECTION_POOL_SIZE,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls._http_session = session
+            return cls._http_session
+
+    @classmethod
+    def hit_buffer(cls):
+        with cls._hit_buffer_lock:
+            if not cls._hit_buffer:
+                cls._hit_buffer = HitBuffer()
+            return cls._hit_buffer
+
+    def post_batch(self, hits):
+        """Send a batch of hits to the batch endpoint, retrying if
+        Google Analytics can't be reached or has a server error.
+
+        :return: True if the batch was sent.
+        """
+        payload = "\n".join(hits)
+        deadline = time.time() + self.MAX_SEND_TIME
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                delay = self.BACKOFF * 2 ** (attempt - 1)
+                if time.time() + delay >= deadline:
+                    break
+                self.sleep(delay)
+            timeout = min(self.TIMEOUT, max(deadline - time.time(), 1))
+            try:
+                response = self.http_session().post(
+                    self.batch_url, data=payload, timeout=timeout
+                )
+            except requests.exceptions.RequestException, e:
+                error = e
+                continue
+            if response.status_code < 500:
+                return True
+            error = "Got status code %s" % response.status_code
+        self.log.error(
+            "Could not send %d hits to %s: %s", len(hits), self.batch_url,
+            error
+        )
+        return False
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class HitBuffer(object):
+    """Hits waiting to be sent to Google Analytics in batches.
+
+    One HitBuffer is shared by every GoogleAnalyticsProvider in the
+    process, however many providers are created. Hits are grouped by
+    batch URL, since hits for different libraries can go in the same
+    batch. A background thread sends each batch once it's full or once
+    its oldest hit has waited `max_age` seconds, so the thread that
+    collected an event never waits on Google Analytics.
+    """
+
+    MAX_AGE = 10
+
+    # How often the background thread looks for batches that have
+    # waited too long.
+    POLL_INTERVAL = 1
+
+    # How long shutdown() spends sending what's left.
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, max_age=None, start=True):
+        """Constructor.
+
+        :param start: If this is False, the background thread isn't
+            started, and batches stay queued until send_queued() is
+            called.
+        """
+        if max_age is None:
+            max_age = self.MAX_AGE
+        self.max_age = max_age
+
+        # Maps each batch URL to a 3-tuple (provider, hits, time the
+        # oldest of them arrived). The provider is the last one to add
+        # hits, and is the one that sends the batch.
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # Batches that are ready to go, as (provider, hits) 2-tuples.
+        self.outgoing = Queue()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.log = logging.getLogger("Google Analytics")
+        if start:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="Google Analytics"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.shutdown)
+
+    def add(self, provider, hits, flush=False):
+        """Add hits to the ones waiting to go to a provider's batch URL,
+        and queue every batch that's ready.
+
+        :param flush: If this is True, queue everything for that batch
+            URL, even if the last batch isn't full.
+        """
+        with self.lock:
+            ignore, waiting, since = self.pending.get(
+                provider.batch_url, (None, [], time.time())
+            )
+            self._queue_batches(provider, waiting + hits, since, flush)
+        if self.stopping.is_set():
+            # The background thread is gone.
+            self.send_queued()
+
+    def flush(self, batch_url=None):
+        """Queue every hit that's waiting, or only the ones for one
+        batch URL.
+        """
+        with self.lock:
+            for url, (provider, hits, since) in self.pending.items():
+                if batch_url in (None, url):
+                    self._queue_batches(provider, hits, since, True)
+
+    def queue_old_batches(self):
+        """Queue the batches whose oldest hit has waited too long."""
+        with self.lock:
+            for provider, hits, since in self.pending.values():
+                self._queue_batches(provider, hits, since, False)
+
+    def _queue_batches(self, provider, hits, since, flush):
+        """Divide hits into batches and queue them, except for a last
+        batch that has room for more hits and hasn't waited too long.
+
+        The caller must hold the lock.
+        """
+        batches = list(provider.batches(hits))
+        if (batches and not flush and provider.has_room(batches[-1])
+            and time.time() - since < self.max_age):
+            self.pending[provider.batch_url] = (provider, batches.pop(), since)
+        else:
+            self.pending.pop(provider.batch_url, None)
+        for batch in batches:
+            self.outgoing.put((provider, batch))
+
+    def run(self):
+        """Send batches until shutdown() is called."""
+        while not self.stopping.is_set():
+            self.queue_old_batches()
+            try:
+                provider, hits = self.outgoing.get(timeout=self.POLL_INTERVAL)
+            except Empty:
+                continue
+            self.send(provider, hits)
+
+    def send(self, provider, hits):
+        try:
+            provider.post_batch(hits)
+        except Exception, e:
+            self.log.error(
+                "Could not send %d hits.", len(hits), exc_info=e
+            )
+
+    def send_queued(self, deadline=None):
+        """Send every queued batch, on this thread.
+
+        :param deadline: Give up on the batches that are left at this
+            time.
+        :return: The number of batches sent.
+        """
+        sent = 0
+        while True:
+            if deadline and time.time() > deadline:
+                left = self.outgoing.qsize()
+                if left:
+                    self.log.warn("Gave up on %d batches of hits.", left)
+                return sent
+            try:
+                provider, hits = self.outgoing.get_nowait()
+            except Empty:
+                return sent
+            self.send(provider, hits)
+            sent += 1
+
+    def shutdown(self):
+        """Stop the background thread and send whatever's left."""
+        deadline = time.time() + self.SHUTDOWN_TIMEOUT
+        self.stopping.set()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(self.SHUTDOWN_TIMEOUT)
+        self.flush()
+        self.send_queued(deadline)
+
+
 Provider = GoogleAnalyticsProvider
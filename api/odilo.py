@@ -34,6 +34,7 @@ from core.monitor import (
 from core.util.http import HTTP
 
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
 
 
 class OdiloAPI(BaseOdiloAPI, BaseCirculationAPI, HasSelfTests):
@@ -420,6 +421,7 @@ class OdiloCirculationMonitor(CollectionMonitor):
         """Constructor."""
         super(OdiloCirculationMonitor, self).__init__(_db, collection)
         self.api = api_class(_db, collection)
+        ChangedWorkQueue.watch(_db)
 
     def run_once(self, start, cutoff):
         self.log.info("Starting recently_changed_ids, start: " + str(start) + ", cutoff: " + str(cutoff))
@@ -1,19 +1,25 @@
 from nose.tools import set_trace
 
 import base64
+import bisect
 import json
 import uuid
 import datetime
 from flask_babel import lazy_gettext as _
 import urlparse
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 import flask
 from flask import Response
 import feedparser
 from lxml import etree
 from StringIO import StringIO
 
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import (
+    bindparam,
+    or_,
+)
 
 from core.opds_import import (
     OPDSXMLParser,
@@ -64,6 +70,7 @@ from core.testing import (
     MockRequestsResponse,
 )
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
 from shared_collection import BaseSharedCollectionAPI
 
 class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
@@ -548,32 +555,157 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
             # Add 1 since position 0 indicates the hold is ready.
             hold.position = holds_count + 1
 
-    def update_hold_queue(self, licensepool):
-        # Update the pool and the next holds in the queue when a license is reserved.
+    def _active_loans(self, licensepool, now=None):
+        """Find the loans on a license pool that haven't expired, in
+        the order they started.
+        """
         _db = Session.object_session(licensepool)
-
-        loans_count = _db.query(Loan).filter(
+        now = now or datetime.datetime.utcnow()
+        return _db.query(Loan).filter(
             Loan.license_pool_id==licensepool.id
         ).filter(
             or_(
                 Loan.end==None,
-                Loan.end>datetime.datetime.utcnow()
+                Loan.end>now
             )
-        ).count()
-        remaining_licenses = licensepool.licenses_owned - loans_count
+        ).order_by(Loan.start, Loan.id).all()
 
-        holds = _db.query(Hold).filter(
+    def _active_holds(self, licensepool, now=None):
+        """Find the holds on a license pool that are still in the
+        queue, in the order they started.
+        """
+        _db = Session.object_session(licensepool)
+        now = now or datetime.datetime.utcnow()
+        return _db.query(Hold).filter(
             Hold.license_pool_id==licensepool.id
         ).filter(
             or_(
                 Hold.end==None,
-                Hold.end>datetime.datetime.utcnow(),
+                Hold.end>now,
                 Hold.position>0,
             )
         ).order_by(
-            Hold.start
+            Hold.start, Hold.id
         ).all()
 
+    def _recalculate_hold_queue(self, licensepool, loans, holds, now=None):
+        """Recalculate the position of every hold in a license pool's
+        queue, and the end date of every hold whose position changed.
+
+        This covers the whole queue, not just the holds that have
+        reserved licenses: a hold further back is given the position
+        and end date _update_hold_end_date would give it, so the
+        patron sees the new estimate without waiting for their own
+        hold to be looked at. A hold's end date is estimated the same
+        way as in _update_hold_end_date, but everything is worked out
+        from the loans and holds passed in.
+
+        Only the holds whose position or end date actually changed are
+        written out, with a single UPDATE statement. A hold that was
+        already in the right place, with an end date, isn't written.
+
+        :param loans: The pool's active loans, ordered by start date.
+        :param holds: The pool's active holds, ordered by start date.
+        """
+        _db = Session.object_session(licensepool)
+        now = now or datetime.datetime.utcnow()
+        collection = self.collection(_db)
+        default_reservation_period = collection.default_reservation_period
+        loan_periods = {}
+
+        remaining_licenses = licensepool.licenses_owned - len(loans)
+        licenses_reserved = min(remaining_licenses, len(holds))
+        current_reservations = holds[:licenses_reserved]
+
+        # A hold's place in line is determined by the number of holds
+        # that started before it. Holds with no start date sort last
+        # and never count as being ahead of anyone.
+        starts = [hold.start for hold in holds if hold.start is not None]
+
+        # Map each hold that needs to change to its new position and
+        # end date.
+        changes = {}
+        def end_date(hold):
+            if hold in changes:
+                return changes[hold][1]
+            return hold.end
+
+        for hold in holds:
+            if hold.start is None:
+                holds_before = 0
+            else:
+                holds_before = bisect.bisect_left(starts, hold.start)
+            if remaining_licenses > holds_before:
+                # The hold is ready to check out.
+                position = 0
+            else:
+                # Add 1 since position 0 indicates the hold is ready.
+                position = holds_before + 1
+
+            if position == hold.position and hold.end:
+                # The hold hasn't moved, so its end date still stands.
+                continue
+
+            end = hold.end
+            if position > 0:
+                if licensepool.licenses_owned > 0:
+                    # See _update_hold_end_date for an explanation of
+                    # this worst-case estimate.
+                    patron_or_client = hold.library or hold.integration_client
+                    if patron_or_client not in loan_periods:
+                        loan_periods[patron_or_client] = collection.default_loan_period(
+                            patron_or_client
+                        )
+                    default_loan_period = loan_periods[patron_or_client]
+
+                    cycles = (position - licenses_reserved - 1) / licensepool.licenses_owned
+                    copy_index = (position - licenses_reserved - 1)  % licensepool.licenses_owned
+                    if len(loans) > copy_index:
+                        next_cycle_start = loans[copy_index].end
+                    else:
+                        reservation = current_reservations[copy_index - len(loans)]
+                        next_cycle_start = end_date(reservation) + datetime.timedelta(days=default_loan_period)
+                    cycle_period = default_loan_period + default_reservation_period
+                    end = next_cycle_start + datetime.timedelta(days=(cycle_period * cycles))
+            else:
+                # The hold just became available. The patron's
+                # reservation period starts now.
+                end = now + datetime.timedelta(days=default_reservation_period)
+
+            if (position, end) != (hold.position, hold.end):
+                changes[hold] = (position, end)
+
+        if not changes:
+            return
+
+        table = Hold.__table__
+        _db.execute(
+            table.update().where(
+                table.c.id==bindparam('hold_id')
+            ).values(
+                position=bindparam('new_position'),
+                end=bindparam('new_end'),
+            ),
+            [dict(hold_id=hold.id, new_position=position, new_end=end)
+             for hold, (position, end) in changes.items()]
+        )
+
+        # The database is up to date, so the Hold objects can be
+        # brought in line without the session writing them out again.
+        for hold, (position, end) in changes.items():
+            set_committed_value(hold, 'position', position)
+            set_committed_value(hold, 'end', end)
+
+    def update_hold_queue(self, licensepool):
+        # Update the pool and the holds in the queue when a license is
+        # reserved or returned.
+        _db = Session.object_session(licensepool)
+        now = datetime.datetime.utcnow()
+
+        loans = self._active_loans(licensepool, now)
+        remaining_licenses = licensepool.licenses_owned - len(loans)
+        holds = self._active_holds(licensepool, now)
+
         if len(holds) > remaining_licenses:
             new_licenses_available = 0
             new_licenses_reserved = remaining_licenses
@@ -588,13 +720,12 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
             new_licenses_reserved,
             new_patrons_in_hold_queue,
             analytics=self.analytics,
-            as_of=datetime.datetime.utcnow(),
+            as_of=now,
         )
 
-        for hold in holds[:licensepool.licenses_reserved]:
-            if hold.position != 0:
-                # This hold just got a reserved license.
-                self._update_hold_end_date(hold)
+        # Bring every hold's position, and the end date of every hold
+        # that moved, up to date.
+        self._recalculate_hold_queue(licensepool, loans, holds, now)
 
     def place_hold(self, patron, pin, licensepool, notification_email_address):
         """Create a new hold."""
@@ -703,9 +834,14 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
             ) for hold in remaining_holds
         ]
 
-    def update_consolidated_copy(self, _db, copy_info, analytics=None):
+    def update_consolidated_copy(self, _db, copy_info, analytics=None,
+                                 update_hold_queue=True):
         """Process information about the current status of a consolidated
         copy from the consolidated copies feed.
+
+        :param update_hold_queue: If this is false, the caller is
+            responsible for calling update_hold_queue on the pool.
+        :return: The LicensePool for the copy.
         """
         identifier = copy_info.get("identifier")
         licenses = copy_info.get("licenses")
@@ -725,7 +861,9 @@ class ODLWithConsolidatedCopiesAPI(BaseCirculationAPI, BaseSharedCollectionAPI):
         pool, ignore = circulation_data.apply(_db, self.collection(_db), replacement_policy)
 
         # Update licenses available and reserved based on existing loans and holds.
-        self.update_hold_queue(pool)
+        if update_hold_queue:
+            self.update_hold_queue(pool)
+        return pool
 
     def update_loan(self, loan, status_doc=None):
         """Check a loan's status, and if it is no longer active, delete the loan
@@ -816,7 +954,80 @@ class ODLBibliographicImportMonitor(OPDSImportMonitor):
     PROTOCOL = ODLBibliographicImporter.NAME
     SERVICE_NAME = "ODL Bibliographic Import Monitor"
 
-class ODLConsolidatedCopiesMonitor(CollectionMonitor):
+class ODLBatchMonitor(CollectionMonitor):
+    """A CollectionMonitor that works through a large number of items
+    in batches, committing after each batch.
+
+    If `workers` is more than one, the items in a batch are divided
+    between that many threads, each with its own database session and
+    its own API object.
+    """
+
+    # The number of items to process before committing.
+    BATCH_SIZE = 100
+
+    # The number of threads to use when processing a batch.
+    WORKERS = 1
+
+    def __init__(self, _db, collection=None, api=None, batch_size=None,
+                 workers=None, **kwargs):
+        super(ODLBatchMonitor, self).__init__(_db, collection, **kwargs)
+        self.api = api or ODLWithConsolidatedCopiesAPI(_db, collection)
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.workers = workers or self.WORKERS
+        ChangedWorkQueue.watch(_db)
+
+    def process_batch(self, items):
+        """Process a batch of items and commit the results."""
+        if self.workers <= 1 or len(items) <= 1:
+            self.process_items(self._db, self.api, items)
+            self._db.commit()
+            return
+
+        # Deal the items out between the workers.
+        chunks = [items[i::self.workers] for i in range(self.workers)]
+        chunks = [x for x in chunks if x]
+        pool = ThreadPool(len(chunks))
+        try:
+            # map() re-raises any exception from a worker thread.
+            pool.map(self._process_in_new_session, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        # The workers changed the database behind the back of our
+        # session, so make sure it doesn't use stale data.
+        self._db.expire_all()
+
+    def _process_in_new_session(self, items):
+        _db = Session(bind=self._db.get_bind())
+        ChangedWorkQueue.watch(_db)
+        try:
+            self.process_items(_db, self.api_for_session(_db), items)
+            _db.commit()
+        except Exception, e:
+            _db.rollback()
+            raise
+        finally:
+            _db.close()
+
+    def api_for_session(self, _db):
+        """Create an API object for a worker thread, so that the
+        threads don't share one.
+        """
+        collection = get_one(_db, Collection, id=self.api.collection_id)
+        return self.api.__class__(_db, collection)
+
+    def process_items(self, _db, api, items):
+        """Process some items using the given database session and
+        API object.
+
+        Implemented in subclasses.
+        """
+        raise NotImplementedError()
+
+
+class ODLConsolidatedCopiesMonitor(ODLBatchMonitor):
     """Monitor a consolidated copies feed for circulation information changes.
 
     This is primarily used to set up availability information when new copies
@@ -829,6 +1040,13 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
     the license pool's availability will be incorrectly incremented when the
     notification arrives. Hopefully this will be rare, and it won't be a problem
     once we have full ODL support.
+
+    After each page is processed, the link to the next page is kept
+    in the `achievements` of the monitor's Timestamp, so if a run is
+    interrupted the next run can pick up from that link. The time of
+    the Timestamp isn't updated until a run finishes, so the resumed
+    run still covers everything since the start of the interrupted
+    one.
     """
 
     SERVICE_NAME = "ODL Consolidated Copies Monitor"
@@ -841,20 +1059,23 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
     OVERLAP = datetime.timedelta(minutes=5)
 
     def __init__(self, _db, collection=None, api=None, **kwargs):
-        super(ODLConsolidatedCopiesMonitor, self).__init__(_db, collection, **kwargs)
-
-        self.api = api or ODLWithConsolidatedCopiesAPI(_db, collection)
+        super(ODLConsolidatedCopiesMonitor, self).__init__(
+            _db, collection, api=api, **kwargs
+        )
         self.start_url = collection.external_integration.setting(ODLWithConsolidatedCopiesAPI.CONSOLIDATED_COPIES_URL_KEY).value
-        self.analytics = self.api.analytics
 
     def run_once(self, start, cutoff):
-        url = self.start_url
-        if start:
-            # Add a small overlap with the previous run to make sure
-            # we don't miss anything.
-            start = start - self.OVERLAP
-
-            url += "?since=%s" % (start.isoformat() + 'Z')
+        # If the last run was interrupted, pick up where it left off.
+        timestamp = self.timestamp()
+        url = timestamp.achievements
+        if not url:
+            url = self.start_url
+            if start:
+                # Add a small overlap with the previous run to make sure
+                # we don't miss anything.
+                start = start - self.OVERLAP
+
+                url += "?since=%s" % (start.isoformat() + 'Z')
 
         # Go through the consolidated copies feed until we get to a page
         # with no next link.
@@ -866,6 +1087,8 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
                 url = urlparse.urljoin(url, next_url)
             else:
                 url = None
+            timestamp.achievements = url
+            self._db.commit()
 
     def process_one_page(self, response):
         content = json.loads(response.content)
@@ -879,41 +1102,88 @@ class ODLConsolidatedCopiesMonitor(CollectionMonitor):
                 next_url = link.get("href")
 
         copies = content.get("copies") or []
-        for copy in copies:
-            self.api.update_consolidated_copy(self._db, copy, self.analytics)
+        for i in range(0, len(copies), self.batch_size):
+            self.process_batch(copies[i:i+self.batch_size])
 
         return next_url
 
-class ODLHoldReaper(CollectionMonitor):
+    def process_items(self, _db, api, copies):
+        # Update every copy's license pool, then update each pool's
+        # hold queue once.
+        pools = []
+        for copy in copies:
+            pool = api.update_consolidated_copy(
+                _db, copy, api.analytics, update_hold_queue=False
+            )
+            if pool not in pools:
+                pools.append(pool)
+        for pool in pools:
+            api.update_hold_queue(pool)
+
+
+class ODLHoldReaper(ODLBatchMonitor):
     """Check for holds that have expired and delete them, and update
-    the holds queues for their pools."""
+    the holds queues for their pools.
+
+    License pools are handled in order of their IDs, and the ID of
+    the last pool handled is kept in the monitor's Timestamp, so if a
+    run is interrupted the next run picks up where it left off.
+    """
 
     SERVICE_NAME = "ODL Hold Reaper"
     PROTOCOL = ODLWithConsolidatedCopiesAPI.NAME
 
-    def __init__(self, _db, collection=None, api=None, **kwargs):
-        super(ODLHoldReaper, self).__init__(_db, collection, **kwargs)
-        self.api = api or ODLWithConsolidatedCopiesAPI(_db, collection)
-
-    def run_once(self, start, cutoff):
-        # Find holds that have expired.
-        expired_holds = self._db.query(Hold).join(
+    def expired_holds(self, _db, now):
+        return _db.query(Hold).join(
             Hold.license_pool
         ).filter(
             LicensePool.collection_id==self.api.collection_id
         ).filter(
-            Hold.end<datetime.datetime.utcnow()
+            Hold.end<now
         ).filter(
             Hold.position==0
         )
 
+    def run_once(self, start, cutoff):
+        self.now = datetime.datetime.utcnow()
+        timestamp = self.timestamp()
+        last_pool_id = timestamp.counter or 0
+
+        while True:
+            # Find the next batch of pools that have expired holds.
+            pool_ids = self.expired_holds(
+                self._db, self.now
+            ).filter(
+                Hold.license_pool_id>last_pool_id
+            ).with_entities(
+                Hold.license_pool_id
+            ).distinct().order_by(
+                Hold.license_pool_id
+            ).limit(self.batch_size).all()
+            pool_ids = [x for [x] in pool_ids]
+            if not pool_ids:
+                break
+            self.process_batch(pool_ids)
+            last_pool_id = pool_ids[-1]
+            timestamp.counter = last_pool_id
+            self._db.commit()
+
+        # The next run will start from the beginning.
+        timestamp.counter = 0
+
+    def process_items(self, _db, api, pool_ids):
+        # Delete all the expired holds for these pools at once...
+        expired = self.expired_holds(_db, self.now).filter(
+            Hold.license_pool_id.in_(pool_ids)
+        )
         changed_pools = set()
-        for hold in expired_holds:
+        for hold in expired:
             changed_pools.add(hold.license_pool)
-            self._db.delete(hold)
+            _db.delete(hold)
 
-        for pool in changed_pools:
-            self.api.update_hold_queue(pool)
+        # ...then update each pool's hold queue once.
+        for pool in sorted(changed_pools, key=lambda x: x.id):
+            api.update_hold_queue(pool)
 
 
 class MockODLWithConsolidatedCopiesAPI(ODLWithConsolidatedCopiesAPI):
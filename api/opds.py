@@ -1,13 +1,25 @@
 import urllib
 import copy
+import hashlib
 import logging
+import time
 from nose.tools import set_trace
 from flask import url_for
 from lxml import etree
 from collections import defaultdict
+from werkzeug.urls import (
+    url_quote,
+    url_quote_plus,
+)
 import uuid
+import flask
 
-from sqlalchemy.orm import lazyload
+from sqlalchemy import and_
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    subqueryload,
+)
 
 from core.cdn import cdnify
 from core.classifier import Classifier
@@ -24,9 +36,11 @@ from core.model import (
     Credential,
     DataSource,
     DeliveryMechanism,
+    Hold,
     Identifier,
     LicensePool,
     LicensePoolDeliveryMechanism,
+    Loan,
     Patron,
     Session,
     BaseMaterializedWork,
@@ -49,6 +63,101 @@ from annotations import AnnotationWriter
 from circulation import BaseCirculationAPI
 from config import Configuration
 from novelist import NoveListAPI
+from util.cache import LRUCache
+
+class URLTemplates(object):
+    """Generate URLs for Flask routes without running the route-building
+    code every time.
+
+    The first time a route is used with a certain set of arguments,
+    a template is built by passing placeholders into Flask's url_for.
+    After that, URLs are made by quoting the real values the same way
+    werkzeug does and substituting them for the placeholders.
+
+    Templates depend on the current request's host, so an instance of
+    this class should only be used while handling a single request.
+    """
+
+    PLACEHOLDER = "URLTEMPLATEARGUMENT%dX"
+
+    def __init__(self):
+        self.templates = {}
+
+    def url_for(self, cdn, route, **kwargs):
+        """Generate a URL for a Flask route.
+
+        :param cdn: If this is true, the URL will point to the CDN, as
+            with core.app_server.cdn_url_for.
+        """
+        # Arguments that are None or start with an underscore can
+        # change which URL rule gets used, or how, so they're part of
+        # the key. Other arguments only change their part of the URL.
+        fixed = []
+        variable = []
+        for k, v in sorted(kwargs.items()):
+            if k.startswith('_') or v is None or not isinstance(v, basestring):
+                fixed.append((k, v))
+            else:
+                variable.append(k)
+        key = (cdn, route, tuple(fixed), tuple(variable))
+
+        template = self.templates.get(key)
+        if template is None:
+            template = self.build_template(cdn, route, fixed, variable)
+            url = self._generate(cdn, route, **kwargs)
+            if template and self.fill(template, kwargs) != url:
+                # Our quoting doesn't match werkzeug's for this route,
+                # so don't use a template for it.
+                template = False
+            self.templates[key] = template
+            return url
+
+        if template is False:
+            return self._generate(cdn, route, **kwargs)
+        return self.fill(template, kwargs)
+
+    def _generate(self, cdn, route, **kwargs):
+        if cdn:
+            return cdn_url_for(route, **kwargs)
+        return url_for(route, **kwargs)
+
+    def build_template(self, cdn, route, fixed, variable):
+        """Build a template for a route.
+
+        :return: A 3-tuple (path, query, arguments), where `path` and
+            `query` are the parts of the URL before and after the
+            question mark, and `arguments` maps argument names to their
+            placeholders. Or False if a template can't be made.
+        """
+        placeholders = dict(
+            (name, self.PLACEHOLDER % i) for i, name in enumerate(variable)
+        )
+        kwargs = dict(fixed)
+        kwargs.update(placeholders)
+        try:
+            url = self._generate(cdn, route, **kwargs)
+        except Exception, e:
+            return False
+        path, question, query = url.partition('?')
+        for placeholder in placeholders.values():
+            if (path + query).count(placeholder) != 1:
+                return False
+        return path, query, placeholders
+
+    def fill(self, template, kwargs):
+        path, query, placeholders = template
+        for name, placeholder in placeholders.items():
+            value = kwargs[name]
+            if isinstance(value, unicode):
+                value = value.encode("utf8")
+            if placeholder in path:
+                path = path.replace(placeholder, url_quote(value))
+            else:
+                query = query.replace(placeholder, url_quote_plus(value))
+        if query:
+            return path + '?' + query
+        return path
+
 
 class CirculationManagerAnnotator(Annotator):
 
@@ -66,6 +175,7 @@ class CirculationManagerAnnotator(Annotator):
         self.active_holds_by_work = active_holds_by_work
         self.active_fulfillments_by_work = active_fulfillments_by_work
         self.test_mode = test_mode
+        self.url_templates = URLTemplates()
 
     def _lane_identifier(self, lane):
         if isinstance(lane, Lane):
@@ -89,13 +199,13 @@ class CirculationManagerAnnotator(Annotator):
                     new_kwargs[k] = v
             return self.test_url_for(False, *args, **new_kwargs)
         else:
-            return url_for(*args, **kwargs)
+            return self.url_templates.url_for(False, *args, **kwargs)
 
     def cdn_url_for(self, *args, **kwargs):
         if self.test_mode:
             return self.test_url_for(True, *args, **kwargs)
         else:
-            return cdn_url_for(*args, **kwargs)
+            return self.url_templates.url_for(True, *args, **kwargs)
 
     def test_url_for(self, cdn=False, *args, **kwargs):
         # Generate a plausible-looking URL that doesn't depend on Flask
@@ -534,35 +644,96 @@ class LibraryAnnotator(CirculationManagerAnnotator):
         if isinstance(self.lane, CrawlableCustomListBasedLane) and isinstance(work, BaseMaterializedWork):
             updated = max(work.last_update_time, work.first_appearance, work.availability_time)
 
+        links = self.work_entry_links(work, identifier, entry)
+
         # Add a link for reporting problems.
-        feed.add_link_to_entry(
-            entry,
-            rel='issues',
-            href=self.url_for(
-                'report',
-                identifier_type=identifier.type,
-                identifier=identifier.identifier,
-                library_short_name=self.library.short_name,
-                _external=True
-            )
-        )
+        feed.add_link_to_entry(entry, **links['report'])
 
         super(LibraryAnnotator, self).annotate_work_entry(
             work, active_license_pool, edition, identifier, feed, entry, updated
         )
 
         # Add a link for each author.
-        self.add_author_links(work, feed, entry)
+        author_tag = '{%s}author' % OPDSFeed.ATOM_NS
+        name_tag = '{%s}name' % OPDSFeed.ATOM_NS
+        for author_entry in entry.findall(author_tag):
+            link = links['authors'].get(author_entry.find(name_tag).text)
+            if link:
+                feed.add_link_to_entry(author_entry, **link)
 
         # And a series, if there is one.
+        if links['series']:
+            series_entry = entry.find(OPDSFeed.schema_('Series'))
+            feed.add_link_to_entry(series_entry, **links['series'])
+
+        # Then recommendations, related books and annotations.
+        for link in links['entry']:
+            feed.add_link_to_entry(entry, **link)
+
+    # The links in a work's entry that don't depend on the patron or
+    # the book's availability are kept here, so that the URLs don't
+    # have to be generated again every time the work shows up in a
+    # feed.
+    WORK_ENTRY_LINK_CACHE = LRUCache(max_size=50000, ttl=3600)
+
+    def work_entry_links(self, work, identifier, entry):
+        """Find or generate the patron-independent links for a work's
+        entry.
+
+        :return: A dictionary with the keyword arguments for
+            add_link_to_entry() for the 'report' link, the 'series'
+            link (or None), each author (keyed by name) and the other
+            links that go directly in the entry.
+        """
+        if self.test_mode or not flask.has_request_context():
+            url_root = None
+        else:
+            url_root = flask.request.url_root
+        key = (
+            url_root, self.library.id, self.library.short_name,
+            identifier.type, identifier.identifier, self.identifies_patrons
+        )
+
+        # If any of these change, the links need to change too.
+        author_tag = '{%s}author' % OPDSFeed.ATOM_NS
+        name_tag = '{%s}name' % OPDSFeed.ATOM_NS
+        author_names = tuple(
+            x.find(name_tag).text for x in entry.findall(author_tag)
+        )
+        has_series_tag = entry.find(OPDSFeed.schema_('Series')) is not None
+        cdns = tuple(sorted((Configuration.cdns() or {}).items()))
+        version = (
+            author_names, work.series, has_series_tag, work.sort_author,
+            work.language, work.audience,
+            NoveListAPI.is_configured(self.library), cdns
+        )
+
+        cached = self.WORK_ENTRY_LINK_CACHE.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        links = dict(
+            report=dict(
+                rel='issues',
+                href=self.url_for(
+                    'report',
+                    identifier_type=identifier.type,
+                    identifier=identifier.identifier,
+                    library_short_name=self.library.short_name,
+                    _external=True
+                )
+            ),
+            authors=self.author_links(work, author_names),
+            series=None,
+            entry=[],
+        )
         if work.series:
-            self.add_series_link(work, feed, entry)
+            links['series'] = self.series_link(work, has_series_tag)
 
         if NoveListAPI.is_configured(self.library):
             # If NoveList Select is configured, there might be
             # recommendations, too.
-            feed.add_link_to_entry(
-                entry,
+            links['entry'].append(dict(
                 rel='recommendations',
                 type=OPDSFeed.ACQUISITION_FEED_TYPE,
                 title='Recommended Works',
@@ -573,12 +744,11 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                     library_short_name=self.library.short_name,
                     _external=True
                 )
-            )
+            ))
 
         # Add a link for related books if available.
         if self.related_books_available(work, self.library):
-            feed.add_link_to_entry(
-                entry,
+            links['entry'].append(dict(
                 rel='related',
                 type=OPDSFeed.ACQUISITION_FEED_TYPE,
                 title='Recommended Works',
@@ -589,12 +759,11 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                     library_short_name=self.library.short_name,
                     _external=True
                 )
-            )
+            ))
 
         # Add a link to get a patron's annotations for this book.
         if self.identifies_patrons:
-            feed.add_link_to_entry(
-                entry,
+            links['entry'].append(dict(
                 rel="http://www.w3.org/ns/oa#annotationService",
                 type=AnnotationWriter.CONTENT_TYPE,
                 href=self.url_for(
@@ -604,7 +773,10 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                     library_short_name=self.library.short_name,
                     _external=True
                 )
-            )
+            ))
+
+        self.WORK_ENTRY_LINK_CACHE.set(key, (version, links))
+        return links
 
     @classmethod
     def related_books_available(cls, work, library):
@@ -639,17 +811,28 @@ class LibraryAnnotator(CirculationManagerAnnotator):
 
     def add_author_links(self, work, feed, entry):
         author_tag = '{%s}author' % OPDSFeed.ATOM_NS
+        name_tag = '{%s}name' % OPDSFeed.ATOM_NS
         author_entries = entry.findall(author_tag)
+        links = self.author_links(
+            work, [x.find(name_tag).text for x in author_entries]
+        )
+        for author_entry in author_entries:
+            link = links.get(author_entry.find(name_tag).text)
+            if link:
+                feed.add_link_to_entry(author_entry, **link)
 
+    def author_links(self, work, contributor_names):
+        """Create a 'contributor' link for each author.
+
+        :return: A dictionary mapping each name to the keyword
+            arguments for add_link_to_entry().
+        """
         languages, audiences = self.language_and_audience_key_from_work(work)
-        for author_entry in author_entries:
-            name_tag = '{%s}name' % OPDSFeed.ATOM_NS
-            contributor_name = author_entry.find(name_tag).text
-            if not contributor_name:
+        links = {}
+        for contributor_name in contributor_names:
+            if not contributor_name or contributor_name in links:
                 continue
-
-            feed.add_link_to_entry(
-                author_entry,
+            links[contributor_name] = dict(
                 rel='contributor',
                 type=OPDSFeed.ACQUISITION_FEED_TYPE,
                 title=contributor_name,
@@ -662,12 +845,23 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                     _external=True
                 )
             )
+        return links
 
     def add_series_link(self, work, feed, entry):
         series_tag = OPDSFeed.schema_('Series')
         series_entry = entry.find(series_tag)
+        link = self.series_link(work, series_entry is not None)
+        if link:
+            feed.add_link_to_entry(series_entry, **link)
 
-        if series_entry is None:
+    def series_link(self, work, has_series_tag):
+        """Create a 'series' link for a work.
+
+        :return: The keyword arguments for add_link_to_entry(), or
+            None if the work's entry has no <series> tag to put the
+            link in.
+        """
+        if not has_series_tag:
             # There is no <series> tag, and thus nothing to annotate.
             # This probably indicates an out-of-date OPDS entry.
             if isinstance(work, Work):
@@ -680,7 +874,7 @@ class LibraryAnnotator(CirculationManagerAnnotator):
                 'add_series_link() called on work %s ("%s"), which has no <schema:Series> tag in its OPDS entry.',
                 work_id, work_title
             )
-            return
+            return None
 
         series_name = work.series
         languages, audiences = self.language_and_audience_key_from_work(work)
@@ -692,8 +886,7 @@ class LibraryAnnotator(CirculationManagerAnnotator):
             library_short_name=self.library.short_name,
             _external=True,
         )
-        feed.add_link_to_entry(
-            series_entry,
+        return dict(
             rel='series',
             type=OPDSFeed.ACQUISITION_FEED_TYPE,
             title=series_name,
@@ -1213,18 +1406,39 @@ class SharedCollectionAnnotator(CirculationManagerAnnotator):
 
 class LibraryLoanAndHoldAnnotator(LibraryAnnotator):
 
+    # If the feed includes a DRM client token, a cached copy of the
+    # feed is only good for this many seconds. The token is good for
+    # an hour after it's issued, so a client that's told its copy is
+    # still current will have a token with at least half an hour left.
+    DRM_TOKEN_ETAG_PERIOD = 30 * 60
+
     @classmethod
     def active_loans_for(cls, circulation, patron, test_mode=False):
         db = Session.object_session(patron)
+        loans = cls.load_with_license_pools(
+            db.query(Loan).filter(Loan.patron_id==patron.id), Loan
+        ).options(joinedload(Loan.fulfillment))
+        holds = cls.load_with_license_pools(
+            db.query(Hold).filter(Hold.patron_id==patron.id), Hold
+        )
+
+        # Put the works in the feed in the same order as the loans
+        # and holds, without any duplicates.
+        works = []
         active_loans_by_work = {}
-        for loan in patron.loans:
+        for loan in loans:
             work = loan.work
             if work:
+                if work not in active_loans_by_work:
+                    works.append(work)
                 active_loans_by_work[work] = loan
         active_holds_by_work = {}
-        for hold in patron.holds:
+        for hold in holds:
             work = hold.work
             if work:
+                if (work not in active_loans_by_work
+                    and work not in active_holds_by_work):
+                    works.append(work)
                 active_holds_by_work[work] = hold
 
         annotator = cls(
@@ -1232,12 +1446,105 @@ class LibraryLoanAndHoldAnnotator(LibraryAnnotator):
             test_mode=test_mode
         )
         url = annotator.url_for('active_loans', library_short_name=patron.library.short_name, _external=True)
-        works = patron.works_on_loan_or_on_hold()
 
         feed_obj = AcquisitionFeed(db, "Active loans and holds", url, works, annotator)
         annotator.annotate_feed(feed_obj, None)
         return feed_obj
 
+    @classmethod
+    def active_loans_etag(cls, patron, *extra):
+        """Calculate an ETag for a patron's active loans feed.
+
+        This only looks at the database rows the feed is built from,
+        so it's much faster than building the feed. Two feeds with
+        the same ETag are equivalent, but not byte-for-byte identical,
+        so the ETag should be sent as a weak one.
+
+        :param extra: Anything else the feed depends on, such as the
+            last time the site configuration changed.
+        """
+        db = Session.object_session(patron)
+        pool_fields = [
+            LicensePool.id, LicensePool.licenses_owned,
+            LicensePool.licenses_available, LicensePool.licenses_reserved,
+            LicensePool.patrons_in_hold_queue, Work.id,
+            Work.last_update_time,
+        ]
+        loans = db.query(
+            Loan.id, Loan.start, Loan.end, Loan.fulfillment_id, *pool_fields
+        ).join(
+            LicensePool, LicensePool.id==Loan.license_pool_id
+        ).outerjoin(
+            Work, Work.id==LicensePool.work_id
+        ).filter(Loan.patron_id==patron.id).order_by(Loan.id)
+        holds = db.query(
+            Hold.id, Hold.start, Hold.end, Hold.position, *pool_fields
+        ).join(
+            LicensePool, LicensePool.id==Hold.license_pool_id
+        ).outerjoin(
+            Work, Work.id==LicensePool.work_id
+        ).filter(Hold.patron_id==patron.id).order_by(Hold.id)
+        loans = [tuple(x) for x in loans]
+        holds = [tuple(x) for x in holds]
+
+        # The feed lists the ways each book can be delivered.
+        pool_ids = set(x[4] for x in loans + holds)
+        mechanisms = []
+        if pool_ids:
+            lpdm = LicensePoolDeliveryMechanism
+            mechanisms = db.query(
+                LicensePool.id, lpdm.id, lpdm.delivery_mechanism_id,
+                lpdm.resource_id, lpdm.rights_status_id
+            ).join(
+                lpdm, and_(
+                    lpdm.identifier_id==LicensePool.identifier_id,
+                    lpdm.data_source_id==LicensePool.data_source_id
+                )
+            ).filter(
+                LicensePool.id.in_(pool_ids)
+            ).order_by(LicensePool.id, lpdm.id)
+            mechanisms = [tuple(x) for x in mechanisms]
+
+        # If the feed includes a DRM client token, the ETag changes
+        # often enough that no client keeps using an expired token.
+        token_period = None
+        if AuthdataUtility.from_config(patron.library):
+            token_period = int(time.time() / cls.DRM_TOKEN_ETAG_PERIOD)
+
+        fingerprint = repr((
+            patron.id, patron.library.short_name, extra, token_period,
+            loans, holds, mechanisms
+        ))
+        return hashlib.sha1(fingerprint).hexdigest()
+
+    @classmethod
+    def load_with_license_pools(cls, qu, model):
+        """Make a query for loans or holds also load everything that's
+        needed to build their works' feed entries.
+
+        Otherwise a patron with a lot of books would need several
+        queries for every book on their bookshelf.
+
+        :param model: Loan or Hold.
+        """
+        def pool():
+            return joinedload(model.license_pool)
+        def mechanisms():
+            return pool().subqueryload(LicensePool.delivery_mechanisms)
+        return qu.options(
+            pool().joinedload(LicensePool.identifier),
+            pool().joinedload(LicensePool.data_source),
+            pool().joinedload(LicensePool.presentation_edition),
+            pool().joinedload(LicensePool.work)
+                .joinedload(Work.presentation_edition)
+                .joinedload(Edition.primary_identifier),
+            mechanisms().joinedload(
+                LicensePoolDeliveryMechanism.delivery_mechanism
+            ),
+            mechanisms().joinedload(LicensePoolDeliveryMechanism.resource),
+            mechanisms().joinedload(LicensePoolDeliveryMechanism.rights_status),
+        )
+
     @classmethod
     def single_loan_feed(cls, circulation, loan, test_mode=False):
         db = Session.object_session(loan)
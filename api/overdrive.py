@@ -3,7 +3,10 @@ import datetime
 import json
 import requests
 import flask
+import threading
 import urlparse
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from flask_babel import lazy_gettext as _
 
 from sqlalchemy.orm import contains_eager
@@ -51,17 +54,38 @@ from core.metadata_layer import ReplacementPolicy
 from core.scripts import Script
 
 from circulation_exceptions import *
+from feed_cache import ChangedWorkQueue
+from util.rate_limit import RateLimiter
+from util.token_cache import AccessTokenCache
 from core.analytics import Analytics
 
 class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
 
     NAME = ExternalIntegration.OVERDRIVE
     DESCRIPTION = _("Integrate an Overdrive collection. For an Overdrive Advantage collection, select the consortium's Overdrive collection as the parent.")
+
+    # Settings that control how fast the circulation monitors ask
+    # Overdrive about availability.
+    MONITOR_WORKERS = "circulation_monitor_workers"
+    MONITOR_REQUESTS_PER_SECOND = "circulation_monitor_requests_per_second"
+
     SETTINGS = [
         { "key": Collection.EXTERNAL_ACCOUNT_ID_KEY, "label": _("Library ID") },
         { "key": BaseOverdriveAPI.WEBSITE_ID, "label": _("Website ID") },
         { "key": ExternalIntegration.USERNAME, "label": _("Client Key") },
         { "key": ExternalIntegration.PASSWORD, "label": _("Client Secret") },
+        { "key": MONITOR_WORKERS,
+          "label": _("Number of availability lookups to run at once"),
+          "description": _("The circulation monitors will look up this many books' availability at a time. If this is not set, books are looked up one at a time."),
+          "type": "number",
+          "optional": True,
+        },
+        { "key": MONITOR_REQUESTS_PER_SECOND,
+          "label": _("Maximum availability lookups per second"),
+          "description": _("Use this to keep the circulation monitors within Overdrive's API quota. If this is not set, there's no limit."),
+          "type": "number",
+          "optional": True,
+        },
     ] + BaseCirculationAPI.SETTINGS
 
     LIBRARY_SETTINGS = BaseCirculationAPI.LIBRARY_SETTINGS + [
@@ -80,6 +104,11 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
 
     SET_DELIVERY_MECHANISM_AT = BaseCirculationAPI.FULFILL_STEP
 
+    # Patrons' bearer tokens are kept in this process-wide cache,
+    # keyed by collection ID and patron ID, so that every request made
+    # on a patron's behalf doesn't have to look up their Credential.
+    PATRON_TOKENS = AccessTokenCache()
+
     # Create a lookup table between common DeliveryMechanism identifiers
     # and Overdrive format types.
     epub = Representation.EPUB_MEDIA_TYPE
@@ -163,8 +192,8 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
 
         The results are never cached.
         """
-        patron_credential = self.get_patron_credential(patron, pin)
-        headers = dict(Authorization="Bearer %s" % patron_credential.credential)
+        token = self.patron_access_token(patron, pin)
+        headers = dict(Authorization="Bearer %s" % token)
         headers.update(extra_headers)
         if method and method.lower() in ('get', 'post', 'put', 'delete'):
             method = method.lower()
@@ -184,8 +213,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
                 )
             else:
                 # Refresh the token and try again.
-                self.refresh_patron_access_token(
-                    patron_credential, patron, pin)
+                self.refresh_patron_access_token_once(patron, pin, token)
                 return self.patron_request(
                     patron, pin, url, extra_headers, data, True)
         else:
@@ -195,6 +223,31 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             # self.log.debug("%s: %s", url, response.status_code)
             return response
 
+    def patron_access_token(self, patron, pin):
+        """Find an OAuth bearer token for the given patron, from the
+        cache if possible.
+        """
+        return self.PATRON_TOKENS.get(
+            self._patron_token_key(patron),
+            lambda: self.get_patron_credential(patron, pin)
+        )
+
+    def refresh_patron_access_token_once(self, patron, pin, rejected_token):
+        """Replace a patron's bearer token after Overdrive rejected it.
+
+        If several requests are rejected at once, only one of them
+        gets a new token.
+        """
+        def refresh():
+            credential = self.get_patron_credential(patron, pin)
+            return self.refresh_patron_access_token(credential, patron, pin)
+        return self.PATRON_TOKENS.refresh(
+            self._patron_token_key(patron), rejected_token, refresh
+        )
+
+    def _patron_token_key(self, patron):
+        return (self.collection.id, patron.id)
+
     def get_patron_credential(self, patron, pin):
         """Create an OAuth token for the given patron."""
         def refresh(credential):
@@ -796,7 +849,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
             return True
         raise CannotReleaseHold(response.content)
 
-    def circulation_lookup(self, book):
+    def circulation_lookup(self, book, exception_on_401=False):
         if isinstance(book, basestring):
             book_id = book
             circulation_link = self.AVAILABILITY_ENDPOINT % dict(
@@ -807,7 +860,9 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
         else:
             book_id = book['id']
             circulation_link = book['availability_link']
-        return book, self.get(circulation_link, {})
+        return book, self.get(
+            circulation_link, {}, exception_on_401=exception_on_401
+        )
 
     def update_formats(self, licensepool):
         """Update the format information for a single book.
@@ -840,12 +895,30 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
         ensured for the Overdrive Identifier, and a Work will be
         created for the LicensePool and set as presentation-ready.
         """
-        # Retrieve current circulation information about this book
+        book = self.fetch_availability(book_id)
+        if book is None:
+            return None, None, False
+        return self.apply_availability(book)
+
+    def fetch_availability(self, book_id, exception_on_401=False):
+        """Retrieve current circulation information about a book.
+
+        :param exception_on_401: If this is True, this method only
+            talks to Overdrive, never to the database, so it's safe to
+            call from several threads at once. If the bearer token has
+            expired, an exception is raised instead of getting a new
+            token, and so is any other exception from the request.
+
+        :return: A dictionary of circulation information, or None if
+            the information couldn't be retrieved.
+        """
         try:
             book, (status_code, headers, content) = self.circulation_lookup(
-                book_id
+                book_id, exception_on_401=exception_on_401
             )
         except Exception, e:
+            if exception_on_401:
+                raise
             status_code = None
             self.log.error(
                 "HTTP exception communicating with Overdrive",
@@ -857,12 +930,19 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI, HasSelfTests):
                 "Could not get availability for %s: status code %s",
                 book_id, status_code
             )
-            return None, None, False
+            return None
 
         if isinstance(content, basestring):
             content = json.loads(content)
         book.update(content)
+        return book
+
+    def apply_availability(self, book):
+        """Update a book's LicensePool with circulation information
+        obtained from fetch_availability().
 
+        :return: A 3-tuple (LicensePool, is_new, is_changed).
+        """
         # Update book_id now that we know we have new data.
         book_id = book['id']
         license_pool, is_new = LicensePool.for_foreign_id(
@@ -1006,59 +1086,174 @@ class OverdriveCirculationMonitor(CollectionMonitor):
     # strict chronological order, but if you see 100 consecutive books
     # that haven't changed, you're probably done.
     MAXIMUM_CONSECUTIVE_UNCHANGED_BOOKS = None
-    
-    def __init__(self, _db, collection, api_class=OverdriveAPI):
+
+    # The number of books whose availability is looked up at once.
+    # These defaults can be overridden by the collection's
+    # integration settings or by the constructor.
+    WORKERS = 1
+
+    # The number of books to update before committing.
+    BATCH_SIZE = 100
+
+    # The maximum number of availability lookups per second, across
+    # all workers. None means there's no limit.
+    REQUESTS_PER_SECOND = None
+
+    def __init__(self, _db, collection, api_class=OverdriveAPI,
+                 workers=None, batch_size=None, requests_per_second=None):
         """Constructor."""
         super(OverdriveCirculationMonitor, self).__init__(_db, collection)
         self.api = api_class(_db, collection)
+        ChangedWorkQueue.watch(_db)
         self.maximum_consecutive_unchanged_books = (
             self.MAXIMUM_CONSECUTIVE_UNCHANGED_BOOKS
         )
         self.analytics = Analytics(_db)
-        
+
+        integration = collection.external_integration
+        if workers is None:
+            workers = integration.setting(
+                OverdriveAPI.MONITOR_WORKERS
+            ).int_value
+        if requests_per_second is None:
+            requests_per_second = integration.setting(
+                OverdriveAPI.MONITOR_REQUESTS_PER_SECOND
+            ).value
+            if requests_per_second:
+                requests_per_second = float(requests_per_second)
+        self.workers = workers or self.WORKERS
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.rate_limiter = RateLimiter(
+            requests_per_second or self.REQUESTS_PER_SECOND
+        )
+
     def recently_changed_ids(self, start, cutoff):
         return self.api.recently_changed_ids(start, cutoff)
 
+    def batches(self, books):
+        """Group a stream of books into lists of `batch_size`."""
+        batch = []
+        for book in books:
+            batch.append(book)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # Returned by fetch_availability() when a lookup should be tried
+    # again in the main thread.
+    RETRY = object()
+
+    def fetch_availability(self, book, stop=None):
+        """Look up a book's availability, respecting the rate limit.
+
+        This may be called from a worker thread, so it must not get a
+        new bearer token, which would mean writing to the database. If
+        the lookup fails with an exception, which is what happens when
+        the token has expired, RETRY is returned instead.
+
+        :param stop: A threading.Event. Once it's set, no more books
+            are looked up.
+        """
+        if not book or (stop and stop.is_set()):
+            return None
+        self.rate_limiter.wait()
+        try:
+            return self.api.fetch_availability(book, exception_on_401=True)
+        except Exception, e:
+            return self.RETRY
+
     def run_once(self, start, cutoff):
+        pool = None
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+        try:
+            self.process_books(self.recently_changed_ids(start, cutoff), pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def process_books(self, books, pool=None):
+        """Look up the availability of some books and apply it to their
+        LicensePools, committing after every batch.
+
+        :param pool: A ThreadPool to use for the lookups. Results are
+            still applied to the database one at a time, in order, in
+            this thread.
+        """
         _db = self._db
-        added_books = 0
-        overdrive_data_source = DataSource.lookup(
-            _db, DataSource.OVERDRIVE)
-
         total_books = 0
         consecutive_unchanged_books = 0
-        for i, book in enumerate(self.recently_changed_ids(start, cutoff)):
-            total_books += 1
-            if not total_books % 100:
-                self.log.info("%s books processed", total_books)
-            if not book:
-                continue
-            license_pool, is_new, is_changed = self.api.update_licensepool(book)
-            # Log a circulation event for this work.
-            if is_new:
-                for library in self.collection.libraries:
-                    self.analytics.collect_event(
-                        library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
+        finished = False
+
+        # Once this is set, the workers skip the rest of the batch
+        # instead of using up requests on books that won't be applied.
+        stop = threading.Event()
+        def fetch(book):
+            return self.fetch_availability(book, stop)
+
+        for batch in self.batches(books):
+            # The workers mustn't touch the database, so make sure
+            # they won't need to get a new bearer token partway
+            # through the batch.
+            self.api.check_creds()
+            self.api.collection_token
+
+            if pool:
+                results = pool.imap(fetch, batch)
+            else:
+                results = (fetch(book_id) for book_id in batch)
+
+            for book_id, book in izip(batch, results):
+                total_books += 1
+                if not total_books % 100:
+                    self.log.info("%s books processed", total_books)
+                if not book_id:
+                    continue
+                if book is self.RETRY:
+                    # The bearer token may have expired. It's safe to
+                    # get a new one here.
+                    self.rate_limiter.wait()
+                    book = self.api.fetch_availability(book_id)
+                if book:
+                    license_pool, is_new, is_changed = (
+                        self.api.apply_availability(book)
+                    )
+                else:
+                    license_pool, is_new, is_changed = None, None, False
 
-            _db.commit()
+                # Log a circulation event for this work.
+                if is_new:
+                    for library in self.collection.libraries:
+                        self.analytics.collect_event(
+                            library, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
 
-            if is_changed:
-                consecutive_unchanged_books = 0
-            else:
-                consecutive_unchanged_books += 1
-                if (self.maximum_consecutive_unchanged_books
-                    and consecutive_unchanged_books >= 
-                    self.maximum_consecutive_unchanged_books):
-                    # We're supposed to stop this run after finding a
-                    # run of books that have not changed, and we have
-                    # in fact seen that many consecutive unchanged
-                    # books.
-                    self.log.info("Stopping at %d unchanged books.",
-                                  consecutive_unchanged_books)
-                    break
+                if is_changed:
+                    consecutive_unchanged_books = 0
+                else:
+                    consecutive_unchanged_books += 1
+                    if (self.maximum_consecutive_unchanged_books
+                        and consecutive_unchanged_books >=
+                        self.maximum_consecutive_unchanged_books):
+                        # We're supposed to stop this run after finding a
+                        # run of books that have not changed, and we have
+                        # in fact seen that many consecutive unchanged
+                        # books.
+                        self.log.info("Stopping at %d unchanged books.",
+                                      consecutive_unchanged_books)
+                        stop.set()
+                        finished = True
+                        break
+
+            _db.commit()
+            if finished:
+                break
 
         if total_books:
             self.log.info("Processed %d books total.", total_books)
+        return total_books
 
 
 class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
@@ -5,7 +5,10 @@ from api.authenticator import (
     BasicAuthenticationProvider,
     PatronData,
 )
-from api.sip.client import SIPClient
+from api.sip.client import (
+    SIPClient,
+    SIPClientPool,
+)
 from core.util.http import RemoteIntegrationException
 from core.util import MoneyUtility
 from core.model import ExternalIntegration
@@ -20,6 +23,7 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
     PORT = "port"
     LOCATION_CODE = "location code"
     FIELD_SEPARATOR = "field separator"
+    CONNECTION_POOL_SIZE = "connection pool size"
     
     SETTINGS = [
         { "key": ExternalIntegration.URL, "label": _("Server") },
@@ -30,6 +34,12 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         { "key": FIELD_SEPARATOR, "label": _("Field Separator"),
           "default": "|",
         },
+        { "key": CONNECTION_POOL_SIZE,
+          "label": _("Maximum number of simultaneous connections"),
+          "description": _("If this is more than one, the circulation manager will keep up to this many logged-in connections open to the SIP server, so that patrons can be authenticated in parallel."),
+          "type": "number",
+          "optional": True,
+        },
     ] + BasicAuthenticationProvider.SETTINGS
     
     # Map the reasons why SIP2 might report a patron is blocked to the
@@ -97,12 +107,20 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
                 location_code = integration.setting(self.LOCATION_CODE).value
                 field_separator = integration.setting(
                     self.FIELD_SEPARATOR).value or '|'
-                client = SIPClient(
+                pool_size = integration.setting(
+                    self.CONNECTION_POOL_SIZE).int_value
+                client_kwargs = dict(
                     target_server=server, target_port=port,
                     login_user_id=login_user_id, login_password=login_password,
                     location_code=location_code, separator=field_separator,
-                    connect=connect
                 )
+                if pool_size and pool_size > 1:
+                    # Connections will be opened as they're needed.
+                    client = SIPClientPool.for_configuration(
+                        pool_size, **client_kwargs
+                    )
+                else:
+                    client = SIPClient(connect=connect, **client_kwargs)
 
         except IOError, e:
             raise RemoteIntegrationException(
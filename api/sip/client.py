@@ -76,6 +76,16 @@ fixed._add('fine_items_count', 4)
 fixed._add('recall_items_count', 4)
 fixed._add('unavailable_holds_count', 4)
 fixed._add('login_ok', 1)
+fixed._add('online_status', 1)
+fixed._add('checkin_ok', 1)
+fixed._add('checkout_ok', 1)
+fixed._add('acs_renewal_policy', 1)
+fixed._add('status_update_ok', 1)
+fixed._add('offline_ok', 1)
+fixed._add('timeout_period', 3)
+fixed._add('retries_allowed', 3)
+fixed._add('date_time_sync', 18)
+fixed._add('protocol_version', 4)
 
 class named(object):
     """A variable-length field in a SIP2 response."""
@@ -148,6 +158,9 @@ named._add("home_address", "BD")
 named._add("email_address", "BE")
 named._add("phone_number", "BF")
 named._add("sequence_number", "AY")
+named._add("library_name", "AM")
+named._add("supported_messages", "BX")
+named._add("terminal_location", "AN")
 
 # The spec doesn't say there can be more than one screen message,
 # but I have seen it happen.
@@ -291,6 +304,15 @@ class SIPClient(Constants):
             self.patron_information_request, self.patron_information_parser,
             *args, **kwargs
         )
+
+    def sc_status(self, *args, **kwargs):
+        """Tell the SIP server we're here, and find out whether it's
+        online.
+        """
+        return self.make_request(
+            self.sc_status_message, self.acs_status_parser,
+            *args, **kwargs
+        )
             
     def connect(self):
         """Create a socket connection to a SIP server."""
@@ -312,6 +334,17 @@ class SIPClient(Constants):
             self.socket = sock
         return sock
 
+    def disconnect(self):
+        """Close the socket connection to the SIP server, if any."""
+        with self.socket_lock:
+            sock = getattr(self, 'socket', None)
+            if sock:
+                try:
+                    sock.close()
+                except socket.error, e:
+                    pass
+            self.socket = None
+
     def reset_connection_state(self):
         """Reset connection-specific state.
 
@@ -344,15 +377,10 @@ class SIPClient(Constants):
         else:
             fail_on_network_error = False
 
-        if (self.must_log_in and not self.logged_in
-            and message_creator != self.login_message):
+        if message_creator != self.login_message:
             # The first thing we need to do is log in.
-            response = self.login(self.login_user_id, self.login_password,
-                                  self.location_code)
-            if response['login_ok'] != '1':
-                raise IOError("Error logging in: %r" % response)
-            self.logged_in = True
-        
+            self.ensure_logged_in()
+
         original_message = message_creator(*args, **kwargs)
         message_with_checksum = self.append_checksum(original_message)
         parsed = None
@@ -385,6 +413,19 @@ class SIPClient(Constants):
         return parsed
         
 
+    def ensure_logged_in(self):
+        """Log in to the SIP server if that's necessary and hasn't
+        happened yet on this connection.
+        """
+        with self.socket_lock:
+            if not self.must_log_in or self.logged_in:
+                return
+            response = self.login(self.login_user_id, self.login_password,
+                                  self.location_code)
+            if response['login_ok'] != '1':
+                raise IOError("Error logging in: %r" % response)
+            self.logged_in = True
+
     def login_message(self, login_user_id, login_password, location_code="",
                       uid_algorithm="0",
                       pwd_algorithm="0"):
@@ -405,6 +446,38 @@ class SIPClient(Constants):
             fixed.login_ok
         )
 
+    def sc_status_message(self, status_code="0", max_print_width="000",
+                          protocol_version="2.00"):
+        """Generate an SC Status message, which tells the SIP server
+        our status and asks for its status in return.
+        """
+        return "99" + status_code + max_print_width + protocol_version
+
+    def acs_status_parser(self, message):
+        """Parse the ACS Status message sent in response to an SC
+        Status message.
+        """
+        return self.parse_response(
+            message,
+            98,
+            fixed.online_status,
+            fixed.checkin_ok,
+            fixed.checkout_ok,
+            fixed.acs_renewal_policy,
+            fixed.status_update_ok,
+            fixed.offline_ok,
+            fixed.timeout_period,
+            fixed.retries_allowed,
+            fixed.date_time_sync,
+            fixed.protocol_version,
+            named.institution_id.required,
+            named.library_name,
+            named.supported_messages,
+            named.terminal_location,
+            named.screen_message,
+            named.print_line,
+        )
+
     def patron_information_request(
             self, patron_identifier, patron_password="", institution_id="",
             terminal_password="",
@@ -760,20 +833,256 @@ class SIPClient(Constants):
         return text      
 
 
+class SIPClientPool(object):
+    """A pool of logged-in connections to a single SIP server.
+
+    A SIPClient can only handle one request at a time, so when many
+    patrons are authenticating at once, they all wait in line for the
+    same socket. A SIPClientPool keeps up to `size` SIPClients open,
+    so that up to `size` requests can run in parallel.
+    """
+
+    log = logging.getLogger("SIPClientPool")
+
+    # Pools shared by every SIP2AuthenticationProvider in this
+    # process, keyed by the configuration of the SIP server.
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, size=5, max_idle=300, max_lifetime=3600,
+                 health_check_interval=60, checkout_timeout=30,
+                 client_factory=None, **client_kwargs):
+        """Constructor.
+
+        :param size: The maximum number of simultaneous connections.
+        :param max_idle: A connection that goes unused for this many
+            seconds will be closed.
+        :param max_lifetime: A connection will be closed once it's
+            this many seconds old, no matter how much it's being used.
+        :param health_check_interval: A connection that has been idle
+            for this many seconds will be checked with an SC Status
+            message before it's used.
+        :param checkout_timeout: How long to wait for a connection to
+            become available before giving up.
+        :param client_factory: A callable that creates a SIPClient.
+        :param client_kwargs: Keyword arguments to `client_factory`.
+        """
+        self.size = size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.client_factory = client_factory or SIPClient
+        self.client_kwargs = client_kwargs
+        self.target_server = client_kwargs.get('target_server')
+
+        # SIPClients that are open and not currently in use.
+        self.idle = []
+
+        # The total number of open SIPClients, idle or not.
+        self.open_connections = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def for_configuration(cls, size, **client_kwargs):
+        """Find or create the pool for a SIP server configuration."""
+        key = (size,) + tuple(sorted(client_kwargs.items()))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls(size=size, **client_kwargs)
+                cls._pools[key] = pool
+            return pool
+
+    def patron_information(self, *args, **kwargs):
+        return self.make_request('patron_information', *args, **kwargs)
+
+    def sc_status(self, *args, **kwargs):
+        return self.make_request('sc_status', *args, **kwargs)
+
+    def make_request(self, method_name, *args, **kwargs):
+        """Check out a connection and use it to send a request.
+
+        :param method_name: The name of a SIPClient method, such as
+            'patron_information', that sends a request and parses the
+            response.
+        """
+        client = self.checkout()
+        try:
+            result = getattr(client, method_name)(*args, **kwargs)
+        except Exception, e:
+            # We don't know what state this connection is in, so
+            # don't use it again.
+            self.checkin(client, discard=True)
+            raise
+        self.checkin(client)
+        return result
+
+    def warm(self):
+        """Open and log in connections until the pool is full."""
+        clients = []
+        try:
+            while True:
+                with self.condition:
+                    if self.open_connections >= self.size:
+                        break
+                clients.append(self.checkout())
+        finally:
+            for client in clients:
+                self.checkin(client)
+
+    def checkout(self):
+        """Get a logged-in connection to the SIP server, waiting if
+        all the connections are in use.
+
+        The connection must be returned with checkin().
+        """
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            client = None
+            create = False
+            with self.condition:
+                while not self.idle and self.open_connections >= self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise IOError(
+                            "Timed out waiting for a connection to %s" %
+                            self.target_server
+                        )
+                    self.condition.wait(remaining)
+                if self.idle:
+                    # Use the most recently used connection, so that
+                    # seldom-used connections age out.
+                    client = self.idle.pop()
+                else:
+                    self.open_connections += 1
+                    create = True
+
+            if create:
+                try:
+                    return self.create_client()
+                except Exception, e:
+                    self._forget()
+                    raise
+
+            now = time.time()
+            if self.is_expired(client, now):
+                self._close(client)
+                continue
+            if now - client.pool_last_used > self.health_check_interval:
+                if not self.is_healthy(client):
+                    self._close(client)
+                    continue
+            return client
+
+    def checkin(self, client, discard=False):
+        """Return a connection to the pool.
+
+        :param discard: If this is true, the connection is closed
+            instead of being reused.
+        """
+        now = time.time()
+        if discard or self.is_expired(client, now):
+            self._close(client)
+        else:
+            client.pool_last_used = now
+            with self.condition:
+                self.idle.append(client)
+                self.condition.notify()
+        self.evict_idle(now)
+
+    def evict_idle(self, now=None):
+        """Close every idle connection that has outlived its welcome."""
+        now = now or time.time()
+        with self.condition:
+            expired = [x for x in self.idle if self.is_expired(x, now)]
+            for client in expired:
+                self.idle.remove(client)
+        for client in expired:
+            self._close(client)
+
+    def create_client(self):
+        """Open a new connection to the SIP server and log in."""
+        client = self.client_factory(**self.client_kwargs)
+        client.ensure_logged_in()
+        client.pool_created = client.pool_last_used = time.time()
+        return client
+
+    def is_expired(self, client, now):
+        """Is the given connection too old, or has it been idle for
+        too long?
+        """
+        return (
+            now - client.pool_created > self.max_lifetime
+            or now - client.pool_last_used > self.max_idle
+        )
+
+    def is_healthy(self, client):
+        """Send an SC Status message over the given connection to make
+        sure the SIP server is still listening.
+        """
+        try:
+            status = client.sc_status(fail_on_network_error=True)
+        except (IOError, socket.error), e:
+            self.log.info(
+                "Discarding connection to %s after failed health check: %s",
+                self.target_server, e
+            )
+            return False
+        return status.get('online_status') == 'Y'
+
+    def _close(self, client):
+        client.disconnect()
+        self._forget()
+
+    def _forget(self):
+        with self.condition:
+            self.open_connections -= 1
+            self.condition.notify()
+
+
 class MockSIPClient(SIPClient):
     """A SIP client that relies on canned responses rather than a socket
     connection.
     """
     
-    def __init__(self, login_user_id=None, login_password=None, separator="|"):
-        self.status = []
+    def __init__(self, login_user_id=None, login_password=None, separator="|",
+                 shared_with=None):
+        """Constructor.
+
+        :param shared_with: Another MockSIPClient. If this is
+            provided, this client will share its queue of responses,
+            its record of requests, and its status log.
+        """
+        if shared_with:
+            self.status = shared_with.status
+        else:
+            self.status = []
         super(MockSIPClient, self).__init__(
             None, None, login_user_id=login_user_id,
             login_password=login_password, separator=separator
         )
-        self.requests = []
-        self.responses = []
-        
+        if shared_with:
+            self.requests = shared_with.requests
+            self.responses = shared_with.responses
+        else:
+            self.requests = []
+            self.responses = []
+
+    @classmethod
+    def pooled(cls, size=2, **kwargs):
+        """Create a SIPClientPool of MockSIPClients.
+
+        All the clients in the pool share the queue of responses of
+        the MockSIPClient found in the pool's `mock` attribute.
+        """
+        mock = cls(**kwargs)
+        def factory(**ignore):
+            return cls(shared_with=mock, **kwargs)
+        pool = SIPClientPool(size=size, client_factory=factory)
+        pool.mock = mock
+        return pool
+
     def queue_response(self, response):
         self.responses.append(response)
 
@@ -788,9 +1097,7 @@ class MockSIPClient(SIPClient):
     
     def read_message(self):
         """Read a response message off the queue."""
-        response = self.responses[0]
-        self.responses = self.responses[1:]
-        return response
+        return self.responses.pop(0)
         
 
 class CannotSendMockSIPClient(MockSIPClient):
@@ -0,0 +1,480 @@
+"""Send a large number of SIP2 requests from a single thread.
+
+SIPClient sends a request and then blocks until the response comes
+back. That's fine when one patron is signing in, but a batch job
+that looks up hundreds of thousands of patrons spends nearly all of
+its time waiting on the network.
+
+SIPPipeline keeps several non-blocking connections open to each SIP
+server it talks to, and uses select() to keep a request in flight on
+every one of them at once. SIP2 only allows one outstanding request
+per connection, so the amount of concurrency is controlled by the
+number of connections per server.
+
+Messages are built, and responses parsed, by ordinary SIPClient
+objects that never touch the network themselves, so the pipeline
+speaks exactly the same dialect of SIP2 as the rest of the
+circulation manager.
+"""
+import errno
+import logging
+import select
+import socket
+import time
+from collections import deque
+from nose.tools import set_trace
+
+from api.sip.client import (
+    RequestResend,
+    SIPClient,
+)
+
+
+class SIPRequest(object):
+    """A single request waiting to be sent by a SIPPipeline."""
+
+    def __init__(self, server, method_name, args, kwargs, tag=None):
+        self.server = server
+        self.method_name = method_name
+        self.args = args
+        self.kwargs = kwargs
+        self.tag = tag
+        self.attempts = 0
+
+
+class SIPServer(object):
+    """The requests and connections a SIPPipeline has for one
+    SIP server.
+    """
+
+    def __init__(self, client_kwargs):
+        self.client_kwargs = client_kwargs
+        self.queue = deque()
+        self.connections = []
+
+        # The number of times in a row we've failed to open a
+        # working connection to this server.
+        self.connection_failures = 0
+
+    @property
+    def available_connections(self):
+        """How many connections are, or soon will be, ready to send
+        a request?
+        """
+        return len([x for x in self.connections
+                    if x.state != SIPConnection.WAITING])
+
+
+class SIPConnection(object):
+    """One non-blocking connection to a SIP server."""
+
+    # The states a connection goes through.
+    CONNECTING = "connecting"
+    LOGGING_IN = "logging in"
+    IDLE = "idle"
+    WAITING = "waiting for response"
+
+    def __init__(self, server, client, sock):
+        self.server = server
+        self.client = client
+        self.socket = sock
+        self.state = self.CONNECTING
+        self.outgoing = ""
+        self.incoming = ""
+        self.request = None
+        self.original_message = None
+        self.parser = None
+        self.deadline = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send(self, message, parser, timeout):
+        """Start sending a message.
+
+        :param message: The message, without checksum or sequence
+            number.
+        :param parser: The SIPClient method that will parse the
+            response.
+        """
+        self.original_message = message
+        self.parser = parser
+        self._queue_outgoing(self.client.append_checksum(message), timeout)
+
+    def resend(self, timeout):
+        """Send the previous message again, at the server's request.
+
+        As in SIPClient, the checksum is recalculated but the
+        sequence number is not included.
+        """
+        self._queue_outgoing(
+            self.client.append_checksum(
+                self.original_message, include_sequence_number=False
+            ), timeout
+        )
+
+    def _queue_outgoing(self, data, timeout):
+        self.outgoing = data + '\r'
+        self.incoming = ""
+        self.deadline = time.time() + timeout
+
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error, e:
+            pass
+
+
+class SIPPipeline(object):
+    """Keep many SIP2 requests in flight at once, across any number of
+    SIP servers, from a single thread.
+
+    Usage:
+
+        pipeline = SIPPipeline(connections_per_server=8)
+        for barcode in barcodes:
+            pipeline.patron_information(client_kwargs, barcode, tag=barcode)
+        for barcode, response in pipeline.run():
+            ...
+
+    `client_kwargs` are the keyword arguments you'd pass into the
+    SIPClient constructor. Each response is either the dictionary
+    SIPClient would have returned, or the IOError SIPClient would have
+    raised.
+    """
+
+    log = logging.getLogger("SIP pipeline")
+
+    # The requests a pipeline knows how to send, mapped to the
+    # SIPClient methods that create the message and parse the
+    # response.
+    MESSAGES = {
+        'patron_information' : (
+            'patron_information_request', 'patron_information_parser'
+        ),
+        'sc_status' : ('sc_status_message', 'acs_status_parser'),
+    }
+
+    def __init__(self, connections_per_server=4, timeout=12,
+                 max_attempts=2, client_class=SIPClient):
+        """Constructor.
+
+        :param connections_per_server: The maximum number of
+            connections to open to any one SIP server.
+        :param timeout: The number of seconds to wait for a connection
+            to open or for a response to arrive.
+        :param max_attempts: The number of times to try a request, or
+            to try connecting to a server, before giving up.
+        :param client_class: The SIPClient subclass used to build and
+            parse messages.
+        """
+        self.connections_per_server = connections_per_server
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.client_class = client_class
+        self.servers = {}
+        self.finished = deque()
+        self.outstanding = 0
+
+    def patron_information(self, client_kwargs, *args, **kwargs):
+        """Queue a patron information request.
+
+        :param tag: An optional value that will be yielded by run()
+            alongside the response.
+        """
+        return self.queue(client_kwargs, 'patron_information', *args, **kwargs)
+
+    def sc_status(self, client_kwargs, *args, **kwargs):
+        """Queue an SC Status request."""
+        return self.queue(client_kwargs, 'sc_status', *args, **kwargs)
+
+    def queue(self, client_kwargs, method_name, *args, **kwargs):
+        """Queue a request to be sent the next time run() is called.
+
+        :param method_name: One of the keys of MESSAGES.
+        :return: A SIPRequest.
+        """
+        if method_name not in self.MESSAGES:
+            raise ValueError("Unknown SIP request: %s" % method_name)
+        tag = kwargs.pop('tag', None)
+        key = tuple(sorted(client_kwargs.items()))
+        server = self.servers.get(key)
+        if not server:
+            server = SIPServer(dict(client_kwargs))
+            self.servers[key] = server
+        request = SIPRequest(server, method_name, args, kwargs, tag)
+        server.queue.append(request)
+        self.outstanding += 1
+        return request
+
+    def run(self):
+        """Send every queued request.
+
+        :yield: A 2-tuple (tag, response) for every request, in the
+            order the responses arrive.
+        """
+        try:
+            while self.outstanding or self.finished:
+                while self.finished:
+                    yield self.finished.popleft()
+                if not self.outstanding:
+                    break
+                for server in self.servers.values():
+                    self.open_connections(server)
+                    self.start_requests(server)
+                self.poll()
+                self.check_deadlines()
+        finally:
+            self.close()
+
+    def close(self):
+        """Close every open connection."""
+        for server in self.servers.values():
+            for connection in list(server.connections):
+                self._discard(connection)
+
+    @property
+    def connections(self):
+        for server in self.servers.values():
+            for connection in server.connections:
+                yield connection
+
+    def open_connections(self, server):
+        """Open as many new connections to `server` as will be useful."""
+        while (len(server.queue) > server.available_connections
+               and len(server.connections) < self.connections_per_server):
+            connection = self.connect(server)
+            if not connection:
+                break
+
+    def connect(self, server):
+        """Start opening a non-blocking connection to a SIP server.
+
+        :return: A SIPConnection, or None if the connection could not
+            be started.
+        """
+        client = self.client_class(connect=False, **server.client_kwargs)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            error = sock.connect_ex((client.target_server, client.target_port))
+        except (socket.error, TypeError), e:
+            error = e
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.connection_failed(
+                server, "Could not connect to %s:%s: %s" % (
+                    client.target_server, client.target_port, error
+                )
+            )
+            return None
+        client.reset_connection_state()
+        connection = SIPConnection(server, client, sock)
+        connection.deadline = time.time() + self.timeout
+        server.connections.append(connection)
+        return connection
+
+    def start_requests(self, server):
+        """Send the next queued request on every idle connection."""
+        for connection in server.connections:
+            if not server.queue:
+                break
+            if connection.state != SIPConnection.IDLE:
+                continue
+            request = server.queue.popleft()
+            creator, parser = self.MESSAGES[request.method_name]
+            client = connection.client
+            try:
+                message = getattr(client, creator)(
+                    *request.args, **request.kwargs
+                )
+            except Exception, e:
+                self.finish(request, e)
+                continue
+            request.attempts += 1
+            connection.request = request
+            connection.state = SIPConnection.WAITING
+            connection.send(message, getattr(client, parser), self.timeout)
+
+    def poll(self):
+        """Wait for at least one connection to become readable or
+        writable, and deal with whatever happened.
+        """
+        readers = []
+        writers = []
+        deadlines = []
+        for connection in self.connections:
+            if connection.state == SIPConnection.CONNECTING or connection.outgoing:
+                writers.append(connection)
+            elif connection.state != SIPConnection.IDLE:
+                readers.append(connection)
+            if connection.deadline and connection.state != SIPConnection.IDLE:
+                deadlines.append(connection.deadline)
+        if not readers and not writers:
+            return
+        wait = max(0, min(deadlines) - time.time()) if deadlines else None
+        try:
+            readable, writable, ignore = select.select(
+                readers, writers, [], wait
+            )
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for connection in writable:
+            self.handle_writable(connection)
+        for connection in readable:
+            if connection in connection.server.connections:
+                self.handle_readable(connection)
+
+    def handle_writable(self, connection):
+        if connection.state == SIPConnection.CONNECTING:
+            error = connection.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_ERROR
+            )
+            if error:
+                self.network_error(connection, socket.error(
+                    error, "Could not connect to %s:%s" % (
+                        connection.client.target_server,
+                        connection.client.target_port
+                    )
+                ))
+                return
+            self.connected(connection)
+            return
+        try:
+            sent = connection.socket.send(connection.outgoing)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.network_error(connection, e)
+            return
+        connection.outgoing = connection.outgoing[sent:]
+
+    def handle_readable(self, connection):
+        try:
+            data = connection.socket.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.network_error(connection, e)
+            return
+        if not data:
+            self.network_error(
+                connection, IOError("No data read from socket.")
+            )
+            return
+        connection.incoming += data
+        if len(connection.incoming) > 1024*1024:
+            self.network_error(
+                connection, IOError("SIP2 response too large.")
+            )
+            return
+        if connection.incoming[-1] in '\r\n':
+            self.handle_response(connection, connection.incoming)
+
+    def connected(self, connection):
+        """A connection has been established. Log in, if necessary."""
+        client = connection.client
+        if client.must_log_in and not client.logged_in:
+            connection.state = SIPConnection.LOGGING_IN
+            message = client.login_message(
+                client.login_user_id, client.login_password,
+                client.location_code
+            )
+            connection.send(message, client.login_response_parser,
+                            self.timeout)
+        else:
+            self.ready(connection)
+
+    def ready(self, connection):
+        connection.server.connection_failures = 0
+        connection.state = SIPConnection.IDLE
+        connection.request = None
+        connection.deadline = None
+
+    def handle_response(self, connection, response):
+        """A complete response has arrived on a connection."""
+        try:
+            parsed = connection.parser(response)
+        except RequestResend, e:
+            connection.resend(self.timeout)
+            return
+        except IOError, e:
+            parsed = e
+
+        if connection.state == SIPConnection.LOGGING_IN:
+            if isinstance(parsed, IOError) or parsed.get('login_ok') != '1':
+                # Trying again won't help -- the credentials are wrong.
+                self._discard(connection)
+                connection.server.connection_failures = self.max_attempts
+                self.connection_failed(
+                    connection.server, "Error logging in: %r" % parsed
+                )
+                return
+            connection.client.logged_in = True
+            self.ready(connection)
+            return
+
+        request = connection.request
+        self.ready(connection)
+        self.finish(request, parsed)
+
+    def check_deadlines(self):
+        """Give up on any connection that's been waiting too long."""
+        now = time.time()
+        for connection in list(self.connections):
+            if (connection.state != SIPConnection.IDLE
+                and connection.deadline and connection.deadline <= now):
+                self.network_error(
+                    connection, IOError(
+                        "Timed out waiting for %s:%s" % (
+                            connection.client.target_server,
+                            connection.client.target_port
+                        )
+                    )
+                )
+
+    def network_error(self, connection, exception):
+        """Something went wrong with a connection. Close it and
+        either retry or give up on whatever it was doing.
+        """
+        self.log.warn(
+            "Network error talking to %s:%s: %s",
+            connection.client.target_server, connection.client.target_port,
+            exception
+        )
+        self._discard(connection)
+        request = connection.request
+        if connection.state in (SIPConnection.CONNECTING,
+                                SIPConnection.LOGGING_IN):
+            self.connection_failed(connection.server, str(exception))
+        elif request:
+            if request.attempts < self.max_attempts:
+                # Try again on a fresh connection.
+                connection.server.queue.appendleft(request)
+            else:
+                if not isinstance(exception, IOError):
+                    exception = IOError(str(exception))
+                self.finish(request, exception)
+
+    def connection_failed(self, server, message):
+        """We couldn't get a working connection to a server. If that's
+        happened too many times, give up on everything queued for it.
+        """
+        server.connection_failures += 1
+        if (server.connection_failures < self.max_attempts
+            or server.available_connections):
+            return
+        self.log.error(message)
+        while server.queue:
+            self.finish(server.queue.popleft(), IOError(message))
+
+    def finish(self, request, response):
+        self.outstanding -= 1
+        self.finished.append((request.tag, response))
+
+    def _discard(self, connection):
+        connection.close()
+        if connection in connection.server.connections:
+            connection.server.connections.remove(connection)
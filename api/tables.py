@@ -0,0 +1,101 @@
+"""Database tables that belong to the circulation manager rather than
+to core.
+
+Every table the circulation manager adds is declared here, on core's
+Base.metadata, so that SessionManager.initialize creates it for new
+databases (including the test database). Existing databases get each
+table, and any later change to it, from a migration in migration/,
+which is named in the comment above the table. Nothing creates or
+alters these tables at runtime.
+
+The modules that use a table import it from here.
+"""
+from nose.tools import set_trace
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    Index,
+    Table,
+    Unicode,
+)
+from sqlalchemy.dialects.postgresql import JSON
+
+from core.model import Base
+
+# Snapshots of the admin dashboard's numbers, saved by
+# bin/refresh_dashboard_stats. See api/admin/dashboard_stats.py.
+#
+# migration/20180701-1-create-dashboardstats.sql,
+# migration/20180701-5-dashboardstats-data-is-json.sql
+dashboard_stats_table = Table(
+    'dashboardstats', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('timestamp', DateTime, nullable=False),
+    Column('collection_id', Integer, index=True),
+    Column('library_id', Integer, index=True),
+    Column('data', JSON, nullable=False),
+)
+
+# Works whose availability has changed, so that cached lane feeds
+# containing them can be regenerated. See api/feed_cache.py.
+#
+# migration/20180701-2-create-changedworks.sql
+changed_works_table = Table(
+    'changedworks', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('work_id', Integer, nullable=False, index=True),
+    Column('timestamp', DateTime, nullable=False, index=True),
+)
+
+# The compacted JSON-LD for each annotation's target and body, so they
+# don't have to be compacted every time the annotation is read. See
+# api/annotations.py.
+#
+# migration/20180701-3-create-compactedannotations.sql,
+# migration/20180701-6-compactedannotations-cascade.sql
+compacted_annotations_table = Table(
+    'compactedannotations', Base.metadata,
+    Column('annotation_id', Integer,
+           ForeignKey('annotations.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('target', Unicode),
+    Column('body', Unicode),
+)
+
+# Lanes whose sizes need to be recalculated by bin/update_lane_sizes.
+# See api/admin/lane_sizes.py.
+#
+# migration/20180701-4-create-stalelanesizes.sql
+stale_lane_sizes_table = Table(
+    'stalelanesizes', Base.metadata,
+    Column('lane_id', Integer, primary_key=True),
+    Column('timestamp', DateTime, nullable=False),
+)
+
+# Patron logins that were recently checked with the source of truth,
+# so they don't have to be checked again on every request. Every
+# process on every server shares these. See
+# BasicAuthenticationProvider in api/authenticator.py.
+#
+# migration/20180701-7-create-credentialcache.sql
+credential_cache_table = Table(
+    'credentialcache', Base.metadata,
+    Column('key', Unicode, primary_key=True),
+    Column('integration_id', Integer,
+           ForeignKey('externalintegrations.id', ondelete='CASCADE'),
+           nullable=False, index=True),
+    Column('library_id', Integer,
+           ForeignKey('libraries.id', ondelete='CASCADE'),
+           nullable=False),
+    Column('identifier', Unicode, nullable=False),
+    Column('failed', Boolean, nullable=False),
+    Column('patron_data', JSON),
+    Column('expires', DateTime, nullable=False, index=True),
+    Column('hits', Integer, nullable=False, default=0),
+    Index('ix_credentialcache_library_id_identifier',
+          'library_id', 'identifier'),
+)
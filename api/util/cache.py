@@ -0,0 +1,197 @@
+"""Simple key-value caches with per-entry expiration times.
+
+LRUCache keeps its entries in the memory of a single process.
+SQLiteCache keeps its entries in a SQLite database on local disk,
+so that every worker process on a host can share them.
+
+Both classes implement the same small interface (get, set, delete,
+clear), so code that needs a cache can accept either one.
+"""
+import cPickle as pickle
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe, in-process cache that holds a limited number of
+    entries, discarding the least recently used entry when it fills up.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """Constructor.
+
+        :param max_size: The maximum number of entries to keep.
+        :param ttl: The default number of seconds an entry remains
+            valid. None means entries never expire.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Look up the value for `key`, if it hasn't expired."""
+        now = time.time()
+        with self.lock:
+            if key not in self.entries:
+                return default
+            expires, value = self.entries.pop(key)
+            if expires is not None and expires <= now:
+                return default
+            # Put the entry back at the most-recently-used end.
+            self.entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`.
+
+        :param ttl: The number of seconds the entry should remain
+            valid, if different from the cache's default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the entry for `key`, if there is one."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        """Is there an unexpired entry for `key`?
+
+        Unlike get(), this doesn't count as a use of the entry.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return False
+            expires, value = self.entries[key]
+        return expires is None or expires > time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteCache(object):
+    """A cache stored in a SQLite database file, which can be shared
+    between all the processes on a single host.
+
+    Keys must have a stable repr(); tuples of strings and numbers
+    work well. Values must be picklable.
+    """
+
+    # Every so often, when setting a value, we take the opportunity
+    # to delete expired entries.
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl=None):
+        """Constructor.
+
+        :param path: The path to the SQLite database file. It will be
+            created if necessary.
+        :param ttl: The default number of seconds an entry remains
+            valid. None means entries never expire.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.log = logging.getLogger("SQLite cache")
+        self.local = threading.local()
+        self.sets = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection.execute(
+            "create table if not exists cache "
+            "(key text primary key, value blob, expires real)"
+        )
+        self.connection.commit()
+
+    @property
+    def connection(self):
+        """Find or create a database connection for the current thread.
+
+        SQLite connections can't be shared between threads.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self.local.connection = connection
+        return connection
+
+    def _key(self, key):
+        return repr(key)
+
+    def get(self, key, default=None):
+        """Look up the value for `key`, if it hasn't expired."""
+        try:
+            row = self.connection.execute(
+                "select value, expires from cache where key=?",
+                (self._key(key),)
+            ).fetchone()
+        except sqlite3.Error, e:
+            self.log.error("Could not read from cache: %s", e)
+            return default
+        if not row:
+            return default
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            return default
+        return pickle.loads(str(value))
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`.
+
+        :param ttl: The number of seconds the entry should remain
+            valid, if different from the cache's default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        try:
+            self.connection.execute(
+                "insert or replace into cache (key, value, expires) "
+                "values (?, ?, ?)",
+                (self._key(key), value, expires)
+            )
+            self.sets += 1
+            if self.sets % self.PURGE_EVERY == 0:
+                self.connection.execute(
+                    "delete from cache where expires <= ?", (time.time(),)
+                )
+            self.connection.commit()
+        except sqlite3.Error, e:
+            self.log.error("Could not write to cache: %s", e)
+
+    def delete(self, key):
+        """Remove the entry for `key`, if there is one."""
+        try:
+            self.connection.execute(
+                "delete from cache where key=?", (self._key(key),)
+            )
+            self.connection.commit()
+        except sqlite3.Error, e:
+            self.log.error("Could not delete from cache: %s", e)
+
+    def clear(self):
+        """Remove every entry."""
+        self.connection.execute("delete from cache")
+        self.connection.commit()
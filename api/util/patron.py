@@ -7,7 +7,7 @@ class PatronUtility(object):
     """Apply circulation-specific logic to Patron model objects."""
     
     @classmethod
-    def needs_external_sync(cls, patron):
+    def needs_external_sync(cls, patron, activity_cache=None):
         """Could this patron stand to have their metadata synced with the
         remote?
 
@@ -15,6 +15,13 @@ class PatronUtility(object):
         hours. Patrons who lack borrowing privileges can always stand
         to be synced, since their privileges may have just been
         restored.
+
+        :param activity_cache: A PatronActivityCache. If the patron's
+            loans and holds are fresh in this cache, every remote was
+            just asked about them and they haven't borrowed or returned
+            anything since, so a patron who lacks borrowing privileges
+            doesn't need to be synced again until the cache entry
+            expires.
         """
         if not patron.last_external_sync:
             # This patron has never been synced.
@@ -31,6 +38,8 @@ class PatronUtility(object):
             # taking action to get their account reinstated and we
             # don't want to make them wait twelve hours to get access.
             check_every = datetime.timedelta(seconds=5)
+            if activity_cache and activity_cache.is_fresh(patron):
+                check_every = datetime.timedelta(seconds=activity_cache.ttl)
         expired_at = patron.last_external_sync + check_every
         if now > expired_at:
             return True
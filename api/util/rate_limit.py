@@ -0,0 +1,51 @@
+"""Keep a group of threads from making requests faster than a
+vendor's API allows.
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """A thread-safe limit on how often something may happen.
+
+    Each call to wait() reserves the next available time slot and
+    sleeps until it arrives, so however many threads share a
+    RateLimiter, no more than `per_second` calls return in any
+    second.
+    """
+
+    def __init__(self, per_second=None, clock=time.time, sleep=time.sleep):
+        """Constructor.
+
+        :param per_second: The maximum number of calls per second. None
+            or zero means there's no limit.
+        :param clock: A function that returns the current time in
+            seconds. Tests can substitute their own.
+        :param sleep: A function that sleeps for some number of
+            seconds. Tests can substitute their own.
+        """
+        if per_second:
+            self.interval = 1.0 / per_second
+        else:
+            self.interval = 0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_slot = None
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller is allowed to go ahead.
+
+        :return: The number of seconds the caller had to wait.
+        """
+        if not self.interval:
+            return 0
+        with self.lock:
+            now = self.clock()
+            if self.next_slot is None or self.next_slot < now:
+                self.next_slot = now
+            delay = self.next_slot - now
+            self.next_slot += self.interval
+        if delay > 0:
+            self.sleep(delay)
+        return delay
@@ -0,0 +1,96 @@
+"""Keep patrons' OAuth bearer tokens in memory, so that a request made
+on a patron's behalf doesn't have to look up their Credential first.
+
+The Credential table remains the source of truth; this cache only
+remembers what's in it until the token is about to expire.
+"""
+import datetime
+import threading
+
+from cache import LRUCache
+
+
+class AccessTokenCache(object):
+    """A thread-safe cache of bearer tokens.
+
+    When several threads need the same token at once, only one of
+    them looks it up (or refreshes it); the others wait and then use
+    what it found.
+    """
+
+    # Tokens are forgotten this many seconds before they expire, so
+    # that a token taken from the cache doesn't expire in the middle
+    # of the request that uses it.
+    EXPIRATION_MARGIN = 60
+
+    # The number of locks that are shared out between keys. Two keys
+    # that happen to share a lock only cost each other a short wait.
+    LOCK_STRIPES = 64
+
+    def __init__(self, max_size=10000):
+        self.tokens = LRUCache(max_size)
+        self.locks = [threading.Lock() for i in range(self.LOCK_STRIPES)]
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def get(self, key, lookup):
+        """Find the token for `key`.
+
+        :param lookup: A function that returns an up-to-date
+            Credential, if the token isn't in the cache.
+        :return: A string.
+        """
+        token = self.tokens.get(key)
+        if token is not None:
+            return token
+        with self.lock_for(key):
+            # Someone else may have looked up the token while we were
+            # waiting for the lock.
+            token = self.tokens.get(key)
+            if token is not None:
+                return token
+            return self.remember(key, lookup())
+
+    def refresh(self, key, rejected_token, refresh):
+        """Replace a token that the remote rejected.
+
+        :param rejected_token: The token that was rejected. If the
+            cache already has a different token for `key`, someone else
+            has refreshed it in the meantime and it's not refreshed
+            again.
+        :param refresh: A function that obtains a new token and returns
+            the updated Credential.
+        :return: A string.
+        """
+        with self.lock_for(key):
+            token = self.tokens.get(key)
+            if token is not None and token != rejected_token:
+                return token
+            self.tokens.delete(key)
+            return self.remember(key, refresh())
+
+    def remember(self, key, credential):
+        """Cache the token from a Credential until shortly before it
+        expires.
+
+        :return: The token.
+        """
+        token = credential.credential
+        ttl = None
+        if credential.expires:
+            ttl = (
+                credential.expires - datetime.datetime.utcnow()
+            ).total_seconds() - self.EXPIRATION_MARGIN
+            if ttl <= 0:
+                # Good enough for one request, but not worth keeping.
+                self.tokens.delete(key)
+                return token
+        self.tokens.set(key, token, ttl)
+        return token
+
+    def invalidate(self, key):
+        self.tokens.delete(key)
+
+    def clear(self):
+        self.tokens.clear()
@@ -0,0 +1,63 @@
+"""Parse large XML documents from vendors without building the whole
+tree in memory first.
+"""
+from cStringIO import StringIO
+
+from lxml import etree
+
+
+class IncrementalXMLParser(object):
+    """A mixin for XMLParser subclasses.
+
+    XMLParser.process_all builds a tree for the entire document before
+    handling the first item in it. process_incrementally handles each
+    item as soon as its closing tag has been read, then throws it
+    away, so memory use stays flat however long the document is.
+    """
+
+    def process_incrementally(self, source, tags, namespaces={},
+                              handler=None):
+        """Handle every element with one of the given tags.
+
+        :param source: A string, or a file-like object such as the one
+            response_body returns for a streamed HTTP response.
+        :param tags: A tag name, or a list of tag names, in lxml's
+            "{namespace}name" form.
+        :param handler: A function that takes an element and a
+            namespace dictionary. Defaults to process_one.
+        :yield: Whatever the handler returns, unless it's None.
+        """
+        if isinstance(source, basestring):
+            source = StringIO(source)
+        handler = handler or self.process_one
+        for event, element in etree.iterparse(
+                source, events=('end',), tag=tags, recover=True):
+            data = handler(element, namespaces)
+
+            # This element, and everything before it, has been handled.
+            # Free the memory it was using.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+            if data is not None:
+                yield data
+
+
+def response_body(response):
+    """Find the body of an HTTP response in a form that
+    process_incrementally can read.
+
+    If the request was made with stream=True and the body hasn't been
+    read yet, this is the response's raw stream, so the document is
+    parsed as it comes off the socket. Otherwise (including for the
+    mock responses used in tests) it's the content, which has already
+    been read into memory.
+    """
+    raw = getattr(response, 'raw', None)
+    if raw is None or getattr(response, '_content_consumed', True):
+        return response.content
+    # Let urllib3 undo any gzip or deflate encoding, as
+    # response.content would have.
+    raw.decode_content = True
+    return raw
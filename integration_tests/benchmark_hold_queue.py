@@ -0,0 +1,119 @@
+"""Compare two ways of recalculating a long ODL hold queue: updating
+each hold with its own queries, and updating the whole queue in one
+pass with update_hold_queue.
+
+This needs the test database used by the unit tests. Run it from the
+top-level directory:
+
+    python integration_tests/benchmark_hold_queue.py [number of holds]
+"""
+import datetime
+import os
+import sys
+import time
+package_dir = os.path.join(os.path.split(__file__)[0], "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from core.model import Collection
+from core.testing import (
+    DatabaseTest,
+    package_setup,
+)
+from api.odl import MockODLWithConsolidatedCopiesAPI
+
+
+class QueryCounter(object):
+    """Count the SQL statements sent to the database."""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, "before_cursor_execute", self.increment)
+
+    def increment(self, *args, **kwargs):
+        self.count += 1
+
+
+class HoldQueueBenchmark(DatabaseTest):
+
+    def setup(self):
+        super(HoldQueueBenchmark, self).setup()
+        self.collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        self.collection.external_integration.set_setting(
+            Collection.DATA_SOURCE_NAME_SETTING, "Feedbooks"
+        )
+        self.api = MockODLWithConsolidatedCopiesAPI(self._db, self.collection)
+        self.pool = self._licensepool(None, collection=self.collection)
+        self.counter = QueryCounter()
+
+    def populate(self, holds, licenses=10):
+        now = datetime.datetime.utcnow()
+        self.pool.licenses_owned = licenses
+        for i in range(licenses):
+            self.pool.loan_to(
+                self._patron(), end=now + datetime.timedelta(days=i+1)
+            )
+        self.holds = []
+        for i in range(holds):
+            hold, ignore = self.pool.on_hold_to(
+                self._patron(), start=now - datetime.timedelta(minutes=holds-i),
+                position=i+1
+            )
+            self.holds.append(hold)
+        self._db.flush()
+
+    def measure(self, name, function):
+        queries = self.counter.count
+        a = time.time()
+        function()
+        self._db.flush()
+        elapsed = time.time() - a
+        queries = self.counter.count - queries
+        print "%-30s %8.3f sec %8d queries" % (name, elapsed, queries)
+        return elapsed
+
+    def run(self, holds):
+        self.populate(holds)
+        print "Recalculating a queue of %d holds on %d licenses" % (
+            holds, self.pool.licenses_owned
+        )
+
+        def one_at_a_time():
+            for hold in self.holds:
+                self.api._update_hold_end_date(hold)
+        original = [(hold.position, hold.end) for hold in self.holds]
+        before = self.measure("One hold at a time", one_at_a_time)
+        expected = [(hold.position, hold.end) for hold in self.holds]
+
+        # Put the queue back the way it was, so update_hold_queue has
+        # the same work to do.
+        for hold, (position, end) in zip(self.holds, original):
+            hold.position = position
+            hold.end = end
+        self._db.flush()
+
+        after = self.measure(
+            "update_hold_queue", lambda: self.api.update_hold_queue(self.pool)
+        )
+        actual = [(hold.position, hold.end) for hold in self.holds]
+        if actual != expected:
+            print "The two methods gave different results!"
+        if after:
+            print "Speedup: %.1fx" % (before / after)
+
+
+if __name__ == '__main__':
+    holds = 500
+    if len(sys.argv) > 1:
+        holds = int(sys.argv[1])
+    package_setup()
+    HoldQueueBenchmark.setup_class()
+    benchmark = HoldQueueBenchmark()
+    benchmark.setup()
+    try:
+        benchmark.run(holds)
+    finally:
+        benchmark.teardown()
+        HoldQueueBenchmark.teardown_class()
@@ -0,0 +1,116 @@
+"""Compare the time and peak memory it takes to parse large vendor
+responses all at once (process_all) and as they're read
+(process_stream).
+
+The responses are made by repeating the items in the recorded
+responses under tests/files until there are enough of them. Each
+measurement runs in its own process, so that one measurement's peak
+memory use doesn't hide another's. This doesn't need a database. Run
+it from the top-level directory:
+
+    python integration_tests/benchmark_parsers.py [number of items]
+"""
+import copy
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+package_dir = os.path.join(os.path.split(__file__)[0], "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from lxml import etree
+
+from api.axis import AvailabilityResponseParser
+from api.bibliotheca import (
+    CirculationParser,
+    EventParser,
+    PatronCirculationParser,
+)
+
+files_dir = os.path.join(package_dir, "tests", "files")
+AXIS_NS = "{http://axis360api.baker-taylor.com/vendorAPI}"
+
+# For each parser: the recorded response it's tested with, and the
+# item that should be repeated to make a large response.
+BENCHMARKS = [
+    ("EventParser", EventParser, "bibliotheca/empty_end_date_event.xml",
+     "CloudLibraryEvent"),
+    ("CirculationParser", CirculationParser,
+     "bibliotheca/item_circulation.xml", "ItemCirculation"),
+    ("PatronCirculationParser", PatronCirculationParser,
+     "bibliotheca/checkouts.xml", "Item"),
+    ("AvailabilityResponseParser", AvailabilityResponseParser,
+     "axis/availability_with_loan_and_hold.xml", AXIS_NS + "title"),
+]
+
+
+def make_document(filename, tag, items):
+    """Repeat the items in a recorded response until there are
+    `items` of them.
+    """
+    root = etree.parse(os.path.join(files_dir, filename)).getroot()
+    originals = list(root.iter(tag))
+    count = len(originals)
+    while count < items:
+        original = originals[count % len(originals)]
+        original.getparent().append(copy.deepcopy(original))
+        count += 1
+    return etree.tostring(root)
+
+
+def make_parser(parser_class):
+    if parser_class in (PatronCirculationParser, AvailabilityResponseParser):
+        # These parsers need a collection, but only to put it in the
+        # objects they create.
+        return parser_class(None)
+    return parser_class()
+
+
+def measure(name, method, path):
+    """Parse one document and print the time taken and the growth in
+    the peak memory use of this process.
+    """
+    [parser_class] = [x[1] for x in BENCHMARKS if x[0] == name]
+    document = open(path).read()
+    parser = make_parser(parser_class)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    a = time.time()
+    count = 0
+    for item in getattr(parser, method)(document):
+        count += 1
+    elapsed = time.time() - a
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%-28s %-15s %8d items %8.3f sec %8d KB" % (
+        name, method, count, elapsed, peak - before
+    )
+
+
+def run(items):
+    print "Parsing responses with about %d items each" % items
+    print "(The last column is how much the peak memory use grew.)"
+    sys.stdout.flush()
+    for name, ignore, filename, tag in BENCHMARKS:
+        handle, path = tempfile.mkstemp(suffix=".xml")
+        try:
+            with os.fdopen(handle, "w") as out:
+                out.write(make_document(filename, tag, items))
+            for method in ("process_all", "process_stream"):
+                subprocess.check_call([
+                    sys.executable, __file__, "--measure", name, method,
+                    path
+                ])
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        name, method, path = sys.argv[2:5]
+        measure(name, method, path)
+    else:
+        items = 100000
+        if len(sys.argv) > 1:
+            items = int(sys.argv[1])
+        run(items)
@@ -0,0 +1,94 @@
+"""Compare the time it takes to render an OPDS feed when every URL
+goes through Flask's url_for, and when URLs are made from templates.
+
+This needs the test database used by the unit tests. Run it from the
+top-level directory:
+
+    python integration_tests/benchmark_url_templates.py [number of works]
+"""
+import os
+import re
+import sys
+import time
+package_dir = os.path.join(os.path.split(__file__)[0], "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from core.opds import AcquisitionFeed
+from core.testing import (
+    DatabaseTest,
+    package_setup,
+)
+from api.app import app
+from api.opds import (
+    LibraryAnnotator,
+    URLTemplates,
+)
+
+
+class NoURLTemplates(URLTemplates):
+    """Send every URL through Flask, as before."""
+
+    def url_for(self, cdn, route, **kwargs):
+        return self._generate(cdn, route, **kwargs)
+
+
+class URLTemplateBenchmark(DatabaseTest):
+
+    def populate(self, works):
+        self.lane = self._lane()
+        self.works = []
+        for i in range(works):
+            work = self._work(with_license_pool=True, series=self._str)
+            self.works.append(work)
+        self._db.flush()
+
+    def render(self, templates_class):
+        # Don't let links cached by a previous render hide the cost
+        # of making them.
+        LibraryAnnotator.WORK_ENTRY_LINK_CACHE.clear()
+        annotator = LibraryAnnotator(None, self.lane, self._default_library)
+        annotator.url_templates = templates_class()
+        feed = AcquisitionFeed(
+            self._db, "test", "http://host/", self.works, annotator
+        )
+        return unicode(feed)
+
+    def measure(self, name, templates_class, repeat):
+        a = time.time()
+        for i in range(repeat):
+            feed = self.render(templates_class)
+        elapsed = (time.time() - a) / repeat
+        print "%-20s %8.3f sec per feed" % (name, elapsed)
+        return elapsed, feed
+
+    def run(self, works, repeat=5):
+        self.populate(works)
+        print "Rendering a feed of %d works" % works
+        with app.test_request_context(
+            "/", base_url="http://test-circulation-manager/"
+        ):
+            # Warm up caches that have nothing to do with URLs.
+            self.render(URLTemplates)
+            before, expected = self.measure("Flask url_for", NoURLTemplates, repeat)
+            after, actual = self.measure("URL templates", URLTemplates, repeat)
+        # The feeds' <updated> times may legitimately differ.
+        updated = re.compile("<updated>[^<]*</updated>")
+        if updated.sub("", actual) != updated.sub("", expected):
+            print "The two feeds are different!"
+        if after:
+            print "Speedup: %.1fx" % (before / after)
+
+
+if __name__ == '__main__':
+    works = 50
+    if len(sys.argv) > 1:
+        works = int(sys.argv[1])
+    package_setup()
+    URLTemplateBenchmark.setup_class()
+    benchmark = URLTemplateBenchmark()
+    benchmark.setup()
+    try:
+        benchmark.run(works)
+    finally:
+        benchmark.teardown()
+        URLTemplateBenchmark.teardown_class()
@@ -0,0 +1,90 @@
+"""A local stand-in for the Google Analytics Measurement Protocol
+endpoints, for trying out GoogleAnalyticsProvider without sending
+anything to Google.
+
+It accepts hits at /collect and batches of hits at /batch, prints a
+line for each request, and rejects batches that break the batch
+endpoint's limits. Run it from the top-level directory:
+
+    python integration_tests/google_analytics_stand_in.py [port] [error rate]
+
+then set the Google Analytics integration's URL to
+http://localhost:<port>/collect and its batch URL to
+http://localhost:<port>/batch. If an error rate between 0 and 1 is
+given, that fraction of requests gets a 503 response, so that retries
+can be tried out.
+"""
+import os
+import random
+import sys
+import urlparse
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+package_dir = os.path.join(os.path.split(__file__)[0], "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from api.google_analytics_provider import GoogleAnalyticsProvider
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open, like Google Analytics does.
+    protocol_version = "HTTP/1.1"
+
+    error_rate = 0
+    hits = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse.urlparse(self.path).path
+        if random.random() < self.error_rate:
+            return self.respond(503, "Simulated error")
+        if path == '/collect':
+            hits = [body]
+        elif path == '/batch':
+            hits = body.split("\n")
+            error = self.check_batch(body, hits)
+            if error:
+                return self.respond(400, error)
+        else:
+            return self.respond(404, "Not found")
+        StandInHandler.hits += len(hits)
+        events = [urlparse.parse_qs(hit).get('ea', ['?'])[0] for hit in hits]
+        print "%s: %d hits (%d in all): %s" % (
+            path, len(hits), StandInHandler.hits, ", ".join(events)
+        )
+        self.respond(200, "")
+
+    def check_batch(self, body, hits):
+        provider = GoogleAnalyticsProvider
+        if len(hits) > provider.MAX_HITS_PER_BATCH:
+            return "Too many hits: %d" % len(hits)
+        if len(body) > provider.MAX_BATCH_BYTES:
+            return "Batch too big: %d bytes" % len(body)
+        for hit in hits:
+            if len(hit) > provider.MAX_HIT_BYTES:
+                return "Hit too big: %d bytes" % len(hit)
+
+    def respond(self, status, message):
+        if status != 200:
+            print "%s: %d %s" % (self.path, status, message)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def log_message(self, format, *args):
+        # do_POST prints its own, more useful, messages.
+        pass
+
+
+if __name__ == '__main__':
+    port = 8099
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        StandInHandler.error_rate = float(sys.argv[2])
+    print "Listening on http://localhost:%d/" % port
+    HTTPServer(('', port), StandInHandler).serve_forever()
@@ -0,0 +1,11 @@
+-- Snapshots of the admin dashboard's numbers, saved by
+-- bin/refresh_dashboard_stats.
+create table if not exists dashboardstats (
+    id serial primary key,
+    timestamp timestamp without time zone not null,
+    collection_id integer,
+    library_id integer,
+    data varchar not null
+);
+create index if not exists ix_dashboardstats_collection_id on dashboardstats (collection_id);
+create index if not exists ix_dashboardstats_library_id on dashboardstats (library_id);
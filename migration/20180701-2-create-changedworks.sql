@@ -0,0 +1,9 @@
+-- Works whose availability has changed, so that cached lane feeds
+-- containing them can be regenerated.
+create table if not exists changedworks (
+    id serial primary key,
+    work_id integer not null,
+    timestamp timestamp without time zone not null
+);
+create index if not exists ix_changedworks_work_id on changedworks (work_id);
+create index if not exists ix_changedworks_timestamp on changedworks (timestamp);
@@ -0,0 +1,7 @@
+-- The compacted JSON-LD target and body of each annotation, stored
+-- when the annotation is written.
+create table if not exists compactedannotations (
+    annotation_id integer primary key,
+    target varchar,
+    body varchar
+);
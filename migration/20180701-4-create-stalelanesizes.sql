@@ -0,0 +1,5 @@
+-- Lanes whose sizes need to be recalculated by bin/update_lane_sizes.
+create table if not exists stalelanesizes (
+    lane_id integer primary key,
+    timestamp timestamp without time zone not null
+);
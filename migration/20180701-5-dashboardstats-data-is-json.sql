@@ -0,0 +1,3 @@
+-- Dashboard stats snapshots are stored as JSON rather than as JSON
+-- text in a varchar.
+alter table dashboardstats alter column data type json using data::json;
@@ -0,0 +1,22 @@
+-- A compacted annotation is deleted along with its annotation.
+delete from compactedannotations
+    where annotation_id not in (select id from annotations);
+
+DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = 'compactedannotations_annotation_id_fkey'
+        ) THEN
+            ALTER TABLE compactedannotations
+                ADD CONSTRAINT compactedannotations_annotation_id_fkey
+                FOREIGN KEY (annotation_id) REFERENCES annotations(id)
+                ON DELETE CASCADE;
+        END IF;
+    END;
+$$;
+
+-- Annotations that were deleted through the API keep their rows, but
+-- no longer need their compacted forms.
+delete from compactedannotations
+    where annotation_id in (select id from annotations where not active);
@@ -0,0 +1,15 @@
+-- Patron logins that were recently checked with the ILS, shared by
+-- every circulation manager process.
+create table if not exists credentialcache (
+    key varchar primary key,
+    integration_id integer not null references externalintegrations(id) on delete cascade,
+    library_id integer not null references libraries(id) on delete cascade,
+    identifier varchar not null,
+    failed boolean not null,
+    patron_data json,
+    expires timestamp without time zone not null,
+    hits integer not null default 0
+);
+create index if not exists ix_credentialcache_integration_id on credentialcache (integration_id);
+create index if not exists ix_credentialcache_expires on credentialcache (expires);
+create index if not exists ix_credentialcache_library_id_identifier on credentialcache (library_id, identifier);
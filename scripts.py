@@ -13,10 +13,12 @@ import time
 import urlparse
 import logging
 import argparse
+import multiprocessing
 
 from sqlalchemy import (
     or_,
     func,
+    select,
 )
 from sqlalchemy.orm import (
     contains_eager,
@@ -25,7 +27,10 @@ from sqlalchemy.orm import (
 from psycopg2.extras import NumericRange
 
 from core import log
-from core.lane import Lane
+from core.lane import (
+    Lane,
+    WorkList,
+)
 from core.classifier import Classifier
 from core.metadata_layer import (
     CirculationData,
@@ -34,6 +39,7 @@ from core.metadata_layer import (
     LinkData,
 )
 from core.model import (
+    CachedFeed,
     CirculationEvent,
     Collection,
     ConfigurationSetting,
@@ -93,6 +99,9 @@ from api.config import (
     CannotLoadConfiguration,
     Configuration,
 )
+from api.admin.dashboard_stats import DashboardStats
+from api.admin.lane_sizes import LaneSizeQueue
+from api.feed_cache import ChangedWorkQueue
 from api.adobe_vendor_id import (
     AdobeVendorIDModel,
     AuthdataUtility,
@@ -314,6 +323,24 @@ class UpdateStaffPicksScript(Script):
         return StringIO(representation.content)
 
 
+# The script running in a worker process started by
+# CacheRepresentationPerLane.run_in_workers.
+_cache_worker = None
+
+def _initialize_cache_worker(script_class, cmd_args, testing):
+    """Give this worker process its own script, with its own database
+    session, CirculationManager and request context.
+    """
+    global _cache_worker
+    script = script_class(cmd_args=cmd_args, testing=testing)
+    ctx = script.app.test_request_context(base_url=script.base_url)
+    ctx.push()
+    _cache_worker = script
+
+def _generate_feed_in_worker(task):
+    return _cache_worker.generate_feed_task(task)
+
+
 class CacheRepresentationPerLane(LaneSweeperScript):
 
     name = "Cache one representation per lane"
@@ -338,16 +365,32 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             type=int,
             default=1
         )
+        parser.add_argument(
+            '--workers',
+            help='Generate feeds in this many worker processes. Default: 1',
+            type=int,
+            default=1
+        )
         return parser
 
     def __init__(self, _db=None, cmd_args=None, testing=False, *args, **kwargs):
         super(CacheRepresentationPerLane, self).__init__(_db, *args, **kwargs)
         self.parse_args(cmd_args)
+        # Worker processes need these to set themselves up.
+        self.cmd_args = cmd_args
+        self.testing = testing
         from api.app import app
         app.manager = CirculationManager(self._db, testing=testing)
         self.app = app
         self.base_url = ConfigurationSetting.sitewide(self._db, Configuration.BASE_URL_KEY).value
 
+        # Feeds waiting to be generated by worker processes.
+        self.tasks = []
+
+        # For each lane, the number of feeds generated, the time
+        # spent generating them, and their total size.
+        self.lane_stats = {}
+
     def parse_args(self, cmd_args=None):
         parser = self.arg_parser(self._db)
         parsed = parser.parse_args(cmd_args)
@@ -361,6 +404,7 @@ class CacheRepresentationPerLane(LaneSweeperScript):
                     self.log.warn("Ignored unrecognized language code %s", alpha)
         self.max_depth = parsed.max_depth
         self.min_depth = parsed.min_depth
+        self.workers = parsed.workers
 
         # Return the parsed arguments in case a subclass needs to
         # process more args.
@@ -399,12 +443,36 @@ class CacheRepresentationPerLane(LaneSweeperScript):
     def generate_representation(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def feed_tasks(self, lane):
+        """Describe each feed that should be cached for a lane.
+
+        :yield: A sequence of dictionaries, each of which can be
+            passed into generate_feed(). They must be picklable, since
+            they may be sent to worker processes.
+        """
+        raise NotImplementedError()
+
+    def generate_feed(self, lane, task):
+        """Generate and cache one of the feeds described by feed_tasks()."""
+        raise NotImplementedError()
+
+    def do_generate(self, lane):
+        for task in self.feed_tasks(lane):
+            yield self.generate_feed(lane, task)
+
     # The generated document will probably be an OPDS acquisition
     # feed.
     ACCEPT_HEADER = OPDSFeed.ACQUISITION_FEED_TYPE
 
     cache_url_method = None
 
+    def do_run(self, *args, **kwargs):
+        super(CacheRepresentationPerLane, self).do_run(*args, **kwargs)
+        if self.tasks:
+            self.run_in_workers(self.tasks)
+            self.tasks = []
+        self.log_summary()
+
     def process_library(self, library):
         begin = time.time()
         client = self.app.test_client()
@@ -418,6 +486,19 @@ class CacheRepresentationPerLane(LaneSweeperScript):
         )
 
     def process_lane(self, lane):
+        if self.workers > 1:
+            # Leave the work for the worker processes.
+            library = lane.get_library(self._db)
+            if isinstance(lane, Lane):
+                lane_id = lane.id
+            else:
+                lane_id = None
+            for task in self.feed_tasks(lane):
+                self.tasks.append(
+                    (library.id, lane_id, lane.full_identifier, task)
+                )
+            return []
+
         annotator = self.app.manager.annotator(lane)
         a = time.time()
         self.log.info("Generating feed(s) for %s", lane.full_identifier)
@@ -428,8 +509,88 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             "Generated %d feed(s) for %s. Took %.2fsec to make %d bytes.",
             len(cached_feeds), lane.full_identifier, (b-a), total_size
         )
+        self.record_stats(
+            lane.full_identifier, len(cached_feeds), b-a, total_size
+        )
         return cached_feeds
 
+    def run_in_workers(self, tasks):
+        """Generate feeds in a pool of worker processes.
+
+        :param tasks: A list of (library ID, lane ID, lane identifier,
+            task) 4-tuples, as gathered by process_lane().
+        """
+        self.log.info(
+            "Generating %d feed(s) in %d worker processes.",
+            len(tasks), self.workers
+        )
+        # The worker processes mustn't share this process's database
+        # connections, so close them before forking.
+        self._db.commit()
+        self._db.get_bind().dispose()
+        pool = multiprocessing.Pool(
+            self.workers, initializer=_initialize_cache_worker,
+            initargs=(self.__class__, self.cmd_args, self.testing)
+        )
+        try:
+            for identifier, elapsed, size in pool.imap_unordered(
+                _generate_feed_in_worker, tasks
+            ):
+                self.record_stats(identifier, 1, elapsed, size)
+        finally:
+            pool.close()
+            pool.join()
+
+    def generate_feed_task(self, task):
+        """Generate one feed gathered by process_lane().
+
+        :return: A 3-tuple (lane identifier, seconds taken, bytes
+            generated).
+        """
+        library_id, lane_id, identifier, details = task
+        library = get_one(self._db, Library, id=library_id)
+        if lane_id is None:
+            lane = WorkList.top_level_for_library(self._db, library)
+        else:
+            lane = get_one(self._db, Lane, id=lane_id)
+        a = time.time()
+        size = 0
+        try:
+            feed = self.generate_feed(lane, details)
+            self._db.commit()
+            size = len(feed or "")
+        except Exception, e:
+            self._db.rollback()
+            self.log.error(
+                "Error generating feed for %s: %r", identifier, details,
+                exc_info=e
+            )
+        return identifier, time.time() - a, size
+
+    def record_stats(self, identifier, feeds, elapsed, size):
+        stats = self.lane_stats.setdefault(identifier, [0, 0, 0])
+        stats[0] += feeds
+        stats[1] += elapsed
+        stats[2] += size
+
+    def log_summary(self):
+        """Log how long each lane's feeds took and how big they were,
+        slowest lane first.
+        """
+        if not self.lane_stats:
+            return
+        rows = sorted(
+            self.lane_stats.items(), key=lambda x: x[1][1], reverse=True
+        )
+        self.log.info("%-50s %6s %10s %12s", "Lane", "Feeds", "Seconds", "Bytes")
+        for identifier, (feeds, elapsed, size) in rows:
+            self.log.info(
+                "%-50s %6d %10.2f %12d", identifier, feeds, elapsed, size
+            )
+        feeds, elapsed, size = [sum(x) for x in zip(*self.lane_stats.values())]
+        self.log.info("%-50s %6d %10.2f %12d", "Total", feeds, elapsed, size)
+
+
 class CacheFacetListsPerLane(CacheRepresentationPerLane):
     """Cache the first two pages of every relevant facet list for this lane."""
 
@@ -478,6 +639,12 @@ class CacheFacetListsPerLane(CacheRepresentationPerLane):
             type=int,
             default=default_pages
         )
+
+        parser.add_argument(
+            '--incremental',
+            help="Only regenerate feeds if something in them has changed since they were cached.",
+            action='store_true',
+        )
         return parser
 
     def parse_args(self, cmd_args=None):
@@ -486,22 +653,76 @@ class CacheFacetListsPerLane(CacheRepresentationPerLane):
         self.availabilities = parsed.availability
         self.collections = parsed.collection
         self.pages = parsed.pages
+        self.incremental = parsed.incremental
         return parsed
 
-    def do_generate(self, lane):
-        feeds = []
-        annotator = self.app.manager.annotator(lane)
-        if isinstance(lane, Lane):
-            lane_id = lane.id
-        else:
-            # Presumably this is the top-level WorkList.
-            lane_id = None
+    def do_run(self, *args, **kwargs):
+        super(CacheFacetListsPerLane, self).do_run(*args, **kwargs)
+        if self.incremental:
+            # Changes that happened before the oldest cached feed was
+            # generated won't ever make a difference again.
+            oldest = self._db.query(func.min(CachedFeed.timestamp)).filter(
+                CachedFeed.type==CachedFeed.PAGE_TYPE
+            ).scalar()
+            if oldest:
+                ChangedWorkQueue.prune(self._db, oldest)
+                self._db.commit()
 
-        library = lane.get_library(self._db)
-        url = self.app.manager.cdn_url_for(
-            "feed", lane_identifier=lane_id,
-            library_short_name=library.short_name
+    def facets(self, library, task):
+        return Facets(
+            library=library, collection=task['collection'],
+            availability=task['availability'],
+            order=task['order'], order_ascending=True
+        )
+
+    def pagination(self, page):
+        pagination = Pagination.default()
+        for i in range(page):
+            pagination = pagination.next_page
+        return pagination
+
+    def changed_since_cached(self, lane, facets):
+        """Has anything in this lane changed since its feeds for these
+        facets were cached?
+        """
+        paginations = [
+            unicode(self.pagination(page).query_string)
+            for page in range(self.pages)
+        ]
+        cached = self._db.query(
+            CachedFeed.pagination, func.min(CachedFeed.timestamp)
+        ).filter(
+            CachedFeed.lane_id==lane.id
+        ).filter(
+            CachedFeed.type==CachedFeed.PAGE_TYPE
+        ).filter(
+            CachedFeed.facets==unicode(facets.query_string)
+        ).filter(
+            CachedFeed.pagination.in_(paginations)
+        ).group_by(CachedFeed.pagination).all()
+        if len(cached) < len(paginations):
+            # Some of the feeds haven't been cached at all.
+            return True
+        cached_at = min(timestamp for ignore, timestamp in cached)
+
+        works = lane.works(self._db, facets=facets).order_by(None).subquery()
+        updated = self._db.query(
+            func.max(func.greatest(
+                works.c.availability_time, works.c.last_update_time
+            ))
+        ).scalar()
+        if updated and updated > cached_at:
+            return True
+
+        # Changes to availability don't show up in the materialized
+        # view, so check the queue of works the monitors have changed.
+        changed = ChangedWorkQueue.latest_change(
+            self._db, select([works.c.works_id])
         )
+        return bool(changed and changed > cached_at)
+
+    def feed_tasks(self, lane):
+        library = lane.get_library(self._db)
 
         default_order = library.default_facet(Facets.ORDER_FACET_GROUP_NAME)
         allowed_orders = library.enabled_facets(Facets.ORDER_FACET_GROUP_NAME)
@@ -535,20 +756,42 @@ class CacheFacetListsPerLane(CacheRepresentationPerLane):
                     if collection not in allowed_collections:
                         logging.warn("Ignoring unsupported collection %s" % collection)
                         continue
-                    pagination = Pagination.default()
-                    facets = Facets(
-                        library=library, collection=collection,
-                        availability=availability,
-                        order=order, order_ascending=True
+                    task = dict(
+                        order=order, availability=availability,
+                        collection=collection
                     )
-                    title = lane.display_name
-                    for pagenum in range(0, self.pages):
-                        yield AcquisitionFeed.page(
-                            self._db, title, url, lane, annotator,
-                            facets=facets, pagination=pagination,
-                            force_refresh=True
+                    if (self.incremental and not self.changed_since_cached(
+                            lane, self.facets(library, task))):
+                        self.log.info(
+                            "Nothing has changed in %s (%s/%s/%s), not regenerating.",
+                            lane.full_identifier, order, availability,
+                            collection
                         )
-                        pagination = pagination.next_page
+                        continue
+                    for pagenum in range(0, self.pages):
+                        yield dict(task, page=pagenum)
+
+    def generate_feed(self, lane, task):
+        annotator = self.app.manager.annotator(lane)
+        if isinstance(lane, Lane):
+            lane_id = lane.id
+        else:
+            # Presumably this is the top-level WorkList.
+            lane_id = None
+
+        library = lane.get_library(self._db)
+        url = self.app.manager.cdn_url_for(
+            "feed", lane_identifier=lane_id,
+            library_short_name=library.short_name
+        )
+        facets = self.facets(library, task)
+        pagination = self.pagination(task['page'])
+        title = lane.display_name
+        return AcquisitionFeed.page(
+            self._db, title, url, lane, annotator,
+            facets=facets, pagination=pagination,
+            force_refresh=True
+        )
 
 
 class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
@@ -563,8 +806,15 @@ class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
             return False
         return True
 
-    def do_generate(self, lane):
-        feeds = []
+    def feed_tasks(self, lane):
+        # If the WorkList has explicitly defined EntryPoints, we want to
+        # create a grouped feed for each EntryPoint. Otherwise, we want
+        # to create a single grouped feed with no particular EntryPoint.
+        entrypoints = lane.entrypoints or [None]
+        for entrypoint in entrypoints:
+            yield dict(entrypoint=entrypoint)
+
+    def generate_feed(self, lane, task):
         annotator = self.app.manager.annotator(lane)
         title = lane.display_name
 
@@ -575,25 +825,20 @@ class CacheOPDSGroupFeedPerLane(CacheRepresentationPerLane):
             lane_id = None
         library = lane.get_library(self._db)
 
-        # If the WorkList has explicitly defined EntryPoints, we want to
-        # create a grouped feed for each EntryPoint. Otherwise, we want
-        # to create a single grouped feed with no particular EntryPoint.
-        entrypoints = lane.entrypoints or [None]
-        for entrypoint in entrypoints:
-            facets = FeaturedFacets(
-                minimum_featured_quality=library.minimum_featured_quality,
-                uses_customlists=lane.uses_customlists,
-                entrypoint=entrypoint
-            )
-            kwargs = dict(facets.items())
-            url = self.app.manager.cdn_url_for(
-                "acquisition_groups", lane_identifier=lane_id,
-                library_short_name=library.short_name, **kwargs
-            )
-            yield AcquisitionFeed.groups(
-                self._db, title, url, lane, annotator,
-                force_refresh=True, facets=facets
-            )
+        facets = FeaturedFacets(
+            minimum_featured_quality=library.minimum_featured_quality,
+            uses_customlists=lane.uses_customlists,
+            entrypoint=task['entrypoint']
+        )
+        kwargs = dict(facets.items())
+        url = self.app.manager.cdn_url_for(
+            "acquisition_groups", lane_identifier=lane_id,
+            library_short_name=library.short_name, **kwargs
+        )
+        return AcquisitionFeed.groups(
+            self._db, title, url, lane, annotator,
+            force_refresh=True, facets=facets
+        )
 
 
 class AdobeAccountIDResetScript(PatronInputScript):
@@ -845,6 +1090,33 @@ class LoanReaperScript(Script):
         self._db.commit()
 
 
+class RefreshDashboardStatsScript(Script):
+    """Calculate the statistics shown on the admin dashboard and save
+    them, so the dashboard doesn't have to calculate them on every
+    request.
+    """
+
+    def do_run(self):
+        stats = DashboardStats.calculate(self._db)
+        stats.save(self._db)
+        self._db.commit()
+        self.log.info(
+            "Saved dashboard statistics for %d collections and %d libraries.",
+            len(stats.collections), len(stats.libraries)
+        )
+
+
+class UpdateLaneSizesScript(Script):
+    """Recalculate the sizes of lanes whose custom lists were changed
+    in the admin interface.
+    """
+
+    def do_run(self):
+        updated = LaneSizeQueue.process(self._db)
+        self._db.commit()
+        self.log.info("Updated the sizes of %d lanes.", updated)
+
+
 class DisappearingBookReportScript(Script):
 
     """Print a TSV-format report on books that used to be in the
@@ -27,6 +27,9 @@ from api.admin.controller import (
     AdminAnnotator,
     SettingsController,
 )
+from api.admin.dashboard_stats import DashboardStats
+from api.admin.lane_sizes import LaneSizeQueue
+from api.circulation import PatronActivityExecutor
 from api.admin.problem_details import *
 from api.admin.exceptions import *
 from api.admin.routes import setup_admin
@@ -1418,9 +1421,11 @@ class TestWorkController(AdminControllerTest):
             eq_(list, work.custom_list_entries[0].customlist)
             eq_(True, work.custom_list_entries[0].featured)
 
-            # The lane's size will be updated once the materialized
-            # views are refreshed.
+            # The lane's size will be updated by bin/update_lane_sizes
+            # once the materialized views are refreshed.
             SessionManager.refresh_materialized_views(self._db)
+            eq_(0, lane.size)
+            eq_(1, LaneSizeQueue.process(self._db))
             eq_(1, lane.size)
 
         # Now remove the list.
@@ -1432,6 +1437,8 @@ class TestWorkController(AdminControllerTest):
         eq_(200, response.status_code)
         eq_(0, len(work.custom_list_entries))
         eq_(0, len(list.entries))
+        eq_(1, lane.size)
+        eq_(1, LaneSizeQueue.process(self._db))
         eq_(0, lane.size)
 
         # Add a list that didn't exist before.
@@ -2060,6 +2067,27 @@ class TestCustomListsController(AdminControllerTest):
                           self.manager.admin_custom_lists_controller.custom_list,
                           list.id)
 
+    def test_custom_list_edit_ignores_unknown_identifiers(self):
+        data_source = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
+        list, ignore = create(self._db, CustomList, name=self._str, data_source=data_source)
+        list.library = self._default_library
+        work = self._work(with_license_pool=True)
+
+        new_entries = [
+            dict(identifier_urn=work.presentation_edition.primary_identifier.urn),
+            dict(identifier_urn="urn:isbn:9780000000002"),
+            dict(identifier_urn="not a urn"),
+        ]
+        with self.request_context_with_library_and_admin("/", method="POST"):
+            flask.request.form = MultiDict([
+                ("id", str(list.id)),
+                ("name", list.name),
+                ("entries", json.dumps(new_entries)),
+            ])
+            response = self.manager.admin_custom_lists_controller.custom_list(list.id)
+        eq_(200, response.status_code)
+        eq_([work], [entry.work for entry in list.entries])
+
     def test_custom_list_edit(self):
         data_source = DataSource.lookup(self._db, DataSource.LIBRARY_STAFF)
         list, ignore = create(self._db, CustomList, name=self._str, data_source=data_source)
@@ -2078,7 +2106,11 @@ class TestCustomListsController(AdminControllerTest):
         w3.presentation_edition.medium = Edition.BOOK_MEDIUM
 
         list.add_entry(w1)
-        list.add_entry(w2)
+        w2_entry, ignore = list.add_entry(w2)
+        long_ago = datetime(2001, 1, 1)
+        w2_entry.featured = False
+        w2_entry.first_appearance = long_ago
+        w2_entry.most_recent_appearance = long_ago
         self.add_to_materialized_view([w1, w2, w3])
 
         new_entries = [dict(identifier_urn=work.presentation_edition.primary_identifier.urn,
@@ -2109,9 +2141,20 @@ class TestCustomListsController(AdminControllerTest):
             set([entry.work for entry in list.entries]))
         eq_(new_collections, list.collections)
 
-        # The lane's estimated size will be updated once the materialized
-        # views are refreshed.
+        # Every entry on the new list, including the one that was
+        # already there, is featured and has just appeared, at the
+        # time the list was updated. The entry that was already there
+        # keeps its first appearance.
+        for entry in list.entries:
+            eq_(True, entry.featured)
+            eq_(list.updated, entry.most_recent_appearance)
+        eq_(long_ago, w2_entry.first_appearance)
+
+        # The lane's size isn't updated right away; it's queued to be
+        # updated once the materialized views are refreshed.
         SessionManager.refresh_materialized_views(self._db)
+        eq_(0, lane.size)
+        eq_(1, LaneSizeQueue.process(self._db))
         eq_(2, lane.size)
 
         self.admin.remove_role(AdminRole.LIBRARIAN, self._default_library)
@@ -2582,7 +2625,7 @@ class TestDashboardController(AdminControllerTest):
 
         with self.app.test_request_context("/"):
             response, requested_date = self.manager.admin_dashboard_controller.bulk_circulation_events()
-        rows = response[1::] # skip header row
+            rows = list(response)[1::] # skip header row
         eq_(num, len(rows))
         eq_(types, [row[1] for row in rows])
         eq_([identifier.identifier]*num, [row[2] for row in rows])
@@ -2600,9 +2643,63 @@ class TestDashboardController(AdminControllerTest):
         today = date.strftime(date.today() - timedelta(days=1), "%Y-%m-%d")
         with self.app.test_request_context("/?date=%s" % today):
             response, requested_date = self.manager.admin_dashboard_controller.bulk_circulation_events()
-        rows = response[1::] # skip header row
+            rows = list(response)[1::] # skip header row
         eq_(0, len(rows))
 
+    def test_bulk_circulation_events_date_range(self):
+        [lp] = self.english_1.license_pools
+        today = datetime.combine(date.today(), datetime.min.time())
+        starts = [today - timedelta(days=i, hours=-1) for i in range(5)]
+        for start in starts:
+            get_one_or_create(
+                self._db, CirculationEvent, license_pool=lp,
+                type=CirculationEvent.DISTRIBUTOR_CHECKOUT, start=start,
+                end=start)
+
+        def day(days_ago):
+            return date.strftime(date.today() - timedelta(days=days_ago), "%Y-%m-%d")
+
+        # Both ends of the range are included.
+        url = "/?start=%s&end=%s" % (day(3), day(1))
+        with self.app.test_request_context(url):
+            response, requested_date = self.manager.admin_dashboard_controller.bulk_circulation_events()
+            rows = list(response)[1::]
+        eq_([str(x) for x in reversed(starts[1:4])], [row[0] for row in rows])
+        eq_("%s_%s" % (day(3), day(1)), requested_date)
+
+        # A start date on its own covers a single day.
+        with self.app.test_request_context("/?start=%s" % day(4)):
+            response, requested_date = self.manager.admin_dashboard_controller.bulk_circulation_events()
+            rows = list(response)[1::]
+        eq_([str(starts[4])], [row[0] for row in rows])
+        eq_(day(4), requested_date)
+
+        with self.app.test_request_context("/?start=yesterday"):
+            response, requested_date = self.manager.admin_dashboard_controller.bulk_circulation_events()
+        eq_(INVALID_DATE_FORMAT.uri, response.uri)
+
+    def test_bulk_circulation_events_in_chunks(self):
+        [lp] = self.english_1.license_pools
+        # Several events share a start time, so the chunks have to be
+        # split up by ID as well.
+        time = datetime.now() - timedelta(minutes=10)
+        events = []
+        for i in range(7):
+            event = create(
+                self._db, CirculationEvent, license_pool=lp,
+                type=CirculationEvent.DISTRIBUTOR_CHECKOUT,
+                start=time + timedelta(minutes=i/3), end=time)[0]
+            events.append(event)
+
+        controller = self.manager.admin_dashboard_controller
+        controller.BULK_CIRCULATION_EVENTS_CHUNK_SIZE = 3
+        with self.app.test_request_context("/"):
+            response, requested_date = controller.bulk_circulation_events()
+            rows = list(response)[1::]
+        del controller.BULK_CIRCULATION_EVENTS_CHUNK_SIZE
+        eq_(7, len(rows))
+        eq_([str(event.start) for event in events], [row[0] for row in rows])
+
     def test_stats_patrons(self):
         with self.request_context_with_admin("/"):
             self.admin.add_role(AdminRole.SYSTEM_ADMIN)
@@ -2737,6 +2834,20 @@ class TestDashboardController(AdminControllerTest):
                 eq_(15, inventory_data.get('licenses'))
                 eq_(4, inventory_data.get('available_licenses'))
 
+    def test_patron_activity_latency(self):
+        PatronActivityExecutor.reset()
+        PatronActivityExecutor.histogram("OverdriveAPI").record(0.2)
+        with self.request_context_with_admin("/"):
+            self.admin.add_role(AdminRole.SYSTEM_ADMIN)
+            response = self.manager.admin_dashboard_controller.patron_activity_latency()
+            eq_(["OverdriveAPI"], response.keys())
+            eq_(1, response["OverdriveAPI"]["count"])
+
+            self.admin.remove_role(AdminRole.SYSTEM_ADMIN)
+            assert_raises(AdminNotAuthorized,
+                          self.manager.admin_dashboard_controller.patron_activity_latency)
+        PatronActivityExecutor.reset()
+
     def test_stats_collections(self):
         with self.request_context_with_admin("/"):
             self.admin.add_role(AdminRole.SYSTEM_ADMIN)
@@ -2843,6 +2954,92 @@ class TestDashboardController(AdminControllerTest):
                 eq_(0, c3_data.get('available_licenses'))
 
 
+    def test_stats_as_of(self):
+        with self.request_context_with_admin("/"):
+            self.admin.add_role(AdminRole.SYSTEM_ADMIN)
+            before = datetime.utcnow().replace(microsecond=0)
+            response = self.manager.admin_dashboard_controller.stats()
+            as_of = datetime.strptime(response['total']['as_of'], "%Y-%m-%dT%H:%M:%SZ")
+            assert as_of >= before
+            assert as_of <= datetime.utcnow()
+
+    def test_stats_snapshot(self):
+        # Save a snapshot of the current stats.
+        snapshot = DashboardStats.calculate(self._db)
+        snapshot.as_of = datetime.utcnow() - timedelta(minutes=10)
+        snapshot.save(self._db)
+
+        # Then add a patron.
+        self._patron()
+
+        def patrons():
+            with self.request_context_with_admin("/"):
+                self.admin.add_role(AdminRole.SYSTEM_ADMIN)
+                response = self.manager.admin_dashboard_controller.stats()
+                library_data = response.get(self._default_library.short_name)
+                return response['total']['as_of'], library_data['patrons']['total']
+
+        # By default, the snapshot is ignored.
+        as_of, total = patrons()
+        eq_(2, total)
+
+        # If the snapshot is recent enough, it's used instead of
+        # calculating the numbers again.
+        setting = ConfigurationSetting.sitewide(
+            self._db, Configuration.DASHBOARD_STATS_SNAPSHOT_MAX_AGE
+        )
+        setting.value = "60"
+        as_of, total = patrons()
+        eq_(1, total)
+        eq_(snapshot.as_of.strftime("%Y-%m-%dT%H:%M:%SZ"), as_of)
+
+        # If it's too old, it's ignored.
+        setting.value = "5"
+        as_of, total = patrons()
+        eq_(2, total)
+
+    def test_dashboard_stats_calculate(self):
+        # Numbers for all collections and libraries are calculated at once.
+        l2 = self._library()
+        c2 = self._collection()
+        edition, pool = self._edition(
+            with_license_pool=True, with_open_access_download=False,
+            collection=c2
+        )
+        pool.open_access = False
+        pool.licenses_owned = 4
+        pool.licenses_available = 1
+
+        patron1 = self._patron(library=l2)
+        patron2 = self._patron(library=l2)
+        pool.loan_to(patron1, end=datetime.now() + timedelta(days=1))
+        pool.on_hold_to(patron1)
+        pool.on_hold_to(patron2)
+        self._patron(library=l2)
+
+        stats = DashboardStats.calculate(self._db)
+        eq_(dict(licensed_titles=1, open_access_titles=0, licenses=4,
+                 available_licenses=1), stats.for_collection(c2))
+        eq_(dict(total=3, with_active_loans=1, with_active_loans_or_holds=2,
+                 loans=1, holds=2), stats.for_library(l2))
+
+        # A library with no patrons gets zeroes.
+        eq_(DashboardStats.EMPTY_LIBRARY, stats.for_library(self._library()))
+
+        # The numbers can be saved and loaded again.
+        stats.save(self._db)
+        loaded = DashboardStats.from_snapshot(self._db)
+        eq_(stats.collections, loaded.collections)
+        eq_(stats.libraries, loaded.libraries)
+        eq_(stats.as_of, loaded.as_of)
+
+        # Saving a new snapshot replaces the old one.
+        DashboardStats(datetime.utcnow(), {}, {5: {}}).save(self._db)
+        loaded = DashboardStats.from_snapshot(self._db)
+        eq_({}, loaded.collections)
+        eq_({5: {}}, loaded.libraries)
+
+
 class SettingsControllerTest(AdminControllerTest):
     """Test some part of the settings controller."""
 
@@ -4831,6 +5028,51 @@ class TestSettingsController(SettingsControllerTest):
         service = get_one(self._db, ExternalIntegration, id=auth_service.id)
         eq_(None, service)
 
+    def test_patron_auth_service_credential_cache(self):
+        auth_service, ignore = create(
+            self._db, ExternalIntegration,
+            protocol=SimpleAuthenticationProvider.__module__,
+            goal=ExternalIntegration.PATRON_AUTH_GOAL
+        )
+        auth_service.libraries = [self._default_library]
+        auth_service.setting(
+            SimpleAuthenticationProvider.TEST_IDENTIFIER).value = "user"
+        auth_service.setting(
+            SimpleAuthenticationProvider.TEST_PASSWORD).value = "pass"
+        provider = SimpleAuthenticationProvider(
+            self._default_library, auth_service
+        )
+        provider._cache_credentials(
+            self._db, "barcode", u"key", dict(username="user"), 60
+        )
+
+        controller = self.manager.admin_settings_controller
+        with self.request_context_with_admin("/"):
+            response = controller.patron_auth_service_credential_cache(
+                auth_service.id
+            )
+            eq_(dict(logins=1, failed_logins=0, hits=0, negative_hits=0),
+                response["stats"])
+
+        with self.request_context_with_admin("/", method="POST"):
+            flask.request.form = MultiDict([])
+            response = controller.patron_auth_service_credential_cache(
+                auth_service.id
+            )
+            eq_(NO_PATRON_IDENTIFIER, response)
+
+            flask.request.form = MultiDict([("identifier", "barcode")])
+            response = controller.patron_auth_service_credential_cache(
+                auth_service.id
+            )
+            eq_(200, response.status_code)
+            eq_("1", response.response[0])
+        eq_(None, BasicAuthenticationProvider._cached_login(self._db, u"key"))
+
+        with self.request_context_with_admin("/"):
+            response = controller.patron_auth_service_credential_cache(-1)
+            eq_(MISSING_SERVICE, response)
+
     def test_sitewide_settings_get(self):
         with self.request_context_with_admin("/"):
             response = self.manager.admin_settings_controller.sitewide_settings()
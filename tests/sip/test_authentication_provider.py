@@ -4,7 +4,10 @@ from nose.tools import (
     set_trace,
     eq_,
 )
-from api.sip.client import MockSIPClient
+from api.sip.client import (
+    MockSIPClient,
+    SIPClientPool,
+)
 from api.sip import SIP2AuthenticationProvider
 from core.util.http import RemoteIntegrationException
 from api.authenticator import PatronData
@@ -64,6 +67,20 @@ class TestSIP2AuthenticationProvider(DatabaseTest):
         integration.setting(p.PORT).value = "1234"
         provider = p(self._default_library, integration, connect=False)
         eq_(1234, provider.client.target_port)
+
+        # If a connection pool size is set, the provider talks to the
+        # server through a pool of SIPClients instead.
+        integration.setting(p.CONNECTION_POOL_SIZE).value = "4"
+        provider = p(self._default_library, integration, connect=False)
+        pool = provider.client
+        assert isinstance(pool, SIPClientPool)
+        eq_(4, pool.size)
+        eq_("server.com", pool.target_server)
+        eq_(1234, pool.client_kwargs['target_port'])
+        eq_("user1", pool.client_kwargs['login_user_id'])
+
+        # No connections are made until they're needed.
+        eq_(0, pool.open_connections)
         
     def test_remote_authenticate(self):
         integration = self._external_integration(self._str)
@@ -11,6 +11,7 @@ from api.sip.client import (
     CannotSendMockSIPClient,
     MockSIPClient,
     SIPClient,
+    SIPClientPool,
 )
 
 class MockSocket(object):
@@ -323,3 +324,116 @@ class TestPatronResponse(object):
                 'too many items billed',
         ]:
             eq_(parsed[no], False)
+
+
+class TestSIPClientPool(object):
+
+    patron_information = "64              000201610210000142637000000000000000000000000AOnypl |AA12345|AESHELDON, ALICE|BLY|CQY|BV0|AY1AZD1B7"
+
+    acs_status_online = "98YYYYNN01000320161021    142637|2.00AOnypl |AMNYPL|AY1AZD1B7"
+    acs_status_offline = "98NYYYNN01000320161021    142637|2.00AOnypl |AMNYPL|AY1AZD1B7"
+
+    def test_connections_are_logged_in_and_reused(self):
+        pool = MockSIPClient.pooled(
+            size=2, login_user_id="user", login_password="pass"
+        )
+        pool.mock.queue_response("941")
+        pool.mock.queue_response(self.patron_information)
+        response = pool.patron_information("12345", "0000")
+        eq_("SHELDON, ALICE", response['personal_name'])
+
+        # A connection was created and logged in before the request
+        # was sent.
+        eq_(1, pool.open_connections)
+        eq_(["93", "63"], [x[:2] for x in pool.mock.requests])
+
+        # The second request reuses the connection, so there's no
+        # need to log in again.
+        pool.mock.queue_response(self.patron_information)
+        pool.patron_information("12345", "0000")
+        eq_(1, pool.open_connections)
+        eq_(["93", "63", "63"], [x[:2] for x in pool.mock.requests])
+
+    def test_concurrent_checkouts_get_different_connections(self):
+        pool = MockSIPClient.pooled(size=2)
+        pool.checkout_timeout = 0
+        client1 = pool.checkout()
+        client2 = pool.checkout()
+        assert client1 != client2
+        eq_(2, pool.open_connections)
+
+        # The pool is exhausted.
+        assert_raises(IOError, pool.checkout)
+
+        # Once a connection is checked back in, it's available again.
+        pool.checkin(client1)
+        eq_(client1, pool.checkout())
+
+    def test_failed_request_discards_connection(self):
+        pool = MockSIPClient.pooled(size=2)
+        pool.mock.queue_response("Not a SIP response")
+        assert_raises(IOError, pool.patron_information, "12345")
+        eq_(0, pool.open_connections)
+        eq_([], pool.idle)
+
+    def test_expired_connections_are_closed(self):
+        pool = MockSIPClient.pooled(size=2)
+        client = pool.checkout()
+        pool.checkin(client)
+        eq_([client], pool.idle)
+
+        # The connection has been idle for too long.
+        client.pool_last_used -= pool.max_idle + 1
+        pool.evict_idle()
+        eq_([], pool.idle)
+        eq_(0, pool.open_connections)
+
+        # This connection has been open for too long.
+        client = pool.checkout()
+        client.pool_created -= pool.max_lifetime + 1
+        pool.checkin(client)
+        eq_([], pool.idle)
+        eq_(0, pool.open_connections)
+
+    def test_health_check(self):
+        pool = MockSIPClient.pooled(size=1)
+        client = pool.checkout()
+        pool.checkin(client)
+
+        # The connection has been idle long enough that it needs a
+        # health check before it's used again. The SIP server says
+        # it's online, so the connection is reused.
+        client.pool_last_used -= pool.health_check_interval + 1
+        pool.mock.queue_response(self.acs_status_online)
+        eq_(client, pool.checkout())
+        eq_("99", pool.mock.requests[-1][:2])
+        pool.checkin(client)
+
+        # This time the SIP server says it's offline, so the
+        # connection is replaced.
+        client.pool_last_used -= pool.health_check_interval + 1
+        pool.mock.queue_response(self.acs_status_offline)
+        new_client = pool.checkout()
+        assert new_client != client
+        eq_(1, pool.open_connections)
+
+    def test_warm(self):
+        pool = MockSIPClient.pooled(
+            size=3, login_user_id="user", login_password="pass"
+        )
+        for i in range(3):
+            pool.mock.queue_response("941")
+        pool.warm()
+        eq_(3, pool.open_connections)
+        eq_(3, len(pool.idle))
+        eq_(["93"] * 3, [x[:2] for x in pool.mock.requests])
+
+    def test_for_configuration(self):
+        pool = SIPClientPool.for_configuration(
+            3, target_server="server.com", target_port=6001
+        )
+        eq_(3, pool.size)
+        eq_("server.com", pool.target_server)
+        eq_(pool, SIPClientPool.for_configuration(
+            3, target_server="server.com", target_port=6001
+        ))
@@ -0,0 +1,229 @@
+"""Tests of SIPPipeline against a small SIP server running on localhost."""
+
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+from api.sip.pipeline import SIPPipeline
+
+
+class MockSIPServer(SocketServer.ThreadingTCPServer):
+    """A SIP server that knows a few patrons.
+
+    :param respond: A function that takes a handler and a request
+        message and returns a response message, or None to send
+        nothing.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, respond=None):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), MockSIPHandler
+        )
+        self.respond = respond or self.default_response
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def client_kwargs(self):
+        return dict(target_server='127.0.0.1',
+                    target_port=self.server_address[1])
+
+    def default_response(self, handler, message):
+        if message.startswith('93'):
+            if 'COwrong' in message:
+                return '940'
+            return '941'
+        barcode = re.search("\|AA([^|]*)", message).group(1)
+        # Slow down a little so that requests overlap.
+        time.sleep(0.05)
+        return (
+            "64              000201610210000142637000000000000000000000000"
+            "AOnypl |AA%s|AEPATRON %s|BLY|CQY|BV0" % (barcode, barcode)
+        )
+
+
+class MockSIPHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            data = ""
+            while True:
+                chunk = self.request.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+                while '\r' in data:
+                    message, data = data.split('\r', 1)
+                    with server.lock:
+                        server.messages.append(message)
+                    response = server.respond(self, message)
+                    if response is None:
+                        continue
+                    if response is False:
+                        return
+                    sequence = re.search("\|AY([0-9])AZ", message)
+                    if sequence:
+                        response += "|AY" + sequence.group(1)
+                    self.request.sendall(response + "AZ0000\r")
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class TestSIPPipeline(object):
+
+    def setup(self):
+        self.servers = []
+
+    def teardown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def server(self, respond=None):
+        server = MockSIPServer(respond)
+        self.servers.append(server)
+        return server
+
+    def test_many_requests_to_several_servers(self):
+        server1 = self.server()
+        server2 = self.server()
+        kwargs1 = server1.client_kwargs
+        kwargs2 = dict(server2.client_kwargs, login_user_id="user",
+                       login_password="pass")
+
+        pipeline = SIPPipeline(connections_per_server=4)
+        for i in range(20):
+            pipeline.patron_information(kwargs1, "a%d" % i, tag=("a", i))
+            pipeline.patron_information(kwargs2, "b%d" % i, tag=("b", i))
+
+        results = dict(pipeline.run())
+        eq_(40, len(results))
+        for i in range(20):
+            eq_("a%d" % i, results[("a", i)]['patron_identifier'])
+            eq_("PATRON b%d" % i, results[("b", i)]['personal_name'])
+
+        # Requests were spread out over several connections, but never
+        # more than we asked for.
+        for server in server1, server2:
+            eq_(4, server.connections)
+            eq_(4, server.max_active)
+
+        # Each connection to the second server logged in once before
+        # sending any patron information requests.
+        logins = [x for x in server2.messages if x.startswith('93')]
+        eq_(4, len(logins))
+        assert server2.messages[0].startswith('93')
+        assert not any(x.startswith('93') for x in server1.messages)
+
+        # All the connections were closed when the run finished.
+        eq_([], list(pipeline.connections))
+
+    def test_resend_request(self):
+        resent = []
+        def respond(handler, message):
+            if not resent:
+                resent.append(message)
+                return "96"
+            return handler.server.default_response(handler, message)
+        server = self.server(respond)
+
+        pipeline = SIPPipeline()
+        pipeline.patron_information(server.client_kwargs, "12345")
+        [(tag, response)] = list(pipeline.run())
+        eq_("12345", response['patron_identifier'])
+
+        # The message was sent a second time without a sequence number.
+        first, second = server.messages
+        assert "|AY0AZ" in first
+        assert "|AY" not in second
+
+    def test_dropped_connection_is_retried(self):
+        dropped = []
+        def respond(handler, message):
+            if not dropped:
+                dropped.append(message)
+                return False
+            return handler.server.default_response(handler, message)
+        server = self.server(respond)
+
+        pipeline = SIPPipeline(connections_per_server=1)
+        pipeline.patron_information(server.client_kwargs, "12345")
+        [(tag, response)] = list(pipeline.run())
+        eq_("12345", response['patron_identifier'])
+        eq_(2, server.connections)
+
+    def test_request_gives_up_after_max_attempts(self):
+        server = self.server(lambda handler, message: None)
+        pipeline = SIPPipeline(timeout=0.1, max_attempts=1)
+        pipeline.patron_information(server.client_kwargs, "12345", tag=1)
+        [(tag, response)] = list(pipeline.run())
+        eq_(1, tag)
+        assert isinstance(response, IOError)
+        assert "Timed out" in str(response)
+
+    def test_unexpected_response(self):
+        server = self.server(lambda handler, message: "99")
+        pipeline = SIPPipeline()
+        pipeline.patron_information(server.client_kwargs, "12345")
+        [(tag, response)] = list(pipeline.run())
+        assert isinstance(response, IOError)
+        assert "Unexpected status code 99" in str(response)
+
+    def test_login_failure(self):
+        server = self.server()
+        kwargs = dict(server.client_kwargs, login_user_id="user",
+                      login_password="wrong")
+        pipeline = SIPPipeline(connections_per_server=2)
+        for i in range(5):
+            pipeline.patron_information(kwargs, str(i))
+        results = list(pipeline.run())
+        eq_(5, len(results))
+        for tag, response in results:
+            assert isinstance(response, IOError)
+            assert "Error logging in" in str(response)
+
+        # No patron information requests were sent.
+        assert all(x.startswith('93') for x in server.messages)
+
+    def test_cannot_connect(self):
+        # Find a port that nothing is listening on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        pipeline = SIPPipeline()
+        for i in range(3):
+            pipeline.patron_information(
+                dict(target_server='127.0.0.1', target_port=port), str(i)
+            )
+        results = list(pipeline.run())
+        eq_(3, len(results))
+        for tag, response in results:
+            assert isinstance(response, IOError)
+
+    def test_unknown_request(self):
+        pipeline = SIPPipeline()
+        assert_raises(ValueError, pipeline.queue, {}, 'checkout')
@@ -0,0 +1,187 @@
+import datetime
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from . import DatabaseTest
+from core.analytics import Analytics
+from core.model import (
+    CirculationEvent,
+    ExternalIntegration,
+    create,
+    get_one,
+)
+from api.analytics_queue import AnalyticsQueue
+
+
+class MockProvider(object):
+
+    def __init__(self):
+        self.events = []
+
+    def collect_event(self, library, license_pool, event_type, time,
+                      **kwargs):
+        self.events.append((library, license_pool, event_type, kwargs))
+
+
+class MockBatchProvider(MockProvider):
+
+    def __init__(self):
+        super(MockBatchProvider, self).__init__()
+        self.batches = []
+
+    def collect_events(self, events):
+        self.batches.append(events)
+
+
+class BrokenProvider(object):
+
+    def collect_event(self, *args, **kwargs):
+        raise Exception("Oops")
+
+
+class MockSession(object):
+
+    def __init__(self):
+        self.commits = 0
+        self.closed = False
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestAnalyticsQueue(DatabaseTest):
+
+    def setup(self):
+        super(TestAnalyticsQueue, self).setup()
+        self.provider = MockProvider()
+        self.sessions = []
+
+    def session_factory(self):
+        session = MockSession()
+        self.sessions.append(session)
+        return session
+
+    def queue(self, **kwargs):
+        kwargs.setdefault('start', False)
+        kwargs.setdefault('linger', 0)
+        return AnalyticsQueue(self.provider, self.session_factory, **kwargs)
+
+    def test_events_are_queued(self):
+        queue = self.queue()
+        queue.collect_event(None, None, "event1", old_value=1)
+        queue.collect_event(None, None, "event2")
+        eq_([], self.provider.events)
+
+        # flush() handles the queued events in one batch.
+        eq_(2, queue.flush())
+        eq_([(None, None, "event1", dict(old_value=1)),
+             (None, None, "event2", {})],
+            self.provider.events)
+        [session] = self.sessions
+        eq_(1, session.commits)
+        eq_(True, session.closed)
+
+    def test_batches(self):
+        queue = self.queue(batch_size=2)
+        for i in range(5):
+            queue.collect_event(None, None, "event%d" % i)
+        eq_(5, queue.flush())
+        eq_(5, len(self.provider.events))
+
+        # Each batch had its own session.
+        eq_(3, len(self.sessions))
+
+    def test_overflow(self):
+        queue = self.queue(max_size=2)
+        for i in range(3):
+            queue.collect_event(None, None, "event%d" % i)
+
+        # The third event didn't fit in the queue, so it was dropped.
+        eq_(1, queue.dropped)
+        queue.flush()
+        eq_(["event0", "event1"], [x[2] for x in self.provider.events])
+
+        # With the INLINE policy, an event that doesn't fit in the
+        # queue is handled right away instead.
+        self.provider.events = []
+        queue = self.queue(max_size=1, overflow=AnalyticsQueue.INLINE)
+        queue.collect_event(None, None, "queued")
+        queue.collect_event(None, None, "inline")
+        eq_(["inline"], [x[2] for x in self.provider.events])
+        queue.flush()
+        eq_(["inline", "queued"], [x[2] for x in self.provider.events])
+        eq_(0, queue.dropped)
+
+    def test_shutdown(self):
+        queue = self.queue(start=True)
+        queue.collect_event(None, None, "event")
+        queue.shutdown()
+
+        # Whatever was in the queue has been handled.
+        eq_(["event"], [x[2] for x in self.provider.events])
+        eq_(False, queue.thread.is_alive())
+
+        # Events that come in after shutdown are handled right away.
+        queue.collect_event(None, None, "late")
+        eq_(["event", "late"], [x[2] for x in self.provider.events])
+
+    def test_process_batch(self):
+        # The background thread's session loads the libraries and
+        # license pools that events refer to.
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        library = self._default_library
+        now = datetime.datetime.utcnow()
+
+        analytics = Analytics(self._db)
+        sitewide = MockBatchProvider()
+        for_library = MockProvider()
+        analytics.sitewide_providers = [sitewide, BrokenProvider()]
+        analytics.library_providers = {library.id: [for_library]}
+        queue = AnalyticsQueue(analytics, self.session_factory, start=False)
+        batch = [
+            (library.id, pool.id, "event1", now, {}),
+            (None, None, "event2", now, {}),
+        ]
+        queue.process_batch(self._db, batch)
+
+        # A provider that can handle a whole batch at once gets every
+        # event in one call.
+        eq_([[(library, pool, "event1", now, {}),
+              (None, None, "event2", now, {})]],
+            sitewide.batches)
+
+        # Other providers get one call per event. The library's
+        # provider only hears about the event in that library, and the
+        # broken provider didn't keep it from hearing about it.
+        eq_([(library, pool, "event1", {})], for_library.events)
+
+    def test_local_analytics(self):
+        # The CirculationEvents created by a batch are committed
+        # together.
+        create(
+            self._db, ExternalIntegration,
+            goal=ExternalIntegration.ANALYTICS_GOAL,
+            protocol="core.local_analytics_provider",
+        )
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        queue = AnalyticsQueue(
+            Analytics(self._db), lambda: self._db, start=False
+        )
+        queue.collect_event(
+            self._default_library, pool, CirculationEvent.CM_CHECKOUT
+        )
+        eq_(None, get_one(self._db, CirculationEvent, license_pool=pool))
+
+        queue.process_batch(self._db, queue.next_batch(0, 0))
+        event = get_one(self._db, CirculationEvent, license_pool=pool)
+        eq_(CirculationEvent.CM_CHECKOUT, event.type)
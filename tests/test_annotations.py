@@ -18,6 +18,7 @@ from api.annotations import (
     AnnotationWriter,
     AnnotationParser,
 )
+from api.tables import compacted_annotations_table
 from api.problem_details import *
 
 class AnnotationTest(DatabaseTest):
@@ -272,6 +273,138 @@ class TestAnnotationWriter(AnnotationTest, ControllerTest):
             page = AnnotationWriter.annotation_page_for(patron, identifier)
             eq_(0, len(page['items']))
 
+    def test_annotation_pages(self):
+        patron = self._patron()
+        now = datetime.datetime.now()
+        annotations = []
+        for i in range(5):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+            )
+            annotation.timestamp = now - datetime.timedelta(minutes=i)
+            annotations.append(annotation)
+
+        with self.app.test_request_context("/"):
+            container, timestamp = AnnotationWriter.annotation_container_for(
+                patron, page_size=2
+            )
+            eq_(5, container['total'])
+            eq_(annotations[0].timestamp, timestamp)
+            assert container['last'].endswith('page=2')
+
+            # The first page has the two most recent annotations and a
+            # link to the next page.
+            first = container['first']
+            eq_(2, len(first['items']))
+            assert "annotations/%i" % annotations[0].id in first['items'][0]['id']
+            eq_(container['id'], first['partOf'])
+            eq_(0, first['startIndex'])
+            assert first['next'].endswith('page=1')
+            assert 'prev' not in first
+
+            # The last page has what's left over, and no next link.
+            last = AnnotationWriter.annotation_page_for(
+                patron, page=2, page_size=2
+            )
+            eq_(AnnotationWriter.JSONLD_CONTEXT, last['@context'])
+            eq_(4, last['startIndex'])
+            eq_(1, len(last['items']))
+            assert "annotations/%i" % annotations[4].id in last['items'][0]['id']
+            assert last['prev'].endswith('page=1')
+            assert 'next' not in last
+
+    def test_changes_since(self):
+        patron = self._patron()
+        now = datetime.datetime.utcnow()
+        an_hour_ago = now - datetime.timedelta(hours=1)
+        yesterday = now - datetime.timedelta(days=1)
+
+        def annotation(timestamp, active=True):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+            )
+            annotation.timestamp = timestamp
+            annotation.active = active
+            return annotation
+        old = annotation(yesterday)
+        new = annotation(now)
+        deleted = annotation(an_hour_ago, active=False)
+
+        with self.app.test_request_context("/"):
+            since = now - datetime.timedelta(hours=2)
+            page, timestamp = AnnotationWriter.changes_since(patron, since)
+
+            # Only the annotations that changed since the given time
+            # are mentioned.
+            eq_("AnnotationPage", page['type'])
+            [item] = page['items']
+            assert "annotations/%i" % new.id in item['id']
+            [tombstone] = page['deleted']
+            assert "annotations/%i" % deleted.id in tombstone
+
+            # The new sync token is the time of the latest change,
+            # along with the change the client just heard about.
+            eq_(now, timestamp)
+            eq_((now, set([(new.id, now)])),
+                AnnotationWriter.parse_sync_token(page['syncToken']))
+
+            # If nothing has changed, the sync token stays the same.
+            since, seen = AnnotationWriter.parse_sync_token(page['syncToken'])
+            page, timestamp = AnnotationWriter.changes_since(
+                patron, since, seen=seen
+            )
+            eq_([], page['items'])
+            eq_([], page['deleted'])
+            eq_(now, timestamp)
+            eq_((now, seen),
+                AnnotationWriter.parse_sync_token(page['syncToken']))
+
+            # A change with a slightly earlier timestamp that wasn't
+            # committed until after the last sync is still found.
+            late = annotation(now - datetime.timedelta(seconds=10))
+            page, timestamp = AnnotationWriter.changes_since(
+                patron, since, seen=seen
+            )
+            [item] = page['items']
+            assert "annotations/%i" % late.id in item['id']
+            eq_(now, timestamp)
+            eq_(set([(new.id, now), (late.id, late.timestamp)]),
+                AnnotationWriter.parse_sync_token(page['syncToken'])[1])
+
+            # Without the list of changes the client has already
+            # seen, everything in the overlap window is sent again.
+            page, timestamp = AnnotationWriter.changes_since(patron, now)
+            eq_(2, len(page['items']))
+
+        eq_(None, AnnotationWriter.parse_sync_token("not a time"))
+        eq_(None, AnnotationWriter.parse_sync_token(
+            "2018-01-02T03:04:05~not a list"
+        ))
+        eq_((datetime.datetime(2018, 1, 2, 3, 4, 5), set()),
+            AnnotationWriter.parse_sync_token("2018-01-02T03:04:05"))
+
+    def test_sync_token(self):
+        now = datetime.datetime(2018, 1, 2, 3, 4, 5, 600000)
+        eq_("2018-01-02T03:04:05.600000",
+            AnnotationWriter.sync_token(now))
+
+        # Only changes within SYNC_OVERLAP of the token's time are
+        # listed.
+        seen = [
+            (2, now - datetime.timedelta(seconds=1, microseconds=5)),
+            (1, now),
+            (3, now - AnnotationWriter.SYNC_OVERLAP),
+        ]
+        token = AnnotationWriter.sync_token(now, seen)
+        eq_("2018-01-02T03:04:05.600000~1:0,2:1000005", token)
+        eq_((now, set(seen[:2])), AnnotationWriter.parse_sync_token(token))
+
     def test_detail_target(self):
         patron = self._patron()
         identifier = self._identifier()
@@ -340,6 +473,31 @@ class TestAnnotationWriter(AnnotationTest, ControllerTest):
             }
             eq_(compacted_body, detail["body"])
 
+    def test_detail_uses_stored_compacted_forms(self):
+        patron = self._patron()
+        identifier = self._identifier()
+        annotation, ignore = create(
+            self._db, Annotation,
+            patron=patron,
+            identifier=identifier,
+            motivation=Annotation.IDLING,
+            target=json.dumps({"http://www.w3.org/ns/oa#hasSource": {
+                "@id": identifier.urn
+            }}),
+        )
+        connection = self._db.connection()
+        connection.execute(
+            compacted_annotations_table.insert(),
+            annotation_id=annotation.id, target=u'{"source": "stored"}',
+            body=None
+        )
+
+        # The stored target is used instead of compacting the
+        # annotation's target again.
+        with self.app.test_request_context("/"):
+            detail = AnnotationWriter.detail(annotation)
+        eq_(dict(source="stored"), detail['target'])
+
 
 class TestAnnotationParser(AnnotationTest):
     def setup(self):
@@ -465,6 +623,38 @@ class TestAnnotationParser(AnnotationTest):
         eq_(json.dumps(expanded["http://www.w3.org/ns/oa#hasTarget"][0]), annotation.target)
         eq_(json.dumps(expanded["http://www.w3.org/ns/oa#hasBody"][0]), annotation.content)
 
+    def test_parse_stores_compacted_target_and_body(self):
+        self.pool.loan_to(self.patron)
+        data = self._sample_jsonld()
+        annotation = AnnotationParser.parse(
+            self._db, json.dumps(data), self.patron
+        )
+
+        # The compacted forms of the target and body were stored when
+        # the annotation was written.
+        [(target, body)] = AnnotationWriter.compacted_for(
+            self._db, [annotation.id]
+        ).values()
+        eq_(self.identifier.urn, json.loads(target)['source'])
+        eq_("describing", json.loads(body)['purpose'])
+
+        # Writing the annotation again replaces what was stored.
+        data['body']['bodyValue'] = "A new body"
+        AnnotationParser.parse(self._db, json.dumps(data), self.patron)
+        [(target, body)] = AnnotationWriter.compacted_for(
+            self._db, [annotation.id]
+        ).values()
+        eq_("A new body", json.loads(body)['bodyValue'])
+
+        # The stored forms go away when the annotation is deleted.
+        AnnotationParser.forget_compacted(self._db, annotation)
+        eq_({}, AnnotationWriter.compacted_for(self._db, [annotation.id]))
+
+        AnnotationParser.store_compacted(self._db, annotation)
+        self._db.delete(annotation)
+        self._db.flush()
+        eq_({}, AnnotationWriter.compacted_for(self._db, [annotation.id]))
+
     def test_parse_jsonld_with_bookmarking_motivation(self):
         """You can create multiple bookmarks in a single book."""
         self.pool.loan_to(self.patron)
@@ -11,6 +11,7 @@ from nose.tools import (
 
 import datetime
 import json
+from sqlalchemy import select
 import os
 from money import Money
 import re
@@ -56,6 +57,8 @@ from api.authenticator import (
     PatronData,
 )
 from api.simple_authentication import SimpleAuthenticationProvider
+from api.circulation import PatronActivityCache
+from api.tables import credential_cache_table
 from api.millenium_patron import MilleniumPatronAPI
 from api.opds import LibraryAnnotator
 
@@ -1370,6 +1373,34 @@ class TestAuthenticationProvider(AuthenticatorTest):
         eq_("1", patron.external_identifier)
         eq_("2", patron.authorization_identifier)
         
+    def test_authenticated_patron_consults_activity_cache(self):
+        # This patron lacks borrowing privileges and was last synced
+        # more than five seconds ago, so they'd normally be synced
+        # again.
+        patron = self._patron()
+        patron.authorization_expires = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        )
+        patron.last_external_sync = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=6)
+        )
+        provider = self.mock_basic()
+        provider.authenticate = lambda _db, header: patron
+        updated = []
+        provider.update_patron_metadata = updated.append
+
+        provider.authenticated_patron(self._db, self.credentials)
+        eq_([patron], updated)
+
+        # But their loans and holds were just fetched from every
+        # remote, so there's no need.
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.PATRON_ACTIVITY_CACHE_TTL
+        ).value = "60"
+        PatronActivityCache.from_configuration(self._db).mark_fresh(patron)
+        provider.authenticated_patron(self._db, self.credentials)
+        eq_([patron], updated)
+
     def test_authenticated_patron_updates_metadata_if_necessary(self):
         patron = self._patron()
         eq_(True, PatronUtility.needs_external_sync(patron))
@@ -1989,6 +2020,114 @@ class TestBasicAuthenticationProviderAuthenticate(AuthenticatorTest):
         eq_(None,
             provider.authenticate(self._db, self.credentials))
         
+    def test_credential_cache(self):
+        patron = self._patron()
+        patron.authorization_identifier = "barcode"
+        patrondata = PatronData(permanent_id=patron.external_identifier)
+        provider = self.mock_basic(patrondata=patrondata)
+        integration_id = self.mock_basic_integration.id
+
+        def stats():
+            return provider.credential_cache_stats(self._db, integration_id)
+
+        # By default, credentials aren't cached.
+        eq_(None, provider.credential_cache_ttl)
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        key = provider.credential_cache_key(self._db, "user", "pass")
+        eq_(None, provider._cached_login(self._db, key))
+
+        # Turn on the cache.
+        provider.credential_cache_ttl = 60
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(dict(logins=1, failed_logins=0, hits=0, negative_hits=0),
+            stats())
+
+        # The cache key doesn't contain the password, and it's the
+        # same for every process, since it's made with the site's
+        # secret key rather than a per-process salt.
+        assert "pass" not in key
+        other_provider = self.mock_basic(patrondata=patrondata)
+        eq_(key, other_provider.credential_cache_key(self._db, "user", "pass"))
+
+        # Now the remote is down, but it doesn't matter, because the
+        # patron's credentials are cached.
+        provider.patrondata = UNSUPPORTED_AUTHENTICATION_MECHANISM
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        eq_(1, stats()['hits'])
+
+        # Different credentials aren't in the cache.
+        wrong = dict(username="user", password="wrong")
+        eq_(UNSUPPORTED_AUTHENTICATION_MECHANISM,
+            provider.authenticate(self._db, wrong))
+
+        # A failed login is cached for a short time.
+        provider.patrondata = None
+        eq_(None, provider.authenticate(self._db, wrong))
+        cached = provider._cached_login(
+            self._db, provider.credential_cache_key(self._db, "user", "wrong")
+        )
+        eq_(True, cached.failed)
+        eq_(None, provider.authenticate(self._db, wrong))
+        eq_(dict(logins=1, failed_logins=1, hits=1, negative_hits=1),
+            stats())
+
+        # The stats only cover this integration.
+        eq_(dict(logins=0, failed_logins=0, hits=0, negative_hits=0),
+            provider.credential_cache_stats(
+                self._db, other_provider.external_integration_id
+            ))
+
+        # An admin can flush a patron's cached logins by their
+        # authorization identifier, whatever username they logged in
+        # with.
+        eq_(1, provider.flush_credential_cache(
+            self._db, self._default_library.id, "barcode"
+        ))
+        eq_(None, provider._cached_login(self._db, key))
+        eq_(None, provider.authenticate(self._db, self.credentials))
+
+        # Failed logins are listed under the username that was typed.
+        eq_(1, provider.flush_credential_cache(
+            self._db, self._default_library.id, "user"
+        ))
+        eq_(dict(logins=0, failed_logins=0, hits=0, negative_hits=0),
+            stats())
+
+    def test_credential_cache_expiration(self):
+        provider = self.mock_basic()
+        provider._cache_credentials(
+            self._db, "a", u"key-a", dict(username="a"), 60
+        )
+        provider._cache_credentials(self._db, "b", u"key-b", None, -1)
+
+        # An expired login isn't used or counted, and flushing it
+        # doesn't count as removing anything.
+        eq_(None, provider._cached_login(self._db, u"key-b"))
+        eq_(1, provider.credential_cache_stats(
+            self._db, self.mock_basic_integration.id
+        )['logins'])
+        eq_(0, provider.flush_credential_cache(
+            self._db, provider.library_id, "b"
+        ))
+
+        # Caching the same credentials again replaces the old entry.
+        provider._cache_credentials(self._db, "a", u"key-a", None, 60)
+        eq_(True, provider._cached_login(self._db, u"key-a").failed)
+
+        # Every so often, expired entries are purged.
+        provider._cache_credentials(self._db, "c", u"key-c", None, -1)
+        old_purge_every = provider.CREDENTIAL_CACHE_PURGE_EVERY
+        provider.CREDENTIAL_CACHE_PURGE_EVERY = 1
+        try:
+            provider._cache_credentials(self._db, "d", u"key-d", None, 60)
+        finally:
+            provider.CREDENTIAL_CACHE_PURGE_EVERY = old_purge_every
+        table = credential_cache_table
+        eq_(set([u"key-a", u"key-d"]), set(
+            row.key for row in
+            self._db.connection().execute(select([table.c.key]))
+        ))
+
     def test_server_side_validation_runs(self):
         patron = self._patron()
         patrondata = PatronData(permanent_id=patron.external_identifier)
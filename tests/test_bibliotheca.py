@@ -939,6 +939,43 @@ class TestBibliothecaEventMonitor(BibliothecaAPITest):
         eq_(new_timestamp, yesterday)
 
 
+    def test_run_once_in_parallel(self):
+        class MockAPI(MockBibliothecaAPI):
+            requested = []
+            def get_events_between(self, start, end, cache_result=False):
+                self.requested.append((start, cache_result))
+                return [(start,)]
+
+        handled = []
+        class Mock(BibliothecaEventMonitor):
+            def handle_event(self, start):
+                if start.day == 4:
+                    raise Exception("Fatal error")
+                handled.append(start)
+                return start + datetime.timedelta(hours=1)
+
+        api = MockAPI(self._db, self.collection)
+        monitor = Mock(self._db, self.collection, api_class=api, workers=3)
+        start = datetime.datetime(2018, 1, 1)
+        days = [start + datetime.timedelta(days=x) for x in range(5)]
+
+        cutoff = start + datetime.timedelta(days=5)
+        assert_raises(Exception, monitor.run_once, start, cutoff)
+
+        # The days were fetched in worker threads, so their responses
+        # weren't cached.
+        eq_(days, sorted(x[0] for x in api.requested))
+        eq_(set([False]), set(x[1] for x in api.requested))
+
+        # The events were handled in order, until the one that caused
+        # an error.
+        eq_(days[:3], handled)
+
+        # The timestamp was moved forward past the days that were
+        # handled completely, so the next run can start from there.
+        eq_(days[2] + datetime.timedelta(hours=1),
+            monitor.timestamp().timestamp)
+
     def test_handle_event(self):
         api = MockBibliothecaAPI(self._db, self.collection)
         api.queue_response(
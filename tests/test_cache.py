@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import time
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.util.cache import (
+    LRUCache,
+    SQLiteCache,
+)
+
+
+class CacheTest(object):
+    """Tests that every cache implementation should pass."""
+
+    def test_get_and_set(self):
+        cache = self.cache()
+        eq_(None, cache.get(("a", 1)))
+        eq_("default", cache.get(("a", 1), "default"))
+
+        cache.set(("a", 1), ["value"])
+        eq_(["value"], cache.get(("a", 1)))
+
+        cache.delete(("a", 1))
+        eq_(None, cache.get(("a", 1)))
+
+        cache.set("b", 2)
+        cache.clear()
+        eq_(None, cache.get("b"))
+
+    def test_expiration(self):
+        cache = self.cache(ttl=60)
+        cache.set("long", 1)
+        cache.set("short", 2, ttl=-1)
+        eq_(1, cache.get("long"))
+        eq_(None, cache.get("short"))
+
+
+class TestLRUCache(CacheTest):
+
+    def cache(self, ttl=None):
+        return LRUCache(ttl=ttl)
+
+    def test_least_recently_used_entry_is_discarded(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # Looking up "a" makes "b" the least recently used entry.
+        cache.get("a")
+        cache.set("c", 3)
+        eq_(2, len(cache))
+        eq_(1, cache.get("a"))
+        eq_(None, cache.get("b"))
+        eq_(3, cache.get("c"))
+
+    def test_contains(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("expired", 3, ttl=-1)
+        assert "a" not in cache
+        assert "b" in cache
+        assert "expired" not in cache
+
+        # Checking for "b" didn't make it the most recently used
+        # entry.
+        cache.set("expired", 3)
+        cache.set("c", 4)
+        assert "b" not in cache
+
+
+class TestSQLiteCache(CacheTest):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self, ttl=None):
+        return SQLiteCache(os.path.join(self.directory, "cache.db"), ttl=ttl)
+
+    def test_entries_are_shared(self):
+        # Two SQLiteCaches pointed at the same file see the same
+        # entries, the way two processes on one host would.
+        cache1 = self.cache()
+        cache2 = self.cache()
+        cache1.set(("patron", 1), [u"loan"])
+        eq_([u"loan"], cache2.get(("patron", 1)))
+        cache2.delete(("patron", 1))
+        eq_(None, cache1.get(("patron", 1)))
@@ -15,6 +15,7 @@ from datetime import (
     datetime, 
     timedelta,
 )
+import time
 
 from api.circulation_exceptions import *
 from api.circulation import (
@@ -24,7 +25,11 @@ from api.circulation import (
     FulfillmentInfo,
     LoanInfo,
     HoldInfo,
+    LatencyHistogram,
+    PatronActivityCache,
+    PatronActivityExecutor,
 )
+from api.util.cache import LRUCache
 
 from core.config import CannotLoadConfiguration
 from core.model import (
@@ -832,6 +837,102 @@ class TestCirculationAPI(DatabaseTest):
         # ... and (once we commit) with the LicensePool.
         self._db.commit()
         assert loan.fulfillment in pool.delivery_mechanisms
+
+    def test_sync_bookshelf_creates_many_loans_and_holds(self):
+        pools = [
+            self._licensepool(None, collection=self.collection)
+            for i in range(4)
+        ]
+        for pool in pools[:2]:
+            self.circulation.add_remote_loan(
+                pool.collection, pool.data_source, pool.identifier.type,
+                pool.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS
+            )
+        for pool in pools[2:]:
+            self.circulation.add_remote_hold(
+                pool.collection, pool.data_source, pool.identifier.type,
+                pool.identifier.identifier, self.TODAY, self.IN_TWO_WEEKS, 3
+            )
+
+        loans, holds = self.circulation.sync_bookshelf(self.patron, "1234")
+
+        # The new loans and holds were created, and are returned in
+        # the order the remote gave them to us.
+        eq_(pools[:2], [x.license_pool for x in loans])
+        eq_(pools[2:], [x.license_pool for x in holds])
+        eq_(set(loans), set(self.patron.loans))
+        eq_(set(holds), set(self.patron.holds))
+        for loan in loans:
+            eq_(self.TODAY, loan.start)
+            eq_(self.IN_TWO_WEEKS, loan.end)
+        for hold in holds:
+            eq_(3, hold.position)
+
+        # Syncing again doesn't create any duplicates.
+        self.circulation.sync_bookshelf(self.patron, "1234")
+        eq_(2, self._db.query(Loan).count())
+        eq_(2, self._db.query(Hold).count())
+
+    def test_sync_bookshelf_gives_new_holds_a_start_date(self):
+        pool = self._licensepool(None, collection=self.collection)
+        self.circulation.add_remote_hold(
+            pool.collection, pool.data_source, pool.identifier.type,
+            pool.identifier.identifier, None, None, 3
+        )
+        before = datetime.utcnow()
+        loans, [hold] = self.circulation.sync_bookshelf(self.patron, "1234")
+        assert hold.start >= before
+
+    def test_sync_bookshelf_when_loans_and_holds_already_exist(self):
+        # While the bookshelf was being synced, the patron borrowed
+        # one book and put another on hold, so the loan and the hold
+        # exist by the time sync_bookshelf gets around to creating
+        # them.
+        loan_pool = self._licensepool(None, collection=self.collection)
+        hold_pool = self._licensepool(None, collection=self.collection)
+        loan, ignore = loan_pool.loan_to(self.patron, start=self.YESTERDAY)
+        hold, ignore = hold_pool.on_hold_to(self.patron, position=1)
+        self.circulation.add_remote_loan(
+            loan_pool.collection, loan_pool.data_source,
+            loan_pool.identifier.type, loan_pool.identifier.identifier,
+            self.TODAY, self.IN_TWO_WEEKS
+        )
+        self.circulation.add_remote_hold(
+            hold_pool.collection, hold_pool.data_source,
+            hold_pool.identifier.type, hold_pool.identifier.identifier,
+            self.TODAY, self.IN_TWO_WEEKS, 3
+        )
+        nothing = lambda patron, model: self._db.query(model).filter(
+            model.id==None
+        )
+        self.circulation.local_loans = lambda patron: nothing(patron, Loan)
+        self.circulation.local_holds = lambda patron: nothing(patron, Hold)
+
+        # That doesn't stop the sync; the existing loan and hold are
+        # used.
+        loans, holds = self.circulation.sync_bookshelf(self.patron, "1234")
+        eq_([loan], loans)
+        eq_([hold], holds)
+        eq_(1, self._db.query(Loan).count())
+        eq_(1, self._db.query(Hold).count())
+
+    def test_license_pools_for(self):
+        loan = LoanInfo(
+            self.collection, self.pool.data_source, self.identifier.type,
+            self.identifier.identifier, None, None
+        )
+        # This LicensePool doesn't exist yet.
+        hold = HoldInfo(
+            self.collection, DataSource.BIBLIOTHECA,
+            Identifier.BIBLIOTHECA_ID, "new-id", None, None, None
+        )
+        pools = self.circulation.license_pools_for([loan, hold])
+        eq_(self.pool, pools[loan.pool_key])
+
+        # A LicensePool was created for the hold.
+        new_pool = pools[hold.pool_key]
+        eq_("new-id", new_pool.identifier.identifier)
+        eq_(self.collection, new_pool.collection)
         
     def test_patron_activity(self):
         # Get a CirculationAPI that doesn't mock out its API's patron activity.
@@ -856,6 +957,161 @@ class TestCirculationAPI(DatabaseTest):
         eq_(0, len(holds))
         eq_(False, complete)        
 
+    def test_patron_activity_gives_up_on_slow_api(self):
+        # One API responds promptly; the other takes longer than
+        # its deadline.
+        class Prompt(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                return [LoanInfo(
+                    collection, DataSource.BIBLIOTHECA, Identifier.ISBN,
+                    "1", None, None
+                )]
+
+        class Slow(BaseCirculationAPI):
+            PATRON_ACTIVITY_TIMEOUT = 0.01
+            def patron_activity(self, patron, pin):
+                time.sleep(0.5)
+                return [HoldInfo(
+                    collection, DataSource.BIBLIOTHECA, Identifier.ISBN,
+                    "2", None, None, 1
+                )]
+
+        PatronActivityExecutor.reset()
+        collection = self.collection
+        circulation = CirculationAPI(self._db, self._default_library)
+        circulation.api_for_collection = {1: Prompt(), 2: Slow()}
+
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+
+        # We got the prompt API's loan, but we didn't wait around
+        # for the slow API's hold, so the results are incomplete.
+        eq_(["1"], [x.identifier for x in loans])
+        eq_([], holds)
+        eq_(False, complete)
+
+        # The timeout was recorded in the slow API's histogram.
+        eq_(1, PatronActivityExecutor.latency_report()['Slow']['timeouts'])
+        PatronActivityExecutor.reset()
+
+    def test_patron_activity_uses_its_own_session(self):
+        # Each call to an API's patron_activity runs in its own
+        # session, so a call that's given up on can't interfere with
+        # the caller's session.
+        sessions = []
+        class Recorder(BaseCirculationAPI):
+            def __init__(self):
+                self._db = None
+            def patron_activity(self, patron, pin):
+                sessions.append((self._db, patron.id))
+                return []
+
+        PatronActivityExecutor.reset()
+        api = Recorder()
+        circulation = CirculationAPI(self._db, self._default_library)
+        circulation.api_for_collection = {1: api}
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(True, complete)
+        [(session, patron_id)] = sessions
+        assert session not in (None, self._db)
+        eq_(self.patron.id, patron_id)
+
+        # The original API object still has no session.
+        eq_(None, api._db)
+        PatronActivityExecutor.reset()
+
+    def test_patron_activity_limits_calls_per_api(self):
+        class Hung(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                raise Exception("Should not be called")
+
+        # Every call this API is allowed is already in progress.
+        PatronActivityExecutor.reset()
+        PatronActivityExecutor.in_flight['Hung'] = (
+            PatronActivityExecutor.MAX_CALLS_PER_API
+        )
+        circulation = CirculationAPI(self._db, self._default_library)
+        circulation.api_for_collection = {1: Hung()}
+
+        # Rather than wait behind them, patron_activity gives up on
+        # the API right away.
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(([], [], False), (loans, holds, complete))
+        PatronActivityExecutor.reset()
+
+    def test_patron_activity_timeout_setting(self):
+        circulation = CirculationAPI(
+            self._db, self._default_library, api_map={
+                ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+            }
+        )
+        api = circulation.api_for_collection[self.collection.id]
+
+        # By default, the API class's timeout is used.
+        eq_(BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT,
+            circulation.patron_activity_timeout(self.collection, api))
+
+        # The collection's integration can override it.
+        self.collection.external_integration.setting(
+            BaseCirculationAPI.PATRON_ACTIVITY_TIMEOUT_KEY
+        ).value = "5"
+        eq_(5, circulation.patron_activity_timeout(self.collection, api))
+
+    def test_patron_activity_cache(self):
+        cache = PatronActivityCache(LRUCache(), 60)
+        circulation = CirculationAPI(
+            self._db, self._default_library, api_map={
+                ExternalIntegration.BIBLIOTHECA : MockBibliothecaAPI
+            }, activity_cache=cache
+        )
+        mock_bibliotheca = circulation.api_for_collection[self.collection.id]
+        data = sample_data("checkouts.xml", "bibliotheca")
+        mock_bibliotheca.queue_response(200, content=data)
+
+        loans, holds, complete = circulation.patron_activity(self.patron, "1234")
+        eq_((2, 2, True), (len(loans), len(holds), complete))
+
+        # Every remote was just asked, so the patron's activity is
+        # fresh.
+        eq_(True, cache.is_fresh(self.patron))
+
+        # The second time, the activity comes from the cache rather
+        # than from Bibliotheca -- if we'd asked Bibliotheca, there
+        # would have been no response queued, and we'd have gotten
+        # an error.
+        #
+        # This cache belongs to one process, and another process may
+        # have made a loan it doesn't know about, so the results
+        # can't be trusted to decide what to delete.
+        loans, holds, complete = circulation.patron_activity(self.patron, "1234")
+        eq_((2, 2, False), (len(loans), len(holds), complete))
+
+        # A cache shared by every process can be trusted.
+        cache.shared = True
+        loans, holds, complete = circulation.patron_activity(self.patron, "1234")
+        eq_((2, 2, True), (len(loans), len(holds), complete))
+
+        # Returning a book invalidates the cache for the book's
+        # collection.
+        self.pool.loan_to(self.patron)
+        mock_bibliotheca.queue_response(200)
+        circulation.revoke_loan(self.patron, "1234", self.pool)
+        eq_(None, cache.get(self.patron, self.collection.id))
+        eq_(False, cache.is_fresh(self.patron))
+
+        # So now we go to Bibliotheca.
+        mock_bibliotheca.queue_response(500, content="Error")
+        loans, holds, complete = circulation.patron_activity(self.patron, "1234")
+        eq_((0, 0, False), (len(loans), len(holds), complete))
+
+        # An incomplete sync doesn't make the activity fresh.
+        eq_(False, cache.is_fresh(self.patron))
+
     def test_can_fulfill_without_loan(self):
         """Can a title can be fulfilled without an active loan?  It depends on
         the BaseCirculationAPI implementation for that title's colelction.
@@ -994,3 +1250,18 @@ class TestConfigurationFailures(DatabaseTest):
         assert isinstance(e, CannotLoadConfiguration)
         eq_("doomed!", e.message)
 
+
+class TestLatencyHistogram(object):
+
+    def test_record(self):
+        histogram = LatencyHistogram(buckets=[1, 5])
+        histogram.record(0.5)
+        histogram.record(2)
+        histogram.record(100)
+        histogram.record_timeout()
+
+        snapshot = histogram.snapshot()
+        eq_([(1, 1), (5, 2), ("+Inf", 3)], snapshot['buckets'])
+        eq_(3, snapshot['count'])
+        eq_(102.5, snapshot['sum'])
+        eq_(1, snapshot['timeouts'])
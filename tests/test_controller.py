@@ -124,7 +124,10 @@ from core.opds import (
 from core.util.opds_writer import (
     OPDSFeed,
 )
-from api.opds import LibraryAnnotator
+from api.opds import (
+    LibraryAnnotator,
+    LibraryLoanAndHoldAnnotator,
+)
 from api.annotations import AnnotationWriter
 from api.testing import (
     VendorIDTest,
@@ -1691,6 +1694,45 @@ class TestLoanController(CirculationControllerTest):
             eq_(0, len(bibliotheca_revoke_links))
 
 
+    def test_active_loans_etag(self):
+        headers = dict(Authorization=self.valid_auth)
+        with self.request_context_with_library("/", headers=headers):
+            response = self.manager.loans.sync()
+        eq_(200, response.status_code)
+
+        # The ETag is calculated from what the feed is made from, not
+        # the feed itself, so it's a weak one.
+        etag = response.headers['ETag']
+        assert etag.startswith('W/')
+
+        # Nothing has changed, so a client that sends the ETag back
+        # gets a 304 response, and the feed isn't made at all.
+        headers['If-None-Match'] = etag
+        old_active_loans_for = LibraryLoanAndHoldAnnotator.__dict__['active_loans_for']
+        @classmethod
+        def fail(*args, **kwargs):
+            raise Exception("The feed shouldn't be generated.")
+        LibraryLoanAndHoldAnnotator.active_loans_for = fail
+        try:
+            with self.request_context_with_library("/", headers=headers):
+                response = self.manager.loans.sync()
+        finally:
+            LibraryLoanAndHoldAnnotator.active_loans_for = old_active_loans_for
+        eq_(304, response.status_code)
+        eq_("", response.data)
+        eq_(etag, response.headers['ETag'])
+        assert response.headers['Cache-Control'].startswith('private,')
+
+        # Once the patron borrows a book, the ETag changes.
+        with self.request_context_with_library("/", headers=headers):
+            patron = self.manager.loans.authenticated_patron_from_request()
+            self.english_1.license_pools[0].loan_to(patron)
+            response = self.manager.loans.sync()
+        eq_(200, response.status_code)
+        assert response.headers['ETag'] != etag
+        assert self.english_1.title in response.data
+
+
 class TestAnnotationController(CirculationControllerTest):
     def setup(self):
         super(TestAnnotationController, self).setup()
@@ -1798,6 +1840,44 @@ class TestAnnotationController(CirculationControllerTest):
             expected_time = format_date_time(mktime(annotation.timestamp.timetuple()))
             eq_(expected_time, response.headers['Last-Modified'])
 
+    def test_get_container_page(self):
+        self.pool.loan_to(self.default_patron)
+        now = datetime.datetime.now()
+        for i in range(3):
+            annotation, ignore = create(
+                self._db, Annotation,
+                patron=self.default_patron,
+                identifier=self._identifier(),
+                motivation=Annotation.IDLING,
+            )
+            annotation.active = True
+            annotation.timestamp = now - datetime.timedelta(minutes=i)
+
+        old_page_size = AnnotationWriter.PAGE_SIZE
+        AnnotationWriter.PAGE_SIZE = 2
+        try:
+            with self.request_context_with_library(
+                    "/?page=1", headers=dict(Authorization=self.valid_auth)):
+                self.manager.annotations.authenticated_patron_from_request()
+                response = self.manager.annotations.container()
+                eq_(200, response.status_code)
+
+                # We've been given the second page of the container,
+                # not the container itself.
+                page = json.loads(response.data)
+                eq_("AnnotationPage", page['type'])
+                eq_(2, page['startIndex'])
+                eq_(1, len(page['items']))
+                eq_('W/"%s"' % now, response.headers['ETag'])
+
+            with self.request_context_with_library(
+                    "/?page=nope", headers=dict(Authorization=self.valid_auth)):
+                self.manager.annotations.authenticated_patron_from_request()
+                response = self.manager.annotations.container()
+                eq_(INVALID_INPUT.uri, response.uri)
+        finally:
+            AnnotationWriter.PAGE_SIZE = old_page_size
+
     def test_post_to_container(self):
         data = dict()
         data['@context'] = AnnotationWriter.JSONLD_CONTEXT
@@ -1922,6 +2002,7 @@ class TestAnnotationController(CirculationControllerTest):
             motivation=Annotation.IDLING,
         )
         annotation.active = True
+        before = datetime.datetime.utcnow()
 
         with self.request_context_with_library(
                 "/", method='DELETE', headers=dict(Authorization=self.valid_auth)):
@@ -1932,6 +2013,66 @@ class TestAnnotationController(CirculationControllerTest):
             # The annotation has been marked inactive.
             eq_(False, annotation.active)
 
+            # Its timestamp is in UTC, like every other annotation
+            # timestamp.
+            assert annotation.timestamp >= before
+
+        # The deletion shows up when a client asks what's changed.
+        with self.request_context_with_library(
+                "/?since=2000-01-01T00:00:00",
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            changes = json.loads(response.data)
+            eq_([], changes['items'])
+            [deleted] = changes['deleted']
+            assert str(annotation.id) in deleted
+
+    def test_get_changes_since(self):
+        self.pool.loan_to(self.default_patron)
+        now = datetime.datetime.utcnow()
+        annotation, ignore = create(
+            self._db, Annotation,
+            patron=self.default_patron,
+            identifier=self.identifier,
+            motivation=Annotation.IDLING,
+        )
+        annotation.active = True
+        annotation.timestamp = now
+        token = AnnotationWriter.sync_token(now - datetime.timedelta(hours=1))
+
+        with self.request_context_with_library(
+                "/?since=%s" % token,
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            eq_(200, response.status_code)
+            changes = json.loads(response.data)
+            [item] = changes['items']
+            assert str(annotation.id) in item['id']
+            expect_token = AnnotationWriter.sync_token(
+                now, [(annotation.id, now)]
+            )
+            eq_(expect_token, changes['syncToken'])
+
+        # Using the new token, there's nothing to report.
+        with self.request_context_with_library(
+                "/?since=%s" % changes['syncToken'],
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            changes = json.loads(response.data)
+            eq_([], changes['items'])
+            eq_([], changes['deleted'])
+            eq_(expect_token, changes['syncToken'])
+
+        with self.request_context_with_library(
+                "/?since=yesterday",
+                headers=dict(Authorization=self.valid_auth)):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            eq_(INVALID_INPUT.uri, response.uri)
+
 
 class TestWorkController(CirculationControllerTest):
     def setup(self):
@@ -2480,6 +2621,36 @@ class TestFeedController(CirculationControllerTest):
         ["french_1", u"Très Français", "Marianne", "fre", False],
     ]
 
+    def test_feed_etag(self):
+        SessionManager.refresh_materialized_views(self._db)
+        with self.request_context_with_library("/"):
+            response = self.manager.opds_feeds.feed(
+                self.english_adult_fiction.id
+            )
+        eq_(200, response.status_code)
+        etag = response.headers['ETag']
+        assert etag
+
+        # A client that already has this version of the feed gets a
+        # 304 response.
+        headers = {"If-None-Match": etag}
+        with self.request_context_with_library("/", headers=headers):
+            response = self.manager.opds_feeds.feed(
+                self.english_adult_fiction.id
+            )
+        eq_(304, response.status_code)
+        eq_("", response.data)
+        eq_(etag, response.headers['ETag'])
+
+        # A client with some other version gets the whole feed.
+        headers = {"If-None-Match": '"some other version"'}
+        with self.request_context_with_library("/", headers=headers):
+            response = self.manager.opds_feeds.feed(
+                self.english_adult_fiction.id
+            )
+        eq_(200, response.status_code)
+        assert self.english_1.title in response.data
+
     def test_feed(self):
         SessionManager.refresh_materialized_views(self._db)
 
@@ -0,0 +1,61 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+import datetime
+
+from sqlalchemy import select
+
+from . import DatabaseTest
+from api.feed_cache import ChangedWorkQueue
+from api.tables import changed_works_table
+
+
+class TestChangedWorkQueue(DatabaseTest):
+
+    def queued(self):
+        return sorted(
+            row.work_id for row in
+            self._db.connection().execute(select([changed_works_table]))
+        )
+
+    def test_availability_change_is_queued(self):
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        self._db.flush()
+
+        ChangedWorkQueue.watch(self._db)
+        # Watching the same session twice doesn't record changes twice.
+        ChangedWorkQueue.watch(self._db)
+        eq_([], self.queued())
+
+        # Changing something other than availability doesn't put the
+        # work in the queue.
+        pool.last_checked = datetime.datetime.utcnow()
+        self._db.flush()
+        eq_([], self.queued())
+
+        pool.licenses_available = pool.licenses_available + 1
+        self._db.flush()
+        eq_([work.id], self.queued())
+
+    def test_latest_change(self):
+        work = self._work()
+        other = self._work()
+
+        # Before anything is watched, the table doesn't exist yet.
+        eq_(None, ChangedWorkQueue.latest_change(self._db, [work.id]))
+
+        ChangedWorkQueue.watch(self._db)
+        eq_(None, ChangedWorkQueue.latest_change(self._db, [work.id]))
+
+        long_ago = datetime.datetime(2010, 1, 1)
+        recently = datetime.datetime(2018, 1, 1)
+        connection = self._db.connection()
+        ChangedWorkQueue.add(connection, [work.id], long_ago)
+        ChangedWorkQueue.add(connection, [work.id, other.id], recently)
+        eq_(recently, ChangedWorkQueue.latest_change(self._db, [work.id]))
+
+        # Pruning removes the old changes and keeps the new ones.
+        ChangedWorkQueue.prune(self._db, recently)
+        eq_(sorted([work.id, other.id]), self.queued())
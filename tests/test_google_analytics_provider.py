@@ -7,7 +7,10 @@ from api.config import (
     CannotLoadConfiguration,
 )
 from core.analytics import Analytics
-from api.google_analytics_provider import GoogleAnalyticsProvider
+from api.google_analytics_provider import (
+    GoogleAnalyticsProvider,
+    HitBuffer,
+)
 from . import DatabaseTest
 from core.model import (
     get_one_or_create,
@@ -21,6 +24,7 @@ from core.model import (
 import unicodedata
 import urlparse
 import datetime
+import requests
 from psycopg2.extras import NumericRange
 
 class MockGoogleAnalyticsProvider(GoogleAnalyticsProvider):
@@ -30,8 +34,64 @@ class MockGoogleAnalyticsProvider(GoogleAnalyticsProvider):
         self.url = url
         self.params = params
 
+class MockResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class MockHTTPSession(object):
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posts = []
+
+    def post(self, url, data, timeout):
+        self.posts.append((url, data))
+        response = self.responses.pop(0) if self.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        return MockResponse(response)
+
+
+class MockBatchingGoogleAnalyticsProvider(GoogleAnalyticsProvider):
+
+    def __init__(self, *args, **kwargs):
+        super(MockBatchingGoogleAnalyticsProvider, self).__init__(*args, **kwargs)
+        self.session = MockHTTPSession()
+        self.sleeps = []
+
+    def http_session(self):
+        return self.session
+
+    @classmethod
+    def hit_buffer(cls):
+        return cls.buffer
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
 class TestGoogleAnalyticsProvider(DatabaseTest):
 
+    def setup(self):
+        super(TestGoogleAnalyticsProvider, self).setup()
+        # Nothing is sent until the test calls send_queued().
+        MockBatchingGoogleAnalyticsProvider.buffer = HitBuffer(start=False)
+
+    def batching_provider(self):
+        integration, ignore = create(
+            self._db, ExternalIntegration,
+            goal=ExternalIntegration.ANALYTICS_GOAL,
+            protocol="api.google_analytics_provider",
+        )
+        integration.setting(GoogleAnalyticsProvider.SEND_IN_BATCHES).value = "true"
+        integration.setting(GoogleAnalyticsProvider.BATCH_URL).value = "http://localhost/batch"
+        ConfigurationSetting.for_library_and_externalintegration(
+            self._db, GoogleAnalyticsProvider.TRACKING_ID, self._default_library, integration
+        ).value = "faketrackingid"
+        return MockBatchingGoogleAnalyticsProvider(integration, self._default_library)
+
     def test_init(self):
         integration, ignore = create(
             self._db, ExternalIntegration,
@@ -186,3 +246,144 @@ class TestGoogleAnalyticsProvider(DatabaseTest):
         eq_(None, params.get('cd10'))
         eq_(None, params.get('cd11'))
         eq_(None, params.get('cd12'))
+
+    def test_batch_settings(self):
+        ga = self.batching_provider()
+        eq_(True, ga.batching)
+        eq_("http://localhost/batch", ga.batch_url)
+
+    def test_batches(self):
+        ga = self.batching_provider()
+
+        # A batch can't have more than 20 hits...
+        hits = ["hit%d" % i for i in range(45)]
+        eq_([20, 20, 5], [len(x) for x in ga.batches(hits)])
+
+        # ...or be bigger than 16K, counting the newlines between hits.
+        hits = ["x" * 4095] * 9
+        eq_([4, 4, 1], [len(x) for x in ga.batches(hits)])
+
+        # A hit that's too big to send at all is left out.
+        hits = ["small", "x" * (8 * 1024 + 1), "small"]
+        eq_([["small", "small"]], list(ga.batches(hits)))
+
+    def test_collect_event_in_batch_mode(self):
+        ga = self.batching_provider()
+        buffer = ga.hit_buffer()
+        now = datetime.datetime.utcnow()
+
+        # Hits wait until there are enough of them to fill a batch.
+        for i in range(19):
+            ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+        eq_(0, buffer.send_queued())
+        eq_([], ga.session.posts)
+        ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+        eq_(1, buffer.send_queued())
+        [(url, payload)] = ga.session.posts
+        eq_("http://localhost/batch", url)
+        hits = payload.split("\n")
+        eq_(20, len(hits))
+        params = urlparse.parse_qs(hits[0])
+        eq_("faketrackingid", params['tid'][0])
+        eq_(CirculationEvent.NEW_PATRON, params['ea'][0])
+        eq_({}, buffer.pending)
+
+        # flush() sends whatever is waiting.
+        ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+        eq_(1, len(buffer.pending[ga.batch_url][1]))
+        ga.flush()
+        eq_(1, buffer.send_queued())
+        eq_(2, len(ga.session.posts))
+        eq_({}, buffer.pending)
+
+    def test_collect_events(self):
+        ga = self.batching_provider()
+        now = datetime.datetime.utcnow()
+        events = [
+            (self._default_library, None, CirculationEvent.NEW_PATRON, now, {})
+        ] * 25
+
+        # A group of events is sent right away, even if the last batch
+        # isn't full.
+        ga.collect_events(events)
+        ga.hit_buffer().send_queued()
+        eq_([20, 5], [len(payload.split("\n"))
+                      for url, payload in ga.session.posts])
+
+    def test_providers_share_a_buffer(self):
+        # Hits from two providers for the same batch URL go out in the
+        # same batch.
+        ga1 = self.batching_provider()
+        ga2 = self.batching_provider()
+        now = datetime.datetime.utcnow()
+        for ga in [ga1, ga2] * 10:
+            ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+        ga1.hit_buffer().send_queued()
+        [(url, payload)] = ga1.session.posts + ga2.session.posts
+        eq_(20, len(payload.split("\n")))
+
+    def test_old_hits_are_sent(self):
+        ga = self.batching_provider()
+        buffer = ga.hit_buffer()
+        now = datetime.datetime.utcnow()
+        ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+
+        # A batch that isn't full stays put for a while...
+        buffer.queue_old_batches()
+        eq_(0, buffer.send_queued())
+
+        # ...but not once its oldest hit has waited too long.
+        provider, hits, since = buffer.pending[ga.batch_url]
+        buffer.pending[ga.batch_url] = (
+            provider, hits, since - buffer.max_age
+        )
+        buffer.queue_old_batches()
+        eq_(1, buffer.send_queued())
+        eq_(1, len(ga.session.posts))
+        eq_({}, buffer.pending)
+
+    def test_shutdown(self):
+        ga = self.batching_provider()
+        buffer = ga.hit_buffer()
+        now = datetime.datetime.utcnow()
+        ga.collect_event(self._default_library, None, CirculationEvent.NEW_PATRON, now)
+
+        # Whatever was waiting is sent.
+        buffer.shutdown()
+        eq_(1, len(ga.session.posts))
+
+        # Once the buffer has shut down, a full batch is sent right
+        # away, on the caller's thread.
+        ga.collect_events(
+            [(self._default_library, None, CirculationEvent.NEW_PATRON, now, {})]
+        )
+        eq_(2, len(ga.session.posts))
+
+    def test_post_batch_retries(self):
+        ga = self.batching_provider()
+        ga.session = MockHTTPSession(
+            requests.exceptions.ConnectionError("Could not connect!"),
+            503, 200
+        )
+        eq_(True, ga.post_batch(["hit1", "hit2"]))
+        eq_(3, len(ga.session.posts))
+        eq_("hit1\nhit2", ga.session.posts[0][1])
+
+        # It waited longer before each retry.
+        eq_([1, 2], ga.sleeps)
+
+        # A batch that still can't be sent after every retry is given
+        # up on.
+        ga.sleeps = []
+        ga.session = MockHTTPSession(500, 500, 500, 500, 500)
+        eq_(False, ga.post_batch(["hit"]))
+        eq_(4, len(ga.session.posts))
+        eq_([1, 2, 4], ga.sleeps)
+
+        # No retry starts once MAX_SEND_TIME has passed.
+        ga.sleeps = []
+        ga.MAX_SEND_TIME = 2
+        ga.session = MockHTTPSession(500, 500, 500, 500)
+        eq_(False, ga.post_batch(["hit"]))
+        eq_(2, len(ga.session.posts))
+        eq_([1], ga.sleeps)
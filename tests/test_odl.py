@@ -9,6 +9,8 @@ import datetime
 import re
 import base64
 
+from sqlalchemy import event
+
 from . import DatabaseTest
 from core.model import (
     Collection,
@@ -820,6 +822,180 @@ class TestODLWithConsolidatedCopiesAPI(DatabaseTest, BaseODLTest):
             eq_(0, hold.position)
             assert hold.end - datetime.datetime.utcnow() - datetime.timedelta(days=3) < datetime.timedelta(hours=1)
 
+    def test_update_hold_queue_matches_update_hold_end_date(self):
+        # update_hold_queue recalculates every hold in the queue at
+        # once. The results are the same as updating each hold with
+        # _update_hold_end_date, in the order the holds were placed,
+        # except that a hold that didn't move keeps its end date.
+        self.collection.external_integration.set_setting(
+            Collection.DEFAULT_RESERVATION_PERIOD_KEY, 3
+        )
+        self.collection.external_integration.set_setting(
+            Collection.EBOOK_LOAN_DURATION_KEY, 6
+        )
+        now = datetime.datetime.utcnow()
+        def days(n):
+            return now + datetime.timedelta(days=n)
+
+        self.pool.licenses_owned = 4
+        for end in (days(2), days(5), days(-1)):
+            self.pool.loan_to(self._patron(), end=end)
+
+        holds = []
+        # Two holds that already have reserved licenses.
+        for i in range(2):
+            hold, ignore = self.pool.on_hold_to(
+                self._patron(), start=days(-10+i), end=days(1+i), position=0
+            )
+            holds.append(hold)
+        # A hold whose reservation expired.
+        expired, ignore = self.pool.on_hold_to(
+            self._patron(), start=days(-20), end=days(-1), position=0
+        )
+        # A long line of holds in various states.
+        for i in range(12):
+            hold, ignore = self.pool.on_hold_to(
+                self._patron(), start=days(-7) + datetime.timedelta(hours=i),
+                position=i+5
+            )
+            holds.append(hold)
+        # Two holds placed at exactly the same time.
+        for i in range(2):
+            hold, ignore = self.pool.on_hold_to(
+                self._patron(), start=days(-1), end=days(30), position=1
+            )
+            holds.append(hold)
+
+        original = [(hold.position, hold.end) for hold in holds]
+        def reset():
+            for hold, (position, end) in zip(holds, original):
+                hold.position = position
+                hold.end = end
+
+        def state():
+            return [(hold.position, hold.end) for hold in holds]
+
+        self.api.update_hold_queue(self.pool)
+        recalculated = state()
+
+        reset()
+        for hold in holds:
+            position, end = hold.position, hold.end
+            self.api._update_hold_end_date(hold)
+            if hold.position == position and end:
+                hold.end = end
+        expected = state()
+
+        for (position, end), (expect_position, expect_end) in zip(
+            recalculated, expected
+        ):
+            eq_(expect_position, position)
+            assert abs(end - expect_end) < datetime.timedelta(minutes=1)
+
+        # Some holds moved and some didn't.
+        moved = [hold for hold, (position, end) in zip(holds, original)
+                 if hold.position != position]
+        assert 0 < len(moved) < len(holds)
+
+        # The expired hold wasn't touched.
+        eq_(0, expired.position)
+        eq_(days(-1), expired.end)
+
+        # The hold queue is correct.
+        eq_(2, self.pool.licenses_reserved)
+        eq_(0, self.pool.licenses_available)
+        eq_(16, self.pool.patrons_in_hold_queue)
+
+    def test_update_hold_queue_leaves_unmoved_holds_alone(self):
+        now = datetime.datetime.utcnow()
+        self.pool.licenses_owned = 1
+        self.pool.loan_to(self._patron(), end=now + datetime.timedelta(days=2))
+        first, ignore = self.pool.on_hold_to(
+            self._patron(), start=now - datetime.timedelta(days=2),
+            end=now + datetime.timedelta(days=20), position=1
+        )
+        second, ignore = self.pool.on_hold_to(
+            self._patron(), start=now - datetime.timedelta(days=1),
+            end=now + datetime.timedelta(days=40), position=5
+        )
+        self.api.update_hold_queue(self.pool)
+
+        # The first hold is still first in line, so its estimated end
+        # date wasn't recalculated.
+        eq_(1, first.position)
+        eq_(now + datetime.timedelta(days=20), first.end)
+
+        # The second hold moved up, and got a new estimate.
+        eq_(2, second.position)
+        assert second.end != now + datetime.timedelta(days=40)
+
+        # The new values are in the database, not waiting to be
+        # flushed.
+        eq_(False, self._db.is_modified(second))
+        self._db.expire(second)
+        eq_(2, second.position)
+
+    def test_update_hold_queue_writes_only_changed_holds(self):
+        # A loan was returned, so the first hold in line gets a
+        # reserved license. The old update_hold_queue only updated
+        # that hold, and left the rest of the queue as it was. Now the
+        # rest of the queue is brought up to date too, but only the
+        # holds that actually change are written.
+        self.collection.external_integration.set_setting(
+            Collection.DEFAULT_RESERVATION_PERIOD_KEY, 3
+        )
+        now = datetime.datetime.utcnow()
+        def days(n):
+            return now + datetime.timedelta(days=n)
+
+        self.pool.licenses_owned = 2
+        self.pool.loan_to(self._patron(), end=days(4))
+        reserved, ignore = self.pool.on_hold_to(
+            self._patron(), start=days(-3), end=days(20), position=2
+        )
+        moved, ignore = self.pool.on_hold_to(
+            self._patron(), start=days(-2), end=days(30), position=3
+        )
+        unmoved, ignore = self.pool.on_hold_to(
+            self._patron(), start=days(-1), end=days(40), position=3
+        )
+        self._db.flush()
+
+        updates = []
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if statement.startswith("UPDATE holds"):
+                if not executemany:
+                    parameters = [parameters]
+                updates.extend(parameters)
+        bind = self._db.get_bind()
+        event.listen(bind, "before_cursor_execute", capture)
+        try:
+            self.api.update_hold_queue(self.pool)
+        finally:
+            event.remove(bind, "before_cursor_execute", capture)
+
+        # The reserved hold got the same update as before.
+        eq_(0, reserved.position)
+        assert abs(reserved.end - days(3)) < datetime.timedelta(minutes=1)
+
+        # The old algorithm would have left the next hold at position
+        # 3. It moved up, and got the end date _update_hold_end_date
+        # would give it.
+        eq_(2, moved.position)
+        recalculated = moved.end
+        self.api._update_hold_end_date(moved)
+        eq_(2, moved.position)
+        assert abs(moved.end - recalculated) < datetime.timedelta(minutes=1)
+
+        # The last hold was already in the right place, so it wasn't
+        # touched.
+        eq_(3, unmoved.position)
+        eq_(days(40), unmoved.end)
+
+        # Two holds were written, in one statement.
+        eq_(2, len(updates))
+
     def test_place_hold_success(self):
         tomorrow = datetime.datetime.utcnow() + datetime.timedelta(days=1)
         self.pool.licenses_owned = 1
@@ -1406,6 +1582,102 @@ class TestODLConsolidatedCopiesMonitor(DatabaseTest, BaseODLTest):
         expected_url = "http://copies?since=%sZ" % expected_time.isoformat()
         eq_(expected_url, api.requests[2][0])
 
+    def test_run_once_resumes_interrupted_run(self):
+        collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        collection.external_integration.set_setting(
+            Collection.DATA_SOURCE_NAME_SETTING, "Feedbooks"
+        )
+        api = MockODLWithConsolidatedCopiesAPI(self._db, collection)
+        monitor = ODLConsolidatedCopiesMonitor(
+            self._db, collection, api=api, batch_size=1
+        )
+        identifiers = [
+            self._identifier(identifier_type=Identifier.URI) for i in range(3)
+        ]
+        def page(identifier, next_link):
+            links = []
+            if next_link:
+                links.append(dict(href=next_link, rel="next"))
+            return json.dumps(dict(
+                links=links,
+                copies=[dict(identifier=identifier.identifier, licenses=2)]
+            ))
+        api.queue_response(200, content=page(identifiers[1], "/page3"))
+        api.queue_response(200, content=page(identifiers[2], None))
+
+        # A previous run got through the first page before it was
+        # interrupted, and left a link to the second page.
+        monitor.timestamp().achievements = "http://copies/page2"
+        monitor.run_once(None, None)
+
+        # The run started from the second page, and the first page
+        # wasn't processed again.
+        eq_(["http://copies/page2", "http://copies/page3"],
+            [url for url, headers in api.requests])
+        eq_([], identifiers[0].licensed_through)
+        for identifier in identifiers[1:]:
+            [pool] = identifier.licensed_through
+            eq_(2, pool.licenses_available)
+
+        # Now that the run is complete, the next run will start over.
+        eq_(None, monitor.timestamp().achievements)
+
+    def test_run_once_records_next_page(self):
+        collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        api = MockODLWithConsolidatedCopiesAPI(self._db, collection)
+        monitor = ODLConsolidatedCopiesMonitor(self._db, collection, api=api)
+        api.queue_response(200, content=json.dumps(dict(
+            links=[dict(href="/page2", rel="next")], copies=[]
+        )))
+
+        # The second page can't be retrieved.
+        api.queue_response(500, content="Error")
+        assert_raises(Exception, monitor.run_once, None, None)
+
+        # But the link to it was kept for the next run.
+        eq_("http://copies/page2", monitor.timestamp().achievements)
+
+    def test_process_batch_with_workers(self):
+        collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        collection.external_integration.set_setting(
+            Collection.DATA_SOURCE_NAME_SETTING, "Feedbooks"
+        )
+        api = MockODLWithConsolidatedCopiesAPI(self._db, collection)
+        monitor = ODLConsolidatedCopiesMonitor(
+            self._db, collection, api=api, workers=3
+        )
+        identifiers = [
+            self._identifier(identifier_type=Identifier.URI) for i in range(7)
+        ]
+        self._db.commit()
+
+        apis = []
+        original = monitor.api_for_session
+        def api_for_session(_db):
+            api = original(_db)
+            apis.append((_db, api))
+            return api
+        monitor.api_for_session = api_for_session
+
+        monitor.process_batch(
+            [dict(identifier=x.identifier, licenses=i+1)
+             for i, x in enumerate(identifiers)]
+        )
+
+        # The batch was dealt out between three workers. Each had its
+        # own session and its own API object.
+        eq_(3, len(apis))
+        eq_(3, len(set(id(_db) for _db, x in apis)))
+        eq_(3, len(set(id(x) for _db, x in apis)))
+        assert self._db not in [_db for _db, x in apis]
+        assert api not in [x for _db, x in apis]
+
+        # Every copy got a license pool.
+        for i, identifier in enumerate(identifiers):
+            [pool] = identifier.licensed_through
+            eq_(i+1, pool.licenses_owned)
+            eq_(i+1, pool.licenses_available)
+
 class TestODLHoldReaper(DatabaseTest, BaseODLTest):
 
     def test_run_once(self):
@@ -1445,6 +1717,51 @@ class TestODLHoldReaper(DatabaseTest, BaseODLTest):
         eq_(1, pool.licenses_available)
         eq_(2, pool.licenses_reserved)
 
+    def test_run_once_in_batches(self):
+        collection = MockODLWithConsolidatedCopiesAPI.mock_collection(self._db)
+        api = MockODLWithConsolidatedCopiesAPI(self._db, collection)
+        reaper = ODLHoldReaper(self._db, collection, api=api, batch_size=2)
+
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        pools = []
+        for i in range(5):
+            pool = self._licensepool(None, collection=collection)
+            pool.licenses_owned = 1
+            pool.licenses_reserved = 1
+            pool.licenses_available = 0
+            pool.on_hold_to(self._patron(), end=yesterday, position=0)
+            pools.append(pool)
+        pools.sort(key=lambda x: x.id)
+
+        # The first two pools have two expired holds each.
+        for pool in pools[:2]:
+            pool.on_hold_to(self._patron(), end=yesterday, position=0)
+        updated = []
+        original = api.update_hold_queue
+        def update_hold_queue(pool):
+            updated.append(pool)
+            return original(pool)
+        api.update_hold_queue = update_hold_queue
+
+        # A previous run was interrupted after handling the first pool.
+        reaper.timestamp().counter = pools[0].id
+        reaper.run_once(None, None)
+
+        # Each pool's queue was recalculated once, even the pool that
+        # had two expired holds.
+        eq_(pools[1:], updated)
+        eq_(2, len(pools[0].holds))
+        for pool in pools[1:]:
+            eq_([], pool.holds)
+            eq_(1, pool.licenses_available)
+        eq_(0, reaper.timestamp().counter)
+
+        # The next run starts from the beginning, and recalculates the
+        # first pool's queue once.
+        reaper.run_once(None, None)
+        eq_(pools[1:] + [pools[0]], updated)
+        eq_([], pools[0].holds)
+
 class TestSharedODLAPI(DatabaseTest, BaseODLTest):
 
     def setup(self):
@@ -3,6 +3,7 @@ import contextlib
 import datetime
 import os
 import re
+import time
 from lxml import etree
 from nose.tools import (
     set_trace,
@@ -10,6 +11,9 @@ from nose.tools import (
     assert_raises,
 )
 import feedparser
+import flask
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from . import DatabaseTest
 
 from core.lane import (
@@ -68,6 +72,7 @@ from api.opds import (
     SharedCollectionAnnotator,
     LibraryLoanAndHoldAnnotator,
     SharedCollectionLoanAndHoldAnnotator,
+    URLTemplates,
 )
 
 from api.testing import VendorIDTest
@@ -79,6 +84,91 @@ import jwt
 _strftime = AtomFeed._strftime
 
 
+class TestURLTemplates(object):
+
+    def setup(self):
+        app = flask.Flask(__name__)
+        def view(**kwargs):
+            return ""
+        app.add_url_rule(
+            '/<library_short_name>/works/<identifier_type>/<path:identifier>/report',
+            'report', view
+        )
+        app.add_url_rule(
+            '/<library_short_name>/groups/', 'acquisition_groups', view,
+            defaults=dict(lane_identifier=None)
+        )
+        app.add_url_rule(
+            '/<library_short_name>/groups/<int:lane_identifier>',
+            'acquisition_groups', view
+        )
+        self.app = app
+
+        # Count the URLs that actually go through Flask.
+        self.generated = []
+        templates = URLTemplates()
+        original = templates._generate
+        def _generate(cdn, route, **kwargs):
+            self.generated.append(route)
+            return original(cdn, route, **kwargs)
+        templates._generate = _generate
+        self.templates = templates
+
+    def test_urls_match_flask(self):
+        values = [
+            u"http://www.gutenberg.org/ebooks/1", u"a b+c&d?e=f",
+            u"caf\xe9 \u2603", "100%", "",
+        ]
+        with self.app.test_request_context("/", base_url="http://host/"):
+            for value in values:
+                for kwargs in [
+                    dict(library_short_name=u"lib", identifier_type=u"URI",
+                         identifier=value, _external=True),
+                    dict(library_short_name=value, identifier_type=value,
+                         identifier=u"id", order=value, available=u"all",
+                         _external=True),
+                ]:
+                    eq_(flask.url_for('report', **kwargs),
+                        self.templates.url_for(False, 'report', **kwargs))
+
+                for lane_identifier in [None, 5]:
+                    kwargs = dict(
+                        library_short_name=value,
+                        lane_identifier=lane_identifier, entrypoint=value
+                    )
+                    eq_(flask.url_for('acquisition_groups', **kwargs),
+                        self.templates.url_for(
+                            False, 'acquisition_groups', **kwargs))
+
+    def test_template_is_reused(self):
+        with self.app.test_request_context("/", base_url="http://host/"):
+            for i in range(10):
+                self.templates.url_for(
+                    False, 'report', library_short_name=u"lib",
+                    identifier_type=u"ISBN", identifier=unicode(i),
+                    _external=True
+                )
+        # The first URL was generated by Flask twice: once to make the
+        # template, and once to check the template against. All the
+        # others were made from the template.
+        eq_(['report', 'report'], self.generated)
+
+    def test_integer_arguments(self):
+        # A placeholder can't be used for an integer argument, so
+        # each integer value gets its own template.
+        with self.app.test_request_context("/", base_url="http://host/"):
+            for lane_identifier in [1, 2, 2]:
+                eq_("/lib/groups/%d" % lane_identifier, self.templates.url_for(
+                    False, 'acquisition_groups', library_short_name=u"lib",
+                    lane_identifier=lane_identifier
+                ))
+            # A string where Flask expects an integer is an error, as
+            # usual.
+            assert_raises(Exception, self.templates.url_for, False,
+                          'acquisition_groups', library_short_name=u"lib",
+                          lane_identifier=u"not a number")
+
+
 class TestCirculationManagerAnnotator(DatabaseTest):
     def setup(self):
         super(TestCirculationManagerAnnotator, self).setup()
@@ -555,6 +645,65 @@ class TestLibraryAnnotator(VendorIDTest):
         # But the borrow link is gone.
         assert u'http://opds-spec.org/acquisition/borrow' not in links
 
+    def test_work_entry_links_are_cached(self):
+        lane = self._lane()
+        work = self._work(with_license_pool=True, authors=["Author A"])
+        [pool] = work.license_pools
+        identifier = pool.identifier
+        edition = pool.presentation_edition
+
+        annotator = LibraryAnnotator(
+            None, lane, self._default_library, test_mode=True
+        )
+        urls = []
+        def url_for(*args, **kwargs):
+            urls.append(args[0])
+            return LibraryAnnotator.url_for(annotator, *args, **kwargs)
+        annotator.url_for = url_for
+
+        def entry_links():
+            feed = AcquisitionFeed(self._db, "test", "url", [], annotator)
+            entry = feed._make_entry_xml(work, edition)
+            annotator.annotate_work_entry(
+                work, pool, edition, identifier, feed, entry
+            )
+            parsed = feedparser.parse(etree.tostring(entry))
+            [entry_parsed] = parsed['entries']
+            return sorted((x['rel'], x['href']) for x in entry_parsed['links']
+                          if x['rel'] != 'http://opds-spec.org/acquisition/borrow')
+
+        links = entry_links()
+        assert 'report' in urls
+        assert 'contributor' in urls
+        assert 'series' not in urls
+
+        # The second time, the same links come out of the cache.
+        urls[:] = []
+        eq_(links, entry_links())
+        assert 'report' not in urls
+        assert 'contributor' not in urls
+
+        # If the work's presentation changes, the links are generated
+        # again.
+        work.series = "A Series"
+        edition.series = "A Series"
+        urls[:] = []
+        new_links = entry_links()
+        assert 'series' in urls
+        assert 'report' in urls
+        assert links != new_links
+
+        # The same goes for a change to the CDN configuration.
+        urls[:] = []
+        eq_(new_links, entry_links())
+        assert 'report' not in urls
+        with temp_config() as config:
+            config[Configuration.INTEGRATIONS][ExternalIntegration.CDN] = {
+                'foo.com' : 'https://cdn.com/'
+            }
+            entry_links()
+        assert 'report' in urls
+
     def test_annotate_feed(self):
         lane = self._lane()
         linksets = []
@@ -819,6 +968,43 @@ class TestLibraryAnnotator(VendorIDTest):
         [entry] = feed.entries
         assert '2018-02-07' in entry.get("updated")
 
+    def test_active_loan_feed_query_count(self):
+        # The number of queries needed to build a patron's bookshelf
+        # doesn't depend on how many books are on it.
+        patron = self._patron()
+
+        def borrow():
+            work = self._work(language="eng", with_license_pool=True)
+            work.license_pools[0].loan_to(patron)
+            work = self._work(language="eng", with_open_access_download=True)
+            work.license_pools[0].loan_to(patron)
+            work = self._work(language="eng", with_license_pool=True)
+            work.license_pools[0].on_hold_to(patron)
+
+        def count_queries():
+            self._db.flush()
+            self._db.expire_all()
+            queries = []
+            def record(*args, **kwargs):
+                queries.append(args)
+            event.listen(Engine, "before_cursor_execute", record)
+            try:
+                feed = LibraryLoanAndHoldAnnotator.active_loans_for(
+                    None, patron, test_mode=True
+                )
+                entries = feedparser.parse(unicode(feed))['entries']
+            finally:
+                event.remove(Engine, "before_cursor_execute", record)
+            return len(entries), len(queries)
+
+        borrow()
+        entries, queries = count_queries()
+        eq_(3, entries)
+
+        for i in range(4):
+            borrow()
+        eq_((15, queries), count_queries())
+
     def test_active_loan_feed(self):
         self.initialize_adobe(self._default_library)
         patron = self._patron()
@@ -1107,6 +1293,39 @@ class TestLibraryAnnotator(VendorIDTest):
         del feed_tag.attrib[key]
         eq_(etree.tostring(feed_tag), etree.tostring(generic_tag))
 
+    def test_active_loans_etag(self):
+        patron = self._patron()
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        pool.loan_to(patron)
+        etag = LibraryLoanAndHoldAnnotator.active_loans_etag
+        original = etag(patron)
+        eq_(original, etag(patron))
+
+        # A new way of delivering the book changes the ETag.
+        pool.set_delivery_mechanism(
+            Representation.EPUB_MEDIA_TYPE, DeliveryMechanism.ADOBE_DRM,
+            RightsStatus.IN_COPYRIGHT, None
+        )
+        with_mechanism = etag(patron)
+        assert with_mechanism != original
+
+        # Without a DRM client token in the feed, the ETag doesn't
+        # depend on the time.
+        old_period = LibraryLoanAndHoldAnnotator.DRM_TOKEN_ETAG_PERIOD
+        LibraryLoanAndHoldAnnotator.DRM_TOKEN_ETAG_PERIOD = 0.000001
+        try:
+            eq_(with_mechanism, etag(patron))
+
+            # With one, the ETag changes once the token is old
+            # enough that the client should get a new one.
+            self.initialize_adobe(self._default_library)
+            with_token = etag(patron)
+            time.sleep(0.001)
+            assert etag(patron) != with_token
+        finally:
+            LibraryLoanAndHoldAnnotator.DRM_TOKEN_ETAG_PERIOD = old_period
+
     def test_borrow_link_raises_unfulfillable_work(self):
         edition, pool = self._edition(with_license_pool=True)
         kindle_mechanism = pool.set_delivery_mechanism(
@@ -5,6 +5,7 @@ from nose.tools import (
 )
 import pkgutil
 import json
+import threading
 from datetime import (
     datetime,
     timedelta,
@@ -12,6 +13,7 @@ from datetime import (
 from api.overdrive import (
     MockOverdriveAPI,
     OverdriveAPI,
+    OverdriveCirculationMonitor,
     OverdriveCollectionReaper,
     OverdriveFormatSweep,
 )
@@ -806,6 +808,45 @@ class TestOverdriveAPI(OverdriveAPITest):
         eq_(10, pool.patrons_in_hold_queue)
         eq_(True, changed)
 
+    def test_patron_access_token(self):
+        # Patron tokens are kept in a cache in front of the Credential
+        # table.
+        OverdriveAPI.PATRON_TOKENS.clear()
+        patron = self._patron()
+        in_an_hour = datetime.utcnow() + timedelta(hours=1)
+        credential = self._credential(patron=patron)
+        credential.credential = "token"
+        credential.expires = in_an_hour
+
+        lookups = []
+        def get_patron_credential(patron, pin):
+            lookups.append(patron)
+            return credential
+        self.api.get_patron_credential = get_patron_credential
+
+        eq_("token", self.api.patron_access_token(patron, "pin"))
+        eq_("token", self.api.patron_access_token(patron, "pin"))
+        eq_([patron], lookups)
+
+        # When Overdrive rejects the token, it's refreshed and the new
+        # token replaces it in the cache.
+        refreshed = []
+        def refresh_patron_access_token(credential, patron, pin):
+            refreshed.append(patron)
+            credential.credential = "new token"
+            return credential
+        self.api.refresh_patron_access_token = refresh_patron_access_token
+        eq_("new token",
+            self.api.refresh_patron_access_token_once(patron, "pin", "token"))
+        eq_("new token", self.api.patron_access_token(patron, "pin"))
+
+        # A second request that was rejected with the old token doesn't
+        # cause another refresh.
+        eq_("new token",
+            self.api.refresh_patron_access_token_once(patron, "pin", "token"))
+        eq_([patron], refreshed)
+        OverdriveAPI.PATRON_TOKENS.clear()
+
     def test_refresh_patron_access_token(self):
         """Verify that patron information is included in the request
         when refreshing a patron access token.
@@ -1083,6 +1124,136 @@ class TestSyncBookshelf(OverdriveAPITest):
         eq_(5, len(patron.holds))
         assert overdrive_hold in patron.holds
 
+class MockAvailabilityAPI(MockOverdriveAPI):
+    """Pretend to look up and apply availability information, keeping
+    track of which books were handled.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MockAvailabilityAPI, self).__init__(*args, **kwargs)
+        self.fetched = []
+        self.applied = []
+        self.refreshed = []
+
+    def fetch_availability(self, book_id, exception_on_401=False):
+        self.fetched.append(book_id)
+        if book_id == 'error':
+            return None
+        if book_id == 'expired':
+            # The bearer token has expired. Getting a new one is only
+            # allowed in the main thread.
+            if exception_on_401:
+                raise Exception("Bearer token expired")
+            self.refreshed.append(book_id)
+        return dict(id=book_id)
+
+    def apply_availability(self, book):
+        self.applied.append(book['id'])
+        return None, False, book['id'] != 'unchanged'
+
+
+class TestOverdriveCirculationMonitor(OverdriveAPITest):
+
+    def test_configuration(self):
+        # By default, books are looked up one at a time with no rate
+        # limit.
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockOverdriveAPI
+        )
+        eq_(1, monitor.workers)
+        eq_(OverdriveCirculationMonitor.BATCH_SIZE, monitor.batch_size)
+        eq_(0, monitor.rate_limiter.interval)
+
+        # The collection's integration can change that.
+        integration = self.collection.external_integration
+        integration.setting(OverdriveAPI.MONITOR_WORKERS).value = "8"
+        integration.setting(
+            OverdriveAPI.MONITOR_REQUESTS_PER_SECOND
+        ).value = "20"
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockOverdriveAPI
+        )
+        eq_(8, monitor.workers)
+        eq_(0.05, monitor.rate_limiter.interval)
+
+        # So can the constructor.
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockOverdriveAPI,
+            workers=2, batch_size=10, requests_per_second=4
+        )
+        eq_(2, monitor.workers)
+        eq_(10, monitor.batch_size)
+        eq_(0.25, monitor.rate_limiter.interval)
+
+    def test_batches(self):
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockOverdriveAPI,
+            batch_size=2
+        )
+        eq_([[1, 2], [3, 4], [5]], list(monitor.batches(iter(range(1, 6)))))
+        eq_([], list(monitor.batches([])))
+
+    def test_run_once(self):
+        books = ['a', None, 'error', 'b', 'expired', 'c']
+        class Mock(OverdriveCirculationMonitor):
+            def recently_changed_ids(self, start, cutoff):
+                return iter(books)
+
+        for workers in (1, 4):
+            monitor = Mock(
+                self._db, self.collection, api_class=MockAvailabilityAPI,
+                workers=workers, batch_size=2
+            )
+            monitor.run_once(None, None)
+
+            # Every book was looked up, and the ones whose availability
+            # was found were applied in the original order, even when
+            # the lookups happened in several threads at once.
+            eq_(['a', 'b', 'c', 'error', 'expired', 'expired'],
+                sorted(monitor.api.fetched))
+            eq_(['a', 'b', 'expired', 'c'], monitor.api.applied)
+
+            # The lookup that needed a new bearer token was tried
+            # again, outside of the workers.
+            eq_(['expired'], monitor.api.refreshed)
+
+    def test_stop_after_unchanged_books(self):
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockAvailabilityAPI,
+            batch_size=2
+        )
+        monitor.maximum_consecutive_unchanged_books = 2
+        books = ['a', 'unchanged', 'b', 'unchanged', 'unchanged', 'c', 'd']
+        eq_(5, monitor.process_books(books))
+        eq_(['a', 'unchanged', 'b', 'unchanged', 'unchanged'],
+            monitor.api.applied)
+
+        # When books are looked up one at a time, nothing after the
+        # stopping point is looked up.
+        eq_(books[:5], monitor.api.fetched)
+
+        # Empty IDs don't count as unchanged books.
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockAvailabilityAPI
+        )
+        monitor.maximum_consecutive_unchanged_books = 2
+        books = ['unchanged', None, None, 'a', 'unchanged', 'unchanged', 'b']
+        eq_(6, monitor.process_books(books))
+        eq_(['unchanged', 'a', 'unchanged', 'unchanged'],
+            monitor.api.applied)
+
+    def test_fetch_availability_after_stop(self):
+        # Once the monitor has decided to stop, the workers don't
+        # look up the rest of the batch.
+        monitor = OverdriveCirculationMonitor(
+            self._db, self.collection, api_class=MockAvailabilityAPI
+        )
+        stop = threading.Event()
+        eq_(dict(id='a'), monitor.fetch_availability('a', stop))
+        stop.set()
+        eq_(None, monitor.fetch_availability('b', stop))
+        eq_(['a'], monitor.api.fetched)
+
+
 class TestOverdriveFormatSweep(OverdriveAPITest):
 
     def test_process_item(self):
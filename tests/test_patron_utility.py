@@ -10,6 +10,8 @@ from . import (
 
 from api.config import Configuration, temp_config
 from api.authenticator import PatronData
+from api.circulation import PatronActivityCache
+from api.util.cache import LRUCache
 from api.util.patron import PatronUtility
 from api.circulation_exceptions import *
 
@@ -49,6 +51,20 @@ class TestPatronUtility(DatabaseTest):
         patron.last_external_sync = six_seconds_ago
         eq_(True, PatronUtility.needs_external_sync(patron))
 
+        # But if the patron's loans and holds were just fetched from
+        # every remote and cached, they don't need to be synced until
+        # the cache entry expires.
+        activity_cache = PatronActivityCache(LRUCache(), 60)
+        eq_(True, PatronUtility.needs_external_sync(patron, activity_cache))
+        activity_cache.mark_fresh(patron)
+        eq_(False, PatronUtility.needs_external_sync(patron, activity_cache))
+
+        # A patron with borrowing privileges is still synced every
+        # twelve hours.
+        patron.authorization_expires = None
+        patron.last_external_sync = yesterday
+        eq_(True, PatronUtility.needs_external_sync(patron, activity_cache))
+
     def test_has_borrowing_privileges(self):
         """Test the methods that encapsulate the determination
         of whether or not a patron can borrow books.
@@ -0,0 +1,44 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.util.rate_limit import RateLimiter
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class TestRateLimiter(object):
+
+    def test_no_limit(self):
+        clock = MockClock()
+        limiter = RateLimiter(None, clock=clock.time, sleep=clock.sleep)
+        for i in range(10):
+            eq_(0, limiter.wait())
+        eq_([], clock.sleeps)
+
+    def test_calls_are_spaced_out(self):
+        clock = MockClock()
+        limiter = RateLimiter(4, clock=clock.time, sleep=clock.sleep)
+
+        # The first call goes through immediately; each call after
+        # that has to wait a quarter second longer than the last,
+        # since the clock isn't moving.
+        eq_([0, 0.25, 0.5, 0.75], [limiter.wait() for i in range(4)])
+        eq_([0.25, 0.5, 0.75], clock.sleeps)
+
+        # After a long pause, calls go through immediately again.
+        clock.now += 60
+        eq_(0, limiter.wait())
+        eq_(0.25, limiter.wait())
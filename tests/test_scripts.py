@@ -10,6 +10,9 @@ import flask
 import json
 from StringIO import StringIO
 
+from api.admin.dashboard_stats import DashboardStats
+from api.admin.lane_sizes import LaneSizeQueue
+from api.feed_cache import ChangedWorkQueue
 from api.adobe_vendor_id import (
     AdobeVendorIDModel,
     AuthdataUtility,
@@ -80,6 +83,8 @@ from scripts import (
     InstanceInitializationScript,
     LanguageListScript,
     NovelistSnapshotScript,
+    RefreshDashboardStatsScript,
+    UpdateLaneSizesScript,
 )
 
 class TestAdobeAccountIDResetScript(DatabaseTest):
@@ -224,6 +229,76 @@ class TestCacheFacetListsPerLane(TestLaneScript):
             # 2 availabilities * 2 collections * 1 order * 1 page = 4 feeds
             eq_(4, len(cached_feeds))
 
+        [(identifier, stats)] = script.lane_stats.items()
+        eq_(lane.full_identifier, identifier)
+        feeds, elapsed, size = stats
+        eq_(4, feeds)
+        eq_(sum(len(x) for x in cached_feeds if x), size)
+
+    def test_process_lane_with_workers(self):
+        script = CacheFacetListsPerLane(
+            self._db, ["--availability=all", "--collection=main",
+                       "--collection=full", "--order=title", "--pages=2",
+                       "--workers=3"],
+            testing=True
+        )
+        eq_(3, script.workers)
+        lane = self._lane()
+        with script.app.test_request_context("/"):
+            # Instead of generating feeds, process_lane() leaves a
+            # task for each feed, to be handed to the worker processes.
+            eq_([], script.process_lane(lane))
+            eq_(4, len(script.tasks))
+            eq_(set([(self._default_library.id, lane.id, lane.full_identifier)]),
+                set(task[:3] for task in script.tasks))
+            eq_([('main', 0), ('main', 1), ('full', 0), ('full', 1)],
+                [(task[3]['collection'], task[3]['page'])
+                 for task in script.tasks])
+
+            # This is what a worker process does with each task.
+            for task in script.tasks:
+                identifier, elapsed, size = script.generate_feed_task(task)
+                eq_(lane.full_identifier, identifier)
+                assert size > 0
+                script.record_stats(identifier, 1, elapsed, size)
+        eq_(4, script.lane_stats[lane.full_identifier][0])
+
+    def test_incremental(self):
+        work = self._work(fiction=True, with_license_pool=True)
+        lane = self._lane(fiction=True)
+        self.add_to_materialized_view([work], true_opds=True)
+        ChangedWorkQueue.watch(self._db)
+
+        script = CacheFacetListsPerLane(
+            self._db, ["--availability=all", "--collection=full",
+                       "--order=title", "--pages=2", "--incremental"],
+            testing=True
+        )
+        eq_(True, script.incremental)
+        lane = self._db.merge(lane)
+        with script.app.test_request_context("/"):
+            # The feeds haven't been cached, so they're generated.
+            eq_(2, len(script.process_lane(lane)))
+
+            # Nothing has changed since then, so they're left alone.
+            eq_([], script.process_lane(lane))
+
+            # Once a monitor notices that one of the lane's books has
+            # changed, the feeds are generated again.
+            ChangedWorkQueue.add(
+                self._db.connection(), [work.id], datetime.datetime.utcnow()
+            )
+            eq_(2, len(script.process_lane(lane)))
+            eq_([], script.process_lane(lane))
+
+            # A change to a book that isn't in the lane makes no
+            # difference.
+            other = self._work(fiction=False)
+            ChangedWorkQueue.add(
+                self._db.connection(), [other.id], datetime.datetime.utcnow()
+            )
+            eq_([], script.process_lane(lane))
+
 
 class TestCacheOPDSGroupFeedPerLane(TestLaneScript):
 
@@ -907,3 +982,36 @@ class TestNovelistSnapshotScript(DatabaseTest):
         eq_(params[0], l1)
 
         NoveListAPI.from_config = oldNovelistConfig
+
+
+class TestRefreshDashboardStatsScript(DatabaseTest):
+
+    def test_do_run(self):
+        self._patron()
+        edition, pool = self._edition(with_license_pool=True)
+        pool.open_access = False
+        pool.licenses_owned = 3
+
+        RefreshDashboardStatsScript(self._db).do_run()
+        stats = DashboardStats.from_snapshot(self._db)
+        eq_(1, stats.for_library(self._default_library)['total'])
+        eq_(3, stats.for_collection(self._default_collection)['licenses'])
+
+
+class TestUpdateLaneSizesScript(DatabaseTest):
+
+    def test_do_run(self):
+        lane = self._lane()
+        lane.size = 100
+        other_lane = self._lane()
+        other_lane.size = 100
+
+        # Queueing a lane twice doesn't make it get updated twice.
+        LaneSizeQueue.add(self._db, [lane])
+        LaneSizeQueue.add(self._db, [lane])
+        UpdateLaneSizesScript(self._db).do_run()
+        eq_(0, lane.size)
+        eq_(100, other_lane.size)
+
+        # The queue is now empty.
+        eq_(0, LaneSizeQueue.process(self._db))
@@ -0,0 +1,83 @@
+import datetime
+import threading
+import time
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.util.token_cache import AccessTokenCache
+
+
+class MockCredential(object):
+
+    def __init__(self, credential, expires=None):
+        self.credential = credential
+        self.expires = expires
+
+
+class TestAccessTokenCache(object):
+
+    def setup(self):
+        self.cache = AccessTokenCache()
+        self.lookups = []
+
+    def lookup(self, token, expires=None):
+        def lookup():
+            self.lookups.append(token)
+            return MockCredential(token, expires)
+        return lookup
+
+    def test_get(self):
+        in_an_hour = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        eq_("token", self.cache.get("key", self.lookup("token", in_an_hour)))
+
+        # The second time, the token comes from the cache.
+        eq_("token", self.cache.get("key", self.lookup("other")))
+        eq_(["token"], self.lookups)
+
+        # Other keys have their own tokens.
+        eq_("other", self.cache.get("key2", self.lookup("other")))
+
+        # Once a token is invalidated, it's looked up again.
+        self.cache.invalidate("key")
+        eq_("new", self.cache.get("key", self.lookup("new")))
+        eq_(["token", "other", "new"], self.lookups)
+
+    def test_tokens_about_to_expire_are_not_cached(self):
+        soon = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+        eq_("token", self.cache.get("key", self.lookup("token", soon)))
+        eq_("token", self.cache.get("key", self.lookup("token", soon)))
+        eq_(["token", "token"], self.lookups)
+
+    def test_refresh(self):
+        self.cache.get("key", self.lookup("rejected"))
+
+        # A rejected token is refreshed.
+        eq_("new", self.cache.refresh("key", "rejected", self.lookup("new")))
+        eq_("new", self.cache.get("key", self.lookup("unused")))
+
+        # If the token was already refreshed by someone else, it's not
+        # refreshed again.
+        eq_("new",
+            self.cache.refresh("key", "rejected", self.lookup("newer")))
+        eq_(["rejected", "new"], self.lookups)
+
+    def test_single_flight(self):
+        # Many threads want the same token at once, but it's only
+        # looked up once.
+        def slow_lookup():
+            self.lookups.append("token")
+            time.sleep(0.1)
+            return MockCredential("token")
+
+        results = []
+        def get():
+            results.append(self.cache.get("key", slow_lookup))
+        threads = [threading.Thread(target=get) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(["token"] * 10, results)
+        eq_(["token"], self.lookups)
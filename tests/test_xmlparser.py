@@ -0,0 +1,96 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from . import (
+    DatabaseTest,
+    sample_data,
+)
+
+from api.axis import AvailabilityResponseParser
+from api.bibliotheca import (
+    CirculationParser,
+    EventParser,
+    PatronCirculationParser,
+)
+from api.util.xmlparser import response_body
+
+
+class ChunkedFile(object):
+    """A file-like object that hands out a document a few bytes at a
+    time, the way the body of a response comes off a socket.
+    """
+
+    def __init__(self, data, chunk_size=7):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        if size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        chunk = self.data[self.position:self.position+size]
+        self.position += len(chunk)
+        return chunk
+
+
+def describe(x):
+    """Turn a parser's output into something that can be compared
+    with ==, however it's represented.
+    """
+    if isinstance(x, (list, tuple)):
+        return [describe(i) for i in x]
+    if isinstance(x, dict):
+        return dict((k, describe(v)) for k, v in x.items())
+    if hasattr(x, '__dict__'):
+        return (x.__class__, describe(vars(x)))
+    return x
+
+
+class TestIncrementalXMLParser(DatabaseTest):
+
+    def test_process_stream(self):
+        # For every parser with a process_stream method, parsing a
+        # document as it's read gives the same results as parsing it
+        # all at once, whether it's read from a string or a few bytes
+        # at a time from a file-like object.
+        collection = self._default_collection
+        for parser, (directory, filename) in [
+            (EventParser(), ('bibliotheca', 'empty_end_date_event.xml')),
+            (CirculationParser(), ('bibliotheca', 'item_circulation.xml')),
+            (PatronCirculationParser(collection),
+             ('bibliotheca', 'checkouts.xml')),
+            (AvailabilityResponseParser(collection),
+             ('axis', 'availability_with_loan_and_hold.xml')),
+        ]:
+            data = sample_data(filename, directory)
+            expect = describe(list(parser.process_all(data)))
+            assert expect, filename
+            eq_(expect, describe(list(parser.process_stream(data))))
+
+            source = ChunkedFile(data)
+            eq_(expect, describe(list(parser.process_stream(source))))
+            assert source.reads > 1
+
+    def test_response_body(self):
+        class Response(object):
+            content = "<content/>"
+
+        # A response that wasn't streamed, or is a mock, gives up
+        # its content.
+        response = Response()
+        eq_("<content/>", response_body(response))
+
+        response.raw = object()
+        response._content_consumed = True
+        eq_("<content/>", response_body(response))
+
+        # A streamed response whose body hasn't been read gives up
+        # its raw stream, set to decode the body as it's read.
+        response.raw = ChunkedFile("<content/>")
+        response._content_consumed = False
+        eq_(response.raw, response_body(response))
+        eq_(True, response.raw.decode_content)